@@ -42,6 +42,11 @@ setup(
     install_requires=[],  # removed for better compat
     scripts=[
         'bin/swift-origin-prep',
+        'bin/sos-migrate',
+        'bin/sos-fsck',
+        'bin/sos-reshard',
+        'bin/sos-deliver-logs',
+        'bin/sos-log-stats',
         ],
     entry_points={
         'paste.filter_factory': [
@@ -0,0 +1,211 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local disk cache of fixed size blocks of large CDN objects, for the
+overlapping Range requests of video players.
+
+A block is the block_size bytes of an object starting at index *
+block_size, kept in a file named after the object's etag and the index, so
+a block is never stale and objects with the same contents share them.  The
+cache also remembers the etag, length and headers of the objects it has
+seen, for their container's TTL but at most max_ttl seconds, to know which
+blocks a Range needs without asking swift.  Blocks are read with mmap and
+the least recently used ones are deleted to keep within max_bytes.
+
+Each worker process uses its own directory under the cache dir, named
+after its pid; the ones of processes that are gone are removed when a
+worker starts using the cache.
+"""
+from collections import OrderedDict
+from hashlib import md5
+import mmap
+import os
+import shutil
+from time import time
+
+from sos.collapse import CONTENT_RANGE_RE
+from sos.metrics import NULL_METRICS, pid_alive
+
+# headers of an object kept to answer Range requests with
+OBJECT_HEADERS = ('Content-Type', 'Content-Encoding', 'Content-Disposition',
+                  'Last-Modified')
+
+
+class ObjectInfo(object):
+
+    def __init__(self, etag, length, headers, expires):
+        self.etag = etag
+        self.length = length
+        self.headers = headers
+        self.expires = expires
+
+
+class BlockCache(object):
+
+    def __init__(self, path, block_size=2 * 1024 * 1024,
+                 max_bytes=1024 ** 3, min_object_size=None, max_ttl=300,
+                 max_objects=10000, metrics=None):
+        self.path = path
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.min_object_size = min_object_size or 2 * block_size
+        self.max_ttl = max_ttl
+        self.max_objects = max_objects
+        self.metrics = metrics or NULL_METRICS
+        self.objects = OrderedDict()
+        # (etag, index) -> size of the blocks on disk
+        self.blocks = OrderedDict()
+        self.size = 0
+        self.dir = None
+
+    def _block_dir(self):
+        """
+        :returns: this process's directory, made on first use
+        """
+        pid = os.getpid()
+        if self.dir and self.dir[0] == pid:
+            return self.dir[1]
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in os.listdir(self.path):
+            if name.isdigit() and not pid_alive(int(name)):
+                shutil.rmtree(os.path.join(self.path, name), True)
+        block_dir = os.path.join(self.path, str(pid))
+        # a process with a recycled pid may have left it behind
+        shutil.rmtree(block_dir, True)
+        os.mkdir(block_dir)
+        self.dir = (pid, block_dir)
+        self.blocks.clear()
+        self.size = 0
+        return block_dir
+
+    def _block_path(self, etag, index):
+        return os.path.join(self._block_dir(),
+                            '%s.%d' % (md5(etag).hexdigest(), index))
+
+    def object_info(self, path, now=None):
+        """
+        :returns: the unexpired ObjectInfo of path, or None
+        """
+        info = self.objects.get(path)
+        if info and info.expires <= (now or time()):
+            del self.objects[path]
+            return None
+        return info
+
+    def learn(self, path, resp, ttl, now=None):
+        """
+        Remembers the object path from a swift GET's 200 or 206 response,
+        if it is big enough to be worth caching in blocks.
+        """
+        if not resp.etag:
+            return
+        if resp.status_int == 206:
+            match = CONTENT_RANGE_RE.match(
+                resp.headers.get('Content-Range', ''))
+            if not match or match.group(3) == '*':
+                return
+            length = int(match.group(3))
+        else:
+            length = resp.content_length
+        if length is None or length < self.min_object_size:
+            return
+        headers = [(header, resp.headers[header]) for header in OBJECT_HEADERS
+                   if resp.headers.get(header)]
+        self.objects.pop(path, None)
+        self.objects[path] = ObjectInfo(resp.etag, length, headers,
+            (now or time()) + min(ttl, self.max_ttl))
+        while len(self.objects) > self.max_objects:
+            self.objects.popitem(last=False)
+
+    def forget(self, path):
+        self.objects.pop(path, None)
+
+    def block_bounds(self, index, length):
+        """
+        :returns: (start, stop) offsets of block index of an object length
+                  bytes long
+        """
+        start = index * self.block_size
+        return start, min(start + self.block_size, length)
+
+    def __contains__(self, key):
+        return key in self.blocks
+
+    def read_block(self, etag, index, start=0, stop=None):
+        """
+        :returns: bytes start to stop of a cached block, or None if it
+                  isn't cached
+        """
+        key = (etag, index)
+        if key not in self.blocks:
+            return None
+        try:
+            fp = open(self._block_path(etag, index), 'rb')
+        except IOError:
+            self.size -= self.blocks.pop(key)
+            return None
+        try:
+            block = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = block[start:stop]
+            finally:
+                block.close()
+        finally:
+            fp.close()
+        self.blocks[key] = self.blocks.pop(key)
+        return data
+
+    def put_block(self, etag, index, data):
+        key = (etag, index)
+        if key in self.blocks or len(data) > self.max_bytes:
+            return
+        path = self._block_path(etag, index)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+        self.blocks[key] = len(data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            (old_etag, old_index), size = self.blocks.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(self._block_path(old_etag, old_index))
+            except OSError:
+                pass
+
+    def iter_range(self, info, start, stop, fetch_block):
+        """
+        Yields bytes start to stop of an object, a block at a time.
+
+        :param fetch_block: function of a block index that GETs it from
+                            swift, caches it and returns it
+        """
+        index = start // self.block_size
+        while start < stop:
+            block_start, block_stop = self.block_bounds(index, info.length)
+            data = self.read_block(info.etag, index, start - block_start,
+                                   min(stop, block_stop) - block_start)
+            if data is None:
+                data = fetch_block(index)[start - block_start:
+                                          min(stop, block_stop) - block_start]
+            else:
+                self.metrics.incr('sos_block_cache_total', ('hit',))
+            if not data:
+                raise IOError('Block %d of %s is short' % (index, info.etag))
+            yield data
+            start += len(data)
+            index += 1
@@ -0,0 +1,87 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Circuit breaker for the metadata store lookups of a worker process.
+
+It opens after failures consecutive failed or timed out lookups and then
+turns lookups away for reset_timeout seconds.  After that a single lookup
+is let through as a probe: it closes the breaker if it works and opens it
+again if not.  Every change of state is logged and counted in
+sos_breaker_transitions_total for alerting.
+"""
+from time import time
+
+from sos.metrics import NULL_METRICS
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failures=5, reset_timeout=30, logger=None,
+                 metrics=None):
+        self.name = name
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.logger = logger
+        self.metrics = metrics or NULL_METRICS
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        # when the half open probe was let through, None if there is none
+        self.probe_started = None
+
+    def _change(self, state, now):
+        if self.logger:
+            log = state == CLOSED and self.logger.info or \
+                self.logger.warning
+            log('%s circuit breaker %s' % (self.name, state))
+        self.metrics.incr('sos_breaker_transitions_total', (self.name, state))
+        self.state = state
+        if state == OPEN:
+            self.opened_at = now
+        self.probe_started = None
+
+    def allow(self, now=None):
+        """
+        :returns: True if a lookup may be made
+        """
+        if self.state == CLOSED:
+            return True
+        if now is None:
+            now = time()
+        if self.state == OPEN:
+            if now < self.opened_at + self.reset_timeout:
+                return False
+            self._change(HALF_OPEN, now)
+        # a probe that never reported back doesn't hold it half open
+        if self.probe_started is not None and \
+                now < self.probe_started + self.reset_timeout:
+            return False
+        self.probe_started = now
+        return True
+
+    def success(self, now=None):
+        self.failures = 0
+        if self.state != CLOSED:
+            self._change(CLOSED, now or time())
+
+    def failure(self, now=None):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and
+                                       self.failures >= self.max_failures):
+            self._change(OPEN, now or time())
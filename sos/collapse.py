@@ -0,0 +1,245 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Collapsing of concurrent CDN GETs for the same object into one swift GET.
+
+The first request for a path and set of request headers makes the GET and
+the requests for the same ones that come in before it has dropped any of
+the body join it.  The body is read from swift only as fast as the fastest
+client takes it and the last buffer_size bytes of it are kept for the
+others.  A client that falls further behind than that gets the rest of the
+body with its own ranged GET, so a slow client can't hold up the others.
+"""
+from collections import deque
+import re
+
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
+from webob import Response
+
+from sos.metrics import NULL_METRICS
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class SharedFetch(object):
+    """
+    One swift GET and the part of its body still buffered.
+    """
+
+    def __init__(self, collapser, key, headers):
+        self.collapser = collapser
+        self.key = key
+        self.headers = headers
+        self.resp = None
+        self.ready = Event()
+        self.backend = None
+        self.chunks = deque()
+        # index of the first chunk in chunks
+        self.dropped = 0
+        self.buffered = 0
+        self.done = False
+        self.failed = False
+        self.closed = False
+        self.readers = 0
+        self.lock = Semaphore(1)
+
+    def start(self, fetch):
+        try:
+            self.resp = fetch(self.headers)
+        finally:
+            self.ready.send(self.resp)
+        if self.resp.status_int in (200, 206) and self.body_range():
+            self.backend = iter(self.resp.app_iter)
+        else:
+            # nothing to share: joined clients get the status, or make
+            # their own GET if they need the body
+            self.collapser.detach(self)
+
+    def body_range(self):
+        """
+        :returns: (first, last) byte of the object in the body, or None if
+                  it can't be told
+        """
+        if self.resp.status_int == 200:
+            if self.resp.content_length is None:
+                return None
+            return 0, self.resp.content_length - 1
+        match = CONTENT_RANGE_RE.match(
+            self.resp.headers.get('Content-Range', ''))
+        if not match:
+            return None
+        return int(match.group(1)), int(match.group(2))
+
+    def read(self, index):
+        """
+        :returns: the index-th chunk of the body, '' at the end of it or
+                  None if it is no longer buffered
+        """
+        while True:
+            if index < self.dropped:
+                return None
+            if index < self.dropped + len(self.chunks):
+                return self.chunks[index - self.dropped]
+            if self.failed:
+                raise IOError('Shared swift GET failed')
+            if self.done:
+                return ''
+            if self.closed:
+                return None
+            with self.lock:
+                # another client may have read it while this one waited
+                if index < self.dropped + len(self.chunks) or self.done or \
+                        self.closed:
+                    continue
+                try:
+                    chunk = self.backend.next()
+                except StopIteration:
+                    self.done = True
+                    self.collapser.detach(self)
+                    continue
+                except Exception:
+                    self.failed = self.done = True
+                    self.collapser.detach(self)
+                    raise
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+                while self.buffered > self.collapser.buffer_size and \
+                        len(self.chunks) > 1:
+                    self.buffered -= len(self.chunks.popleft())
+                    if not self.dropped:
+                        # a new client couldn't get the start of the body
+                        self.collapser.detach(self)
+                    self.dropped += 1
+
+    def response(self, fetch):
+        """
+        :returns: a webob.Response for a client of this GET
+        """
+        if self.backend is None:
+            app_iter = ['']
+        else:
+            self.readers += 1
+            app_iter = SharedIter(self, fetch)
+        return Response(status=self.resp.status,
+                        headerlist=list(self.resp.headerlist),
+                        app_iter=app_iter, request=self.resp.request)
+
+    def close_reader(self):
+        self.readers -= 1
+        if not self.readers:
+            # a client that joined but hasn't started reading yet gets
+            # what is still buffered, then its own GET for the rest
+            self.collapser.detach(self)
+            self.closed = True
+            if hasattr(self.resp.app_iter, 'close'):
+                self.resp.app_iter.close()
+
+
+class SharedIter(object):
+    """
+    A client's iterator over the body of a SharedFetch.
+    """
+
+    def __init__(self, shared, fetch):
+        self.shared = shared
+        self.fetch = fetch
+        self.closed = False
+
+    def __iter__(self):
+        index = 0
+        sent = 0
+        while True:
+            chunk = self.shared.read(index)
+            if chunk is None:
+                break
+            if not chunk:
+                return
+            index += 1
+            sent += len(chunk)
+            yield chunk
+        # fell behind the buffer, get the rest from swift
+        self.shared.collapser.metrics.incr('sos_collapsed_requests_total',
+                                           ('slow',))
+        self.close()
+        first, last = self.shared.body_range()
+        if first + sent > last:
+            return
+        headers = dict(self.shared.headers)
+        for header in ('If-Range', 'If-Modified-Since'):
+            headers.pop(header, None)
+        headers['Range'] = 'bytes=%d-%d' % (first + sent, last)
+        if self.shared.resp.etag:
+            headers['If-Match'] = '"%s"' % self.shared.resp.etag
+        resp = self.fetch(headers)
+        if resp.status_int != 206:
+            raise IOError('Ranged GET for a slow client got %s' % resp.status)
+        try:
+            for chunk in resp.app_iter:
+                yield chunk
+        finally:
+            if hasattr(resp.app_iter, 'close'):
+                resp.app_iter.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shared.close_reader()
+
+
+class Collapser(object):
+    """
+    The GETs being shared in a worker process.
+    """
+
+    def __init__(self, buffer_size=4 * 1024 * 1024, metrics=None):
+        self.buffer_size = buffer_size
+        self.metrics = metrics or NULL_METRICS
+        self.fetches = {}
+
+    def detach(self, shared):
+        """
+        Stops new clients from joining shared.
+        """
+        if self.fetches.get(shared.key) is shared:
+            del self.fetches[shared.key]
+
+    def get(self, path, headers, fetch):
+        """
+        GETs path from swift, sharing the GET with other clients.
+
+        :param fetch: function of request headers making a GET of path
+        :returns: webob.Response
+        """
+        key = (path, tuple(sorted(headers.iteritems())))
+        shared = self.fetches.get(key)
+        if shared:
+            resp = shared.ready.wait()
+            if resp is None or (shared.backend is None and
+                                resp.status_int in (200, 206)):
+                # the shared GET failed or its body can't be shared
+                return fetch(headers)
+            self.metrics.incr('sos_collapsed_requests_total', ('joined',))
+        else:
+            shared = self.fetches[key] = SharedFetch(self, key, headers)
+            try:
+                shared.start(fetch)
+            except Exception:
+                self.detach(shared)
+                raise
+            self.metrics.incr('sos_collapsed_requests_total', ('fetched',))
+            if shared.backend is None:
+                return shared.resp
+        return shared.response(fetch)
@@ -0,0 +1,96 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per handler concurrency limits, so a storm of origin db or admin requests
+can't take every green thread of the proxy from the CDN requests.
+
+A request holds its handler's slot until its response has been sent, as
+listings, bulk changes and exports do most of their work while streaming.
+When all the slots are taken up to queue_size requests wait for one, for
+at most queue_timeout seconds; the rest are turned away at once.
+"""
+from eventlet import Timeout
+from eventlet.semaphore import Semaphore
+
+HANDLER_NAMES = ('cdn', 'origin_db', 'admin')
+DEFAULT_CONCURRENCY = {'cdn': 0, 'origin_db': 100, 'admin': 10}
+
+
+class ConcurrencyLimit(object):
+
+    def __init__(self, size, queue_size=0, queue_timeout=1.0):
+        self.size = size
+        self.semaphore = Semaphore(size)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+
+    def acquire(self):
+        """
+        :returns: True if a slot was taken, False if the request should be
+                  turned away
+        """
+        if self.semaphore.acquire(blocking=False):
+            return True
+        if self.waiting >= self.queue_size:
+            return False
+        self.waiting += 1
+        try:
+            with Timeout(self.queue_timeout, False):
+                return self.semaphore.acquire()
+            return False
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+
+class ReleasingIter(object):
+    """
+    Wraps a response's app_iter to call release once it is closed.
+    """
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self._release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            release, self._release = self._release, None
+            if release:
+                release()
+
+
+def limits_from_conf(conf):
+    """
+    :returns: dict of handler name -> ConcurrencyLimit for the handlers
+              with a <handler>_concurrency other than 0
+    """
+    limits = {}
+    queue_timeout = float(conf.get('concurrency_queue_timeout', 1))
+    for name in HANDLER_NAMES:
+        size = int(conf.get('%s_concurrency' % name,
+                            DEFAULT_CONCURRENCY[name]))
+        if size > 0:
+            limits[name] = ConcurrencyLimit(size,
+                int(conf.get('%s_queue_size' % name, size)), queue_timeout)
+    return limits
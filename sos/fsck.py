@@ -0,0 +1,388 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Consistency checker for the origin db.  origin_db_puts_posts and
+origin_db_delete update a container's .hash_N object and its row in the
+account listing container in separate requests, so a failure in between
+leaves the two out of sync.
+
+The rows of every account listing container are keyed by their hash_path
+and spilled to sorted runs on disk; the .hash_N container listings are
+already sorted by hash, so they are just merged.  The two sorted streams
+are then joined, which keeps memory bounded no matter how many containers
+are CDN enabled.  Listing rows carry everything a .hash_N object holds, so
+an object only has to be fetched when its etag doesn't match the json the
+row implies.
+
+Problems found:
+
+missing_hash
+    a listing row without a .hash_N object, left by a DELETE that removed
+    the object but not the row.  Repaired by deleting the row.
+orphan_hash
+    a .hash_N object without a listing row, left by a PUT or POST that
+    wrote the object but not the row.  Repaired by adding the row.
+mismatch
+    ttl or flags differ.  The .hash_N object is written first and is what
+    the CDN uses, so the row is repaired to match it.
+misplaced
+    a .hash_N object in a different .hash_N container than
+    get_hsh_obj_path gives.  Repaired by moving it.
+misplaced_row
+    a listing row in a different listing shard container than
+    get_listing_cont gives, left by changing number_listing_shards.
+    Repaired by moving it.
+invalid
+    a .hash_N object that can't be parsed or whose name isn't the
+    hash_path of its account and container.  Only reported.
+"""
+import heapq
+import os
+from collections import defaultdict
+from hashlib import md5
+from itertools import groupby
+from tempfile import mkstemp
+from urllib import quote, unquote
+
+from eventlet import GreenPool
+from eventlet.queue import Queue
+
+from sos.origin import HashData, OriginBase, InvalidUtf8, \
+    parse_listing_content_type, gen_listing_content_type, split_listing_cont
+from sos.utils import ClientException, iter_listing, \
+    iter_origin_containers, split_container_path, split_hsh_obj_path
+
+FSCK_LISTING_LIMIT = 1000
+
+
+class ExternalSorter(object):
+    """
+    Sorts more lines than fit in memory: every run_size lines are sorted
+    and written to a temp file and iterating merges the runs.
+    """
+
+    def __init__(self, run_size=100000, tmpdir=None):
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.lines = []
+        self.runs = []
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        if not self.lines:
+            return
+        self.lines.sort()
+        fd, path = mkstemp(dir=self.tmpdir, prefix='sos-fsck-')
+        fp = os.fdopen(fd, 'w')
+        try:
+            for line in self.lines:
+                fp.write(line + '\n')
+        finally:
+            fp.close()
+        self.runs.append(path)
+        self.lines = []
+
+    def __iter__(self):
+        self._spill()
+        files = [open(path) for path in self.runs]
+        try:
+            for line in heapq.merge(*files):
+                yield line[:-1]
+        finally:
+            for fp in files:
+                fp.close()
+
+    def close(self):
+        for path in self.runs:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.runs = []
+        self.lines = []
+
+
+class Fsck(object):
+
+    def __init__(self, conf, conn_pool, logger, concurrency=10,
+                 run_size=100000, tmpdir=None, repair=False, report=None):
+        self.origin = OriginBase(None, conf, logger)
+        self.conn_pool = conn_pool
+        self.logger = logger
+        self.pool = GreenPool(concurrency)
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.repair = repair
+        self.report = report or self._log_report
+        self.stats = defaultdict(int)
+
+    def _log_report(self, problem, hsh, account, container, detail=''):
+        self.logger.info('%s %s %s/%s %s' % (problem, hsh, quote(account),
+                                             quote(container), detail))
+
+    def _problem(self, problem, hsh, account='-', container='-', detail=''):
+        self.stats[problem] += 1
+        self.report(problem, hsh, account, container, detail)
+
+    def hash_cont(self, hsh):
+        return split_hsh_obj_path(self.origin.get_hsh_obj_path(hsh))[0]
+
+    def listing_cont(self, account, hsh):
+        return '%s/%s' % (self.origin.get_origin_account(account),
+                          self.origin.get_listing_cont(account, hsh))
+
+    def listing_containers(self):
+        for path in iter_origin_containers(self.conn_pool,
+                self.origin.all_origin_accounts()):
+            if split_listing_cont(split_container_path(path)[1]) is not None:
+                yield path
+
+    def sorted_listing_rows(self, sorter):
+        """
+        Lists every account listing container into sorter as
+        hsh, account, container, content_type, listing container lines.
+        """
+        def list_account(listing_cont):
+            account = split_listing_cont(
+                split_container_path(listing_cont)[1])
+            for page in iter_listing(self.conn_pool, listing_cont,
+                                     limit=FSCK_LISTING_LIMIT):
+                for row in page:
+                    container = row['name']
+                    if isinstance(container, unicode):
+                        container = container.encode('utf-8')
+                    sorter.add('\t'.join((
+                        self.origin.hash_path(account, container),
+                        quote(account), quote(container),
+                        row['content_type'], quote(listing_cont))))
+                    self.stats['listing_rows'] += 1
+
+        pool = GreenPool(self.pool.size)
+        for listing_cont in self.listing_containers():
+            pool.spawn_n(list_account, listing_cont)
+        pool.waitall()
+        for line in sorter:
+            hsh, account, container, content_type, listing_cont = \
+                line.split('\t')
+            yield hsh, (unquote(account), unquote(container), content_type,
+                        unquote(listing_cont))
+
+    def _prefetch(self, container, pool):
+        """
+        Yields the (name, etag) rows of a .hash_N container while a green
+        thread keeps the next page loaded.
+        """
+        queue = Queue(1)
+
+        def producer():
+            try:
+                for page in iter_listing(self.conn_pool, container,
+                                         limit=FSCK_LISTING_LIMIT):
+                    queue.put(page)
+                queue.put(None)
+            except Exception, e:
+                queue.put(e)
+
+        pool.spawn_n(producer)
+        while True:
+            page = queue.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            for row in page:
+                yield str(row['name']), (container, row['hash'])
+
+    def sorted_hash_objects(self):
+        containers = self.origin.hash_container_paths()
+        pool = GreenPool(len(containers))
+        return heapq.merge(*[self._prefetch(container, pool)
+                             for container in containers])
+
+    def join(self, listing_rows, hash_objs):
+        """
+        Merge joins two streams of (hsh, data) sorted by hsh.
+
+        :returns: generator of (hsh, [listing data], [hash obj data])
+        """
+        listings = groupby(listing_rows, lambda item: item[0])
+        hashes = groupby(hash_objs, lambda item: item[0])
+        listing = next(listings, None)
+        hsh_obj = next(hashes, None)
+        while listing or hsh_obj:
+            if hsh_obj is None or \
+                    (listing is not None and listing[0] < hsh_obj[0]):
+                yield listing[0], [d for h, d in listing[1]], []
+                listing = next(listings, None)
+            elif listing is None or hsh_obj[0] < listing[0]:
+                yield hsh_obj[0], [], [d for h, d in hsh_obj[1]]
+                hsh_obj = next(hashes, None)
+            else:
+                yield listing[0], [d for h, d in listing[1]], \
+                    [d for h, d in hsh_obj[1]]
+                listing = next(listings, None)
+                hsh_obj = next(hashes, None)
+
+    def _get_hash_data(self, cont, hsh):
+        with self.conn_pool.item() as conn:
+            body = conn.get_object(cont, hsh)[1]
+        try:
+            hash_data = HashData.create_from_json(body)
+        except (ValueError, InvalidUtf8):
+            return None
+        if self.origin.hash_path(hash_data.account.encode('utf-8'),
+                hash_data.container.encode('utf-8')) != hsh:
+            return None
+        return hash_data
+
+    def _put_listing_row(self, hsh, hash_data):
+        listing_cont = self.listing_cont(hash_data.account.encode('utf-8'),
+                                         hsh)
+        with self.conn_pool.item() as conn:
+            conn.put_container(listing_cont)
+            conn.put_object(listing_cont, hash_data.container.encode('utf-8'),
+                '', content_type=gen_listing_content_type(
+                    hash_data.cdn_enabled, hash_data.ttl,
+                    hash_data.logs_enabled))
+
+    def _check_listing_rows(self, hsh, listing_rows):
+        """
+        Reports (and repairs) listing rows in the wrong listing shard.  A
+        row is only moved if the right shard has none; if it has, that one
+        is the row in use and the misplaced one is older.
+
+        :returns: listing_rows with the rows that were moved or deleted
+                  updated, the one in the right shard first
+        """
+        checked = []
+        for account, container, content_type, listing_cont in listing_rows:
+            expected_cont = self.listing_cont(account, hsh)
+            if listing_cont != expected_cont:
+                self._problem('misplaced_row', hsh, account, container,
+                              listing_cont)
+                placed = expected_cont in [row[3] for row in listing_rows +
+                                           checked]
+                if self.repair and placed:
+                    with self.conn_pool.item() as conn:
+                        conn.delete_object(listing_cont, container)
+                    continue
+                if self.repair:
+                    with self.conn_pool.item() as conn:
+                        conn.put_container(expected_cont)
+                        conn.put_object(expected_cont, container, '',
+                                        content_type=content_type)
+                        conn.delete_object(listing_cont, container)
+                    listing_cont = expected_cont
+            checked.append((account, container, content_type, listing_cont))
+        checked.sort(key=lambda row: row[3] != self.listing_cont(row[0], hsh))
+        return checked
+
+    def check(self, hsh, listing_rows, hash_objs):
+        listing_rows = self._check_listing_rows(hsh, listing_rows)
+        expected_cont = self.hash_cont(hsh)
+        located = []
+        placed = expected_cont in [cont for cont, etag in hash_objs]
+        for cont, etag in hash_objs:
+            if cont != expected_cont:
+                self._problem('misplaced', hsh, detail=cont)
+                if self.repair and placed:
+                    # the copy in expected_cont is the one in use, the
+                    # misplaced one is older
+                    with self.conn_pool.item() as conn:
+                        conn.delete_object(cont, hsh)
+                    continue
+                hash_data = self._get_hash_data(cont, hsh)
+                if self.repair and hash_data:
+                    body = hash_data.get_json_str()
+                    with self.conn_pool.item() as conn:
+                        conn.put_object(expected_cont, hsh, body,
+                                        etag=md5(body).hexdigest())
+                        conn.delete_object(cont, hsh)
+                    cont = expected_cont
+                    placed = True
+            located.append((cont != expected_cont, cont, etag))
+        if not located:
+            account, container, content_type, listing_cont = listing_rows[0]
+            self._problem('missing_hash', hsh, account, container)
+            if self.repair:
+                with self.conn_pool.item() as conn:
+                    for row in listing_rows:
+                        try:
+                            conn.delete_object(row[3], row[1])
+                        except ClientException, e:
+                            if e.http_status != 404:
+                                raise
+            return
+        junk, cont, etag = min(located)
+        if not listing_rows:
+            hash_data = self._get_hash_data(cont, hsh)
+            if not hash_data:
+                self._problem('invalid', hsh, detail=cont)
+                return
+            self._problem('orphan_hash', hsh, hash_data.account,
+                          hash_data.container)
+            if self.repair:
+                self._put_listing_row(hsh, hash_data)
+            return
+        account, container, content_type, listing_cont = listing_rows[0]
+        try:
+            cdn_enabled, ttl, logs_enabled = \
+                parse_listing_content_type(content_type)
+            expected = HashData(account, container, ttl, cdn_enabled,
+                                logs_enabled)
+            if md5(expected.get_json_str()).hexdigest() == etag:
+                self.stats['ok'] += 1
+                return
+        except ValueError:
+            expected = None
+        hash_data = self._get_hash_data(cont, hsh)
+        if not hash_data:
+            self._problem('invalid', hsh, account, container, cont)
+            return
+        if expected and (expected.ttl, expected.cdn_enabled,
+                expected.logs_enabled) == (hash_data.ttl,
+                hash_data.cdn_enabled, hash_data.logs_enabled):
+            self.stats['ok'] += 1
+            return
+        self._problem('mismatch', hsh, account, container,
+                      '%s != %s' % (content_type, gen_listing_content_type(
+                          hash_data.cdn_enabled, hash_data.ttl,
+                          hash_data.logs_enabled)))
+        if self.repair:
+            self._put_listing_row(hsh, hash_data)
+
+    def _safe_check(self, *args):
+        try:
+            self.check(*args)
+        except Exception, e:
+            self.stats['errors'] += 1
+            self.logger.exception('Could not check %s: %s' % (args[0], e))
+
+    def run(self):
+        sorter = ExternalSorter(self.run_size, self.tmpdir)
+        try:
+            for hsh, listing_rows, hash_objs in self.join(
+                    self.sorted_listing_rows(sorter),
+                    self.sorted_hash_objects()):
+                self.pool.spawn_n(self._safe_check, hsh, listing_rows,
+                                  hash_objs)
+            self.pool.waitall()
+        finally:
+            sorter.close()
+        return dict(self.stats)
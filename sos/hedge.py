@@ -0,0 +1,116 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Hedged requests, to keep a slow replica from setting the tail latency.
+
+When a request hasn't answered within the percentile-th percentile of the
+recent request times, a second identical one is sent and whichever gives
+a good answer first is used; the other is killed.  Each request earns
+fraction of a hedge, and a hedge is only sent with a whole one to spend,
+so hedges add at most fraction to the backend load.
+"""
+from collections import deque
+from time import time
+
+from eventlet import spawn
+from eventlet.queue import Empty, LightQueue
+
+from sos.metrics import NULL_METRICS
+
+# hedges that can be saved up while requests are fast
+MAX_CREDIT = 10.0
+
+
+class Hedger(object):
+
+    def __init__(self, name, fraction=0.05, percentile=95, min_delay=0.01,
+                 window=1000, metrics=None):
+        self.name = name
+        self.fraction = fraction
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.metrics = metrics or NULL_METRICS
+        self.durations = deque(maxlen=window)
+        self.credit = 1.0
+        # the delay is worked out again every recalc_every requests
+        self.recalc_every = max(1, window // 10)
+        self.since_recalc = 0
+        self.delay = None
+
+    def observe(self, duration):
+        self.durations.append(duration)
+        self.since_recalc += 1
+        if self.delay is None or self.since_recalc >= self.recalc_every:
+            self.since_recalc = 0
+            durations = sorted(self.durations)
+            index = int(len(durations) * self.percentile / 100.0)
+            self.delay = max(self.min_delay,
+                             durations[min(index, len(durations) - 1)])
+
+    def _take_hedge(self):
+        if self.credit >= 1:
+            self.credit -= 1
+            return True
+        return False
+
+    def call(self, func, good=None):
+        """
+        Calls func(), hedging it with a second call if it is slow.
+
+        :param good: function of a result, False if the other call's result
+                     should be waited for instead; exceptions are never good
+        :returns: the first good result, or else the last one
+        :raises: the last exception if neither call gave a result
+        """
+        self.credit = min(MAX_CREDIT, self.credit + self.fraction)
+        results = LightQueue()
+
+        def attempt(index):
+            start = time()
+            try:
+                result = func()
+            except Exception, e:
+                results.put((False, index, e))
+                return
+            self.observe(time() - start)
+            results.put((good is None or good(result), index, result))
+
+        attempts = [spawn(attempt, 0)]
+        try:
+            result = None
+            # nothing is hedged until there is a delay to wait for
+            if self.delay is not None:
+                try:
+                    result = results.get(timeout=self.delay)
+                except Empty:
+                    pass
+                if (result is None or not result[0]) and self._take_hedge():
+                    attempts.append(spawn(attempt, 1))
+            if result is None:
+                result = results.get()
+            pending = len(attempts) - 1
+            while not result[0] and pending:
+                pending -= 1
+                result = results.get()
+        finally:
+            for gt in attempts:
+                gt.kill()
+        ok, index, value = result
+        if len(attempts) > 1:
+            self.metrics.incr('sos_hedged_requests_total',
+                              (self.name, index and 'won' or 'lost'))
+        if isinstance(value, Exception):
+            raise value
+        return value
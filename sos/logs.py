@@ -0,0 +1,367 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Delivers the SOS access logs of containers with log retention turned on
+(X-Log-Retention, HashData.logs_enabled) into the customer's account.
+
+Every input file, typically one proxy's hourly log, is handled by its own
+worker process.  The file is read a line at a time and the access log
+records written by OriginServer._log_request are picked out of it.  The
+hash of each is looked up in the origin db through a bounded LRU cache of
+hash -> HashData, and the records of hashes with logs_enabled are
+appended to a gzip spool file per (account, container, hour), with the
+fields that are only of use inside the cluster (the auth token, the
+transaction id, the proxy side addresses, the sampling weight and the
+phase timings) replaced by '-'.  Only
+max_open_files spool files are kept open: the least recently used is
+closed and appended to as a new gzip member if it gets more records, so
+memory stays bounded however big the input is.  Each spool file is then
+uploaded as
+<account>/<log_delivery_container>/<container>/YYYY/MM/DD/HH/<source>.log.gz
+where source is derived from the host name and the md5 of the input file's
+contents.  Every proxy's file and every rotation of it gets its own
+objects, and delivering the same file again overwrites them instead of
+duplicating them.
+"""
+import gzip
+import os
+import re
+import socket
+from collections import defaultdict, OrderedDict
+from hashlib import md5
+from multiprocessing import Pool
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from sos.origin import HashData, OriginBase
+from sos.utils import ClientException, Connection, split_hsh_obj_path
+
+ACCESS_RECORD_FIELDS = 18
+CLIENT_FIELD = 0
+REMOTE_ADDR_FIELD = 1
+DATE_FIELD = 2
+AUTH_TOKEN_FIELD = 10
+TRANS_ID_FIELD = 12
+HASH_FIELD = 14
+WEIGHT_FIELD = 16
+TIMINGS_FIELD = 17
+# never delivered to the customer
+REDACTED_FIELDS = (REMOTE_ADDR_FIELD, AUTH_TOKEN_FIELD, TRANS_ID_FIELD,
+                   WEIGHT_FIELD, TIMINGS_FIELD)
+PRIVATE_IPV4_RE = re.compile(r'^(10|127|169\.254|172\.(1[6-9]|2\d|3[01])|'
+                             r'192\.168)\.')
+MONTHS = dict((month, '%02d' % (i + 1)) for i, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec')))
+DATE_RE = re.compile(
+    r'^(\d\d)/(\w\w\w)/(\d\d\d\d)/(\d\d)/(\d\d)/(\d\d)$')
+
+
+def parse_access_record(line):
+    """
+    Picks an access log record out of a log line, skipping the syslog
+    prefix in front of it.
+
+    :returns: (record, hsh, hour bucket as YYYY/MM/DD/HH) or None if line
+              is not an access log record of a CDN request
+    """
+    fields = line.split()
+    if len(fields) < ACCESS_RECORD_FIELDS or \
+            'total:' not in fields[-1]:
+        return None
+    fields = fields[-ACCESS_RECORD_FIELDS:]
+    match = DATE_RE.match(fields[DATE_FIELD])
+    hsh = fields[HASH_FIELD]
+    if not match or match.group(2) not in MONTHS or hsh == '-':
+        return None
+    day, month, year, hour = match.groups()[:4]
+    return (' '.join(fields), hsh,
+            '%s/%s/%s/%s' % (year, MONTHS[month], day, hour))
+
+
+def is_internal_address(addr):
+    """
+    :returns: True if addr is a loopback, link local or private address
+    """
+    addr = addr.lower()
+    if ':' in addr:
+        return addr == '::1' or addr.startswith(('fc', 'fd', 'fe80:'))
+    return bool(PRIVATE_IPV4_RE.match(addr))
+
+
+def redact_access_record(record):
+    """
+    :returns: record with the fields the customer shouldn't see replaced
+              by '-'; the client address is kept unless it is internal
+    """
+    fields = record.split(' ')
+    for index in REDACTED_FIELDS:
+        fields[index] = '-'
+    if is_internal_address(fields[CLIENT_FIELD]):
+        fields[CLIENT_FIELD] = '-'
+    return ' '.join(fields)
+
+
+class LRUCache(object):
+    """
+    dict with at most max_size keys, dropping the least recently used.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def set(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.max_size:
+            self.pop_oldest()
+
+    def pop_oldest(self):
+        """
+        :returns: (key, value) of the least recently used key, removed
+        """
+        return self.data.popitem(last=False)
+
+
+class SpoolFiles(object):
+    """
+    gzip files under a temp dir, one per key, at most max_open of them open
+    at once.  A file closed to make room is reopened for appending, which
+    adds another gzip member; gunzip reads them all as one stream.
+    """
+
+    def __init__(self, tmpdir, max_open=100):
+        self.tmpdir = tmpdir
+        self.max_open = max_open
+        self.open_files = LRUCache(max_open)
+        self.paths = {}
+
+    def write(self, key, line):
+        fp = self.open_files.get(key)
+        if fp is None:
+            if len(self.open_files) >= self.max_open:
+                self.open_files.pop_oldest()[1].close()
+            path = self.paths.get(key)
+            if path is None:
+                path = self.paths[key] = os.path.join(self.tmpdir,
+                                                      str(len(self.paths)))
+            fp = gzip.open(path, 'ab')
+            self.open_files.set(key, fp)
+        fp.write(line + '\n')
+
+    def close(self):
+        for fp in self.open_files.data.values():
+            fp.close()
+        self.open_files = LRUCache(self.max_open)
+
+
+class LogSplitter(object):
+    """
+    Splits one access log file into per container, per hour spool files
+    and uploads them.
+
+    :param conn: Connection to the swift cluster, authed as a reseller
+                 admin
+    :param hostname: name of this host in the delivered object names,
+                     defaults to socket.gethostname()
+    """
+
+    def __init__(self, conf, conn, logger, cache_size=100000,
+                 max_open_files=100, tmpdir=None, hostname=None):
+        self.origin = OriginBase(None, conf, logger)
+        self.conn = conn
+        self.logger = logger
+        self.hash_data = LRUCache(cache_size)
+        self.max_open_files = max_open_files
+        self.tmpdir = tmpdir
+        self.hostname = hostname or socket.gethostname()
+        self.log_container = conf.get('log_delivery_container',
+                                      '.CDN_ACCESS_LOGS')
+        self.stats = defaultdict(int)
+
+    def _get_hash_object(self, hsh_obj_path):
+        cont, obj = split_hsh_obj_path(hsh_obj_path)
+        try:
+            return self.conn.get_object(cont, obj)[1]
+        except ClientException, e:
+            if e.http_status != 404:
+                raise
+        return None
+
+    def get_hash_data(self, hsh):
+        """
+        :returns: the HashData of hsh or None if it has none, cached
+        """
+        if hsh in self.hash_data:
+            self.stats['cache_hits'] += 1
+            return self.hash_data.get(hsh)
+        self.stats['lookups'] += 1
+        hash_data = None
+        try:
+            body = self._get_hash_object(self.origin.get_hsh_obj_path(hsh))
+            prev_obj_path = self.origin.get_prev_hsh_obj_path(hsh)
+            if body is None and prev_obj_path:
+                body = self._get_hash_object(prev_obj_path)
+            if body is not None:
+                hash_data = HashData.create_from_json(body)
+        except ValueError, e:
+            self.logger.warning('Invalid cdn data for %s: %s' % (hsh, e))
+        self.hash_data.set(hsh, hash_data)
+        return hash_data
+
+    def split(self, lines, spool):
+        """
+        Writes the records of lines whose hash has logs_enabled into spool.
+        """
+        for line in lines:
+            parsed = parse_access_record(line)
+            if parsed is None:
+                self.stats['skipped'] += 1
+                continue
+            record, hsh, bucket = parsed
+            hash_data = self.get_hash_data(hsh)
+            if hash_data is None or not hash_data.logs_enabled:
+                self.stats['not_enabled'] += 1
+                continue
+            spool.write((hash_data.account.encode('utf-8'),
+                         hash_data.container.encode('utf-8'), bucket),
+                        redact_access_record(record))
+            self.stats['delivered'] += 1
+
+    def upload(self, spool, source):
+        put_containers = set()
+        for (account, container, bucket), path in sorted(
+                spool.paths.items()):
+            log_cont = '%s/%s' % (account, self.log_container)
+            obj = '%s/%s/%s.log.gz' % (container, bucket, source)
+            try:
+                if log_cont not in put_containers:
+                    self.conn.put_container(log_cont)
+                    put_containers.add(log_cont)
+                fp = open(path, 'rb')
+                try:
+                    self.conn.put_object(log_cont, obj, fp,
+                        content_length=os.path.getsize(path),
+                        content_type='application/x-gzip')
+                finally:
+                    fp.close()
+                self.stats['objects'] += 1
+            except ClientException, e:
+                self.stats['errors'] += 1
+                self.logger.error('Could not upload %s/%s: %s' %
+                                  (log_cont, obj, e))
+
+    def deliver(self, log_path):
+        """
+        Splits and uploads log_path, gzipped or not.
+
+        :returns: dict of stats
+        """
+        if log_path.endswith('.gz'):
+            log_file = gzip.open(log_path, 'rb')
+        else:
+            log_file = open(log_path)
+        tmpdir = mkdtemp(dir=self.tmpdir, prefix='sos-logs-')
+        spool = SpoolFiles(tmpdir, self.max_open_files)
+        digest = md5()
+
+        def read_lines():
+            for line in log_file:
+                digest.update(line)
+                yield line
+
+        try:
+            try:
+                self.split(read_lines(), spool)
+            finally:
+                log_file.close()
+                spool.close()
+            source = md5('%s/%s' % (self.hostname,
+                                    digest.hexdigest())).hexdigest()
+            self.upload(spool, source)
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+        self.logger.info('Delivered %s: %s' % (log_path, dict(self.stats)))
+        return dict(self.stats)
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _deliver_file(log_path):
+    conf, swift_url, token, options, logger = _worker_args
+    conn = Connection(None, None, None, preauthurl=swift_url,
+                      preauthtoken=token)
+    try:
+        return LogSplitter(conf, conn, logger, **options).deliver(log_path)
+    except Exception, e:
+        logger.exception('Failed on %s: %s' % (log_path, e))
+        return {'errors': 1}
+
+
+class LogDeliverer(object):
+    """
+    Delivers many log files, workers of them at once in a process pool.
+
+    :param conn_pool: OriginConnectionPool, only used for its url and token
+    """
+
+    def __init__(self, conf, conn_pool, logger, workers=4, **options):
+        self.conf = conf
+        self.conn_pool = conn_pool
+        self.logger = logger
+        self.workers = workers
+        self.options = options
+
+    def run(self, log_paths):
+        args = (self.conf, self.conn_pool.swift_url, self.conn_pool.token,
+                self.options, self.logger)
+        stats = defaultdict(int)
+        if self.workers > 1 and len(log_paths) > 1:
+            # the workers are forked, so args (and the logger) are not
+            # pickled; only the paths and the stats are
+            pool = Pool(min(self.workers, len(log_paths)), _init_worker,
+                        args)
+            try:
+                results = pool.map(_deliver_file, log_paths, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_worker(*args)
+            results = map(_deliver_file, log_paths)
+        for result in results:
+            for key, value in result.items():
+                stats[key] += value
+        return dict(stats)
@@ -0,0 +1,432 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Latency percentiles, top talkers and request rates from SOS access logs.
+
+The records written by OriginServer._log_request are parsed chunk_size
+lines at a time into columns: array.array while parsing, turned into NumPy
+arrays for the aggregation when NumPy is installed.  Each chunk is folded
+into a LogStats of fixed size histograms and counters, so memory does not
+grow with the number of lines, only with the number of distinct hashes,
+accounts and time buckets.  Every count is weighted by the record's
+sampling weight.
+
+Latency percentiles come from histograms with 20 log spaced buckets per
+decade from 0.1ms to 100s, so they are the upper bound of the bucket the
+percentile falls in, at most 12% above the real value.
+
+Log files are split between worker processes; plain files bigger than
+split_size are also split by byte range, gzipped ones can only be read
+whole.  The workers' LogStats are merged at the end.
+"""
+import calendar
+import gzip
+import heapq
+import os
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from multiprocessing import Pool
+from time import gmtime, strftime
+from urllib import unquote
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sos.logs import ACCESS_RECORD_FIELDS, DATE_FIELD, DATE_RE, \
+    HASH_FIELD, MONTHS
+
+HOST_FIELD = 4
+PATH_FIELD = 5
+STATUS_FIELD = 7
+TRANS_TIME_FIELD = 13
+WEIGHT_FIELD = 16
+LATENCY_BOUNDS = tuple(0.0001 * 10 ** (i / 20.0) for i in xrange(121))
+PERCENTILES = (50, 90, 99, 99.9)
+CHUNK_SIZE = 100000
+SPLIT_SIZE = 256 * 1024 * 1024
+
+
+class Classifier(object):
+    """
+    Picks the handler of a logged request from its host and path the way
+    OriginServer does.
+    """
+
+    def __init__(self, conf):
+        self.origin_prefix = conf.get('origin_prefix', '/origin/')
+        self.origin_db_hosts = [host for host in
+            conf.get('origin_db_hosts', '').split(',') if host]
+        self.origin_cdn_host_suffixes = [host for host in
+            conf.get('origin_cdn_host_suffixes', '').split(',') if host]
+
+    def handler(self, host, path):
+        host = host.split(':')[0]
+        handler = 'other'
+        if host in self.origin_db_hosts:
+            handler = 'origin_db'
+        for cdn_host_suffix in self.origin_cdn_host_suffixes:
+            if host.endswith(cdn_host_suffix):
+                handler = 'cdn'
+                break
+        if path.startswith(self.origin_prefix):
+            handler = 'admin'
+        return handler
+
+
+class Columns(object):
+    """
+    One chunk of parsed records.  groups, hash_ids and account_ids index
+    group_keys, hash_keys and account_keys; id 0 is no hash or account.
+    """
+
+    def __init__(self):
+        self.times = array('d')
+        self.latencies = array('d')
+        self.weights = array('d')
+        self.groups = array('i')
+        self.hash_ids = array('i')
+        self.account_ids = array('i')
+        self.group_keys = []
+        self.hash_keys = [None]
+        self.account_keys = [None]
+        self._ids = ({}, {}, {})
+
+    def __len__(self):
+        return len(self.times)
+
+    def _id(self, which, keys, key):
+        ids = self._ids[which]
+        key_id = ids.get(key)
+        if key_id is None:
+            key_id = ids[key] = len(keys)
+            keys.append(key)
+        return key_id
+
+    def add(self, timestamp, latency, weight, group, hsh, account):
+        self.times.append(timestamp)
+        self.latencies.append(latency)
+        self.weights.append(weight)
+        self.groups.append(self._id(0, self.group_keys, group))
+        self.hash_ids.append(hsh and self._id(1, self.hash_keys, hsh) or 0)
+        self.account_ids.append(
+            account and self._id(2, self.account_keys, account) or 0)
+
+
+class LogStats(object):
+    """
+    Weighted request counts and latency histograms, mergeable across
+    chunks and processes.
+    """
+
+    def __init__(self, bucket_seconds=60):
+        self.bucket_seconds = bucket_seconds
+        # (handler, status) -> weighted count per LATENCY_BOUNDS bucket,
+        # the last one is over the last bound
+        self.latencies = {}
+        self.hashes = defaultdict(float)
+        self.accounts = defaultdict(float)
+        self.rates = defaultdict(float)
+        self.records = 0
+        self.skipped = 0
+
+    def _add_latencies(self, group, counts):
+        totals = self.latencies.get(group)
+        if totals is None:
+            totals = self.latencies[group] = [0.0] * (len(LATENCY_BOUNDS) + 1)
+        for i, count in enumerate(counts):
+            totals[i] += count
+
+    def add_chunk(self, cols):
+        self.records += len(cols)
+        if numpy is not None:
+            self._add_chunk_numpy(cols)
+        else:
+            self._add_chunk_python(cols)
+
+    def _add_chunk_numpy(self, cols):
+        weights = numpy.array(cols.weights, dtype=numpy.float64)
+        groups = numpy.array(cols.groups, dtype=numpy.intp)
+        slots = len(LATENCY_BOUNDS) + 1
+        buckets = numpy.searchsorted(numpy.array(LATENCY_BOUNDS),
+            numpy.array(cols.latencies, dtype=numpy.float64))
+        counts = numpy.bincount(groups * slots + buckets, weights=weights,
+            minlength=len(cols.group_keys) * slots)
+        for i, group in enumerate(cols.group_keys):
+            self._add_latencies(group,
+                                counts[i * slots:(i + 1) * slots].tolist())
+        for ids, keys, totals in (
+                (cols.hash_ids, cols.hash_keys, self.hashes),
+                (cols.account_ids, cols.account_keys, self.accounts)):
+            counts = numpy.bincount(numpy.array(ids, dtype=numpy.intp),
+                                    weights=weights, minlength=len(keys))
+            for key_id in numpy.nonzero(counts[1:])[0] + 1:
+                totals[keys[key_id]] += float(counts[key_id])
+        starts = (numpy.array(cols.times, dtype=numpy.float64) //
+                  self.bucket_seconds).astype(numpy.int64)
+        starts, inverse = numpy.unique(starts, return_inverse=True)
+        counts = numpy.bincount(inverse, weights=weights)
+        for start, count in zip(starts.tolist(), counts.tolist()):
+            self.rates[start * self.bucket_seconds] += count
+
+    def _add_chunk_python(self, cols):
+        slots = len(LATENCY_BOUNDS) + 1
+        counts = [[0.0] * slots for group in cols.group_keys]
+        for group, latency, weight in zip(cols.groups, cols.latencies,
+                                          cols.weights):
+            counts[group][bisect_left(LATENCY_BOUNDS, latency)] += weight
+        for group, group_counts in zip(cols.group_keys, counts):
+            self._add_latencies(group, group_counts)
+        for ids, keys, totals in (
+                (cols.hash_ids, cols.hash_keys, self.hashes),
+                (cols.account_ids, cols.account_keys, self.accounts)):
+            for key_id, weight in zip(ids, cols.weights):
+                if key_id:
+                    totals[keys[key_id]] += weight
+        for timestamp, weight in zip(cols.times, cols.weights):
+            self.rates[int(timestamp // self.bucket_seconds) *
+                       self.bucket_seconds] += weight
+
+    def merge(self, other):
+        for group, counts in other.latencies.items():
+            self._add_latencies(group, counts)
+        for totals, other_totals in ((self.hashes, other.hashes),
+                                     (self.accounts, other.accounts),
+                                     (self.rates, other.rates)):
+            for key, count in other_totals.items():
+                totals[key] += count
+        self.records += other.records
+        self.skipped += other.skipped
+
+    def latency_counts(self, handler=None, status=None):
+        """
+        :returns: the latency histogram of handler and status summed over
+                  the ones that are None
+        """
+        totals = [0.0] * (len(LATENCY_BOUNDS) + 1)
+        for (group_handler, group_status), counts in self.latencies.items():
+            if handler not in (None, group_handler) or \
+                    status not in (None, group_status):
+                continue
+            for i, count in enumerate(counts):
+                totals[i] += count
+        return totals
+
+
+def percentile(counts, pct):
+    """
+    :returns: upper bound in seconds of the bucket of counts that pct
+              percent of the weight falls in, None if counts is empty
+              and inf if it is past the last bound
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    wanted = total * pct / 100.0
+    seen = 0.0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= wanted and count:
+            break
+    if i < len(LATENCY_BOUNDS):
+        return LATENCY_BOUNDS[i]
+    return float('inf')
+
+
+def top(counts, k):
+    """
+    :returns: list of (count, key) of the k keys with the highest count
+    """
+    return heapq.nlargest(k, ((count, key) for key, count in
+                              counts.iteritems()))
+
+
+def parse_record(line, classifier):
+    """
+    :returns: (timestamp, latency, weight, (handler, status), hsh, account)
+              of an access log record or None if line isn't one
+    """
+    fields = line.split()
+    if len(fields) < ACCESS_RECORD_FIELDS or 'total:' not in fields[-1]:
+        return None
+    fields = fields[-ACCESS_RECORD_FIELDS:]
+    match = DATE_RE.match(fields[DATE_FIELD])
+    if not match or match.group(2) not in MONTHS:
+        return None
+    day, month, year, hour, minute, second = match.groups()
+    try:
+        timestamp = calendar.timegm((int(year), int(MONTHS[month]), int(day),
+                                     int(hour), int(minute), int(second)))
+        latency = float(fields[TRANS_TIME_FIELD])
+        weight = float(fields[WEIGHT_FIELD])
+        status = int(fields[STATUS_FIELD])
+    except ValueError:
+        return None
+    path = unquote(fields[PATH_FIELD]).split('?', 1)[0]
+    handler = classifier.handler(unquote(fields[HOST_FIELD]), path)
+    hsh = fields[HASH_FIELD]
+    if hsh == '-':
+        hsh = None
+    account = None
+    if handler == 'origin_db':
+        parts = path.split('/')
+        if len(parts) > 2 and parts[2]:
+            account = parts[2]
+    return timestamp, latency, weight, (handler, status), hsh, account
+
+
+def iter_lines(path, start=0, end=None):
+    """
+    Yields the lines of path that start in the byte range [start, end).
+    """
+    if path.endswith('.gz'):
+        fp = gzip.open(path, 'rb')
+    else:
+        fp = open(path)
+    try:
+        if start:
+            # the line running over start belongs to the previous range
+            fp.seek(start - 1)
+            fp.readline()
+        while end is None or fp.tell() < end:
+            line = fp.readline()
+            if not line:
+                return
+            yield line
+    finally:
+        fp.close()
+
+
+def stats_for_lines(lines, classifier, bucket_seconds=60,
+                    chunk_size=CHUNK_SIZE):
+    """
+    :returns: LogStats of lines
+    """
+    stats = LogStats(bucket_seconds)
+    cols = Columns()
+    for line in lines:
+        record = parse_record(line, classifier)
+        if record is None:
+            stats.skipped += 1
+            continue
+        cols.add(*record)
+        if len(cols) >= chunk_size:
+            stats.add_chunk(cols)
+            cols = Columns()
+    if len(cols):
+        stats.add_chunk(cols)
+    return stats
+
+
+def split_jobs(paths, split_size=SPLIT_SIZE):
+    """
+    :returns: list of (path, start, end) byte ranges to read; gzipped
+              files can't be seeked so are always whole
+    """
+    jobs = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if path.endswith('.gz') or size <= split_size:
+            jobs.append((path, 0, None))
+            continue
+        for start in xrange(0, size, split_size):
+            jobs.append((path, start, start + split_size))
+    return jobs
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _stats_job(job):
+    conf, bucket_seconds, chunk_size = _worker_args
+    path, start, end = job
+    return stats_for_lines(iter_lines(path, start, end), Classifier(conf),
+                           bucket_seconds, chunk_size)
+
+
+def collect_stats(conf, paths, workers=None, bucket_seconds=60,
+                  chunk_size=CHUNK_SIZE, split_size=SPLIT_SIZE):
+    """
+    :param workers: number of processes, defaults to the number of cpus
+    :returns: LogStats of every line of paths
+    """
+    jobs = split_jobs(paths, split_size)
+    args = (conf, bucket_seconds, chunk_size)
+    stats = LogStats(bucket_seconds)
+    if workers is None:
+        workers = os.sysconf('SC_NPROCESSORS_ONLN')
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(min(workers, len(jobs)), _init_worker, args)
+        try:
+            results = pool.imap_unordered(_stats_job, jobs)
+            for result in results:
+                stats.merge(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*args)
+        for job in jobs:
+            stats.merge(_stats_job(job))
+    return stats
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return '>%.0fs' % LATENCY_BOUNDS[-1]
+    if seconds < 1:
+        return '%.1fms' % (seconds * 1000)
+    return '%.2fs' % seconds
+
+
+def format_report(stats, k=10, hash_names=None):
+    """
+    :param hash_names: optional dict of hsh -> account/container to show
+                       next to the top hashes
+    :returns: str report of stats
+    """
+    lines = ['%d records, %d other lines' % (stats.records, stats.skipped),
+             '', 'Latency (%s)' % ', '.join('p%g' % pct
+                                            for pct in PERCENTILES)]
+    groups = sorted(set((handler, None) for handler, status in
+                        stats.latencies)) + sorted(stats.latencies)
+    for handler, status in groups:
+        counts = stats.latency_counts(handler, status)
+        lines.append('  %-10s %-4s %10d  %s' % (handler, status or 'all',
+            sum(counts), '  '.join(_format_seconds(percentile(counts, pct))
+                                   for pct in PERCENTILES)))
+    lines.extend(['', 'Top hashes'])
+    for count, hsh in top(stats.hashes, k):
+        lines.append('  %10d  %s %s' % (count, hsh,
+                                        (hash_names or {}).get(hsh, '')))
+    lines.extend(['', 'Top accounts'])
+    for count, account in top(stats.accounts, k):
+        lines.append('  %10d  %s' % (count, account))
+    lines.extend(['', 'Requests per second every %ds' %
+                  stats.bucket_seconds])
+    for start in sorted(stats.rates):
+        lines.append('  %s  %.2f' % (
+            strftime('%Y-%m-%d %H:%M:%S', gmtime(start)),
+            stats.rates[start] / stats.bucket_seconds))
+    return '\n'.join(line.rstrip() for line in lines) + '\n'
@@ -0,0 +1,345 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Counters and latency histograms for SOS.
+
+Every proxy worker process keeps its own Metrics, aggregated in place in
+dicts of ints keyed by (name, label values) so recording a sample does not
+build anything but that key.  The totals are served in the Prometheus text
+format by GET <origin_prefix>.stats and every sample can also be passed on
+to emitters such as StatsdEmitter.
+
+With a WorkerStats each worker also writes its metrics and hottest hashes
+to a file of its own every few seconds, and the worker answering a scrape
+adds up those of all the live workers, like prometheus_client's
+multiprocess mode.
+"""
+import errno
+import os
+import socket
+from bisect import bisect_left
+
+from eventlet import sleep, spawn_n
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# name -> label names
+COUNTERS = {
+    'sos_requests_total': ('handler', 'status'),
+    'sos_cdn_data_cache_total': ('result',),
+    'sos_streamed_bytes_total': (),
+    'sos_oversized_rejected_total': (),
+    'sos_access_log_dropped_total': (),
+    'sos_ratelimited_total': ('kind',),
+    'sos_shed_total': ('handler',),
+    'sos_breaker_transitions_total': ('breaker', 'state'),
+    'sos_hedged_requests_total': ('name', 'result'),
+    'sos_collapsed_requests_total': ('result',),
+    'sos_object_cache_total': ('result',),
+    'sos_block_cache_total': ('result',),
+}
+HISTOGRAMS = {
+    'sos_subrequest_seconds': ('phase',),
+}
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+HELP = {
+    'sos_requests_total': 'Requests handled by SOS',
+    'sos_cdn_data_cache_total': 'get_cdn_data memcache lookups by result',
+    'sos_streamed_bytes_total': 'Object bytes streamed to the CDN',
+    'sos_oversized_rejected_total': 'CDN requests for objects over '
+                                    'max_cdn_file_size',
+    'sos_subrequest_seconds': 'Subrequests to Swift by phase',
+    'sos_access_log_dropped_total': 'Access log records dropped because '
+                                    'the buffer was full',
+    'sos_ratelimited_total': 'CDN requests turned away by the hash or '
+                             'account rate limit',
+    'sos_shed_total': 'Requests turned away because their handler was at '
+                      'its concurrency limit',
+    'sos_breaker_transitions_total': 'Circuit breaker state changes',
+    'sos_hedged_requests_total': 'Hedged requests by whether the hedge '
+                                 'answered first',
+    'sos_collapsed_requests_total': 'CDN GETs that made a shared swift GET, '
+                                    'joined one or fell behind one',
+    'sos_object_cache_total': 'CDN object cache lookups and objects stored',
+    'sos_block_cache_total': 'Blocks of Range requests read from the '
+                             'block cache or GETted for it',
+}
+
+
+class NullMetrics(object):
+    """
+    Drops everything; used when no Metrics is given.
+    """
+
+    def incr(self, name, labels=(), value=1):
+        pass
+
+    def observe(self, name, seconds, labels=()):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Metrics(object):
+    """
+    Process wide counters and histograms.
+
+    :param emitters: objects with the incr and observe methods of this
+                     class, each sample is passed to all of them
+    """
+
+    def __init__(self, emitters=(), buckets=LATENCY_BUCKETS):
+        self.emitters = list(emitters)
+        self.buckets = buckets
+        self.counters = {}
+        # (name, labels) -> counts per bucket, the last one is +Inf
+        self.histograms = {}
+        self.histogram_sums = {}
+
+    def incr(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+        for emitter in self.emitters:
+            emitter.incr(name, labels, value)
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        counts = self.histograms.get(key)
+        if counts is None:
+            counts = self.histograms[key] = [0] * (len(self.buckets) + 1)
+            self.histogram_sums[key] = 0.0
+        counts[bisect_left(self.buckets, seconds)] += 1
+        self.histogram_sums[key] += seconds
+        for emitter in self.emitters:
+            emitter.observe(name, seconds, labels)
+
+    def snapshot(self):
+        """
+        :returns: the counters and histograms as a JSON serializable dict
+        """
+        return {'counters': [[name, list(labels), value] for
+                             (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), counts,
+                                self.histogram_sums[(name, labels)]]
+                               for (name, labels), counts in
+                               self.histograms.items()]}
+
+    def merge(self, snapshot):
+        """
+        Adds the counts of a snapshot of another Metrics to these, without
+        passing them on to the emitters.
+        """
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+        for name, labels, counts, total in snapshot['histograms']:
+            key = (name, tuple(labels))
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(self.buckets) + 1)
+                self.histogram_sums[key] = 0.0
+            for i, count in enumerate(counts):
+                self.histograms[key][i] += count
+            self.histogram_sums[key] += total
+
+    def _labels(self, names, values, extra=(), per_process=True):
+        pairs = zip(names, values) + list(extra)
+        if per_process:
+            pairs.append(('pid', os.getpid()))
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace(
+            '\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+    def prometheus(self, per_process=True):
+        """
+        :param per_process: False for metrics merged from every worker
+        :returns: str of all the metrics in the Prometheus text format.
+                  Unless per_process is False every series has a pid label
+                  as each worker process counts on its own.
+        """
+        lines = []
+        for name in sorted(COUNTERS):
+            lines.append('# HELP %s %s' % (name, HELP[name]))
+            lines.append('# TYPE %s counter' % name)
+            for (key_name, values), value in sorted(self.counters.items()):
+                if key_name == name:
+                    lines.append('%s%s %d' % (name, self._labels(
+                        COUNTERS[name], values, per_process=per_process),
+                        value))
+        for name in sorted(HISTOGRAMS):
+            lines.append('# HELP %s %s' % (name, HELP[name]))
+            lines.append('# TYPE %s histogram' % name)
+            for (key_name, values), counts in sorted(self.histograms.items()):
+                if key_name != name:
+                    continue
+                label_names = HISTOGRAMS[name]
+                total = 0
+                for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (name, self._labels(
+                        label_names, values, [('le', bucket)], per_process),
+                        total))
+                lines.append('%s_sum%s %.6f' % (name, self._labels(
+                    label_names, values, per_process=per_process),
+                    self.histogram_sums[(name, values)]))
+                lines.append('%s_count%s %d' % (name, self._labels(
+                    label_names, values, per_process=per_process), total))
+        return '\n'.join(lines) + '\n'
+
+
+class WorkerStats(object):
+    """
+    The metrics and hot hashes of every worker process of a proxy, shared
+    through a <pid>.json file per worker in path.  Each worker rewrites its
+    file every interval seconds, so the others' counts are up to that old;
+    the files of workers that are gone are removed.
+    """
+
+    def __init__(self, path, metrics, hot_hashes=None, interval=10):
+        self.path = path
+        self.metrics = metrics
+        self.hot_hashes = hot_hashes
+        self.interval = interval
+        self.pid = None
+
+    def start(self):
+        """
+        Starts writing this process's file, once per process.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self.dump()
+            except (IOError, OSError):
+                pass
+            sleep(self.interval)
+
+    def dump(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = os.path.join(self.path, '%d.json' % os.getpid())
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as fp:
+            json.dump({'metrics': self.metrics.snapshot(),
+                       'hot': self.hot_hashes and self.hot_hashes.top() or
+                              []}, fp)
+        os.rename(tmp_path, path)
+
+    def collect(self):
+        """
+        :returns: list of the stats of every live worker, this one's fresh
+        """
+        self.dump()
+        stats = []
+        for name in os.listdir(self.path):
+            pid, ext = os.path.splitext(name)
+            if ext != '.json' or not pid.isdigit():
+                continue
+            path = os.path.join(self.path, name)
+            if not pid_alive(int(pid)):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as fp:
+                    stats.append(json.load(fp))
+            except (IOError, ValueError):
+                pass
+        return stats
+
+    def prometheus(self):
+        """
+        :returns: the metrics of every worker added up, in the Prometheus
+                  text format
+        """
+        merged = Metrics(buckets=self.metrics.buckets)
+        for stats in self.collect():
+            merged.merge(stats['metrics'])
+        return merged.prometheus(per_process=False)
+
+    def hot(self, limit=None):
+        """
+        :returns: list of (hsh, requests per second) of the hottest hashes
+                  of every worker, their rates added up
+        """
+        rates = {}
+        for stats in self.collect():
+            for hsh, rate in stats['hot']:
+                rates[hsh] = rates.get(hsh, 0) + rate
+        hottest = sorted(rates.iteritems(), key=lambda item: -item[1])
+        return hottest[:limit or self.hot_hashes.top_k]
+
+
+class StatsdEmitter(object):
+    """
+    Sends every sample to a StatsD server over UDP as
+    <prefix>.<name>.<label values>, counters as |c and histogram samples
+    as |ms timers.  Send errors are ignored.
+    """
+
+    def __init__(self, host, port=8125, prefix='sos'):
+        self.addr = (host, int(port))
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _metric_name(self, name, labels):
+        if name.startswith('sos_'):
+            name = name[4:]
+        return '.'.join((self.prefix, name) + tuple(
+            str(label).replace('.', '_') for label in labels))
+
+    def _send(self, data):
+        try:
+            self.sock.sendto(data, self.addr)
+        except (IOError, socket.error):
+            pass
+
+    def incr(self, name, labels=(), value=1):
+        self._send('%s:%d|c' % (self._metric_name(name, labels), value))
+
+    def observe(self, name, seconds, labels=()):
+        self._send('%s:%.3f|ms' % (self._metric_name(name, labels),
+                                   seconds * 1000))
+
+
+def metrics_from_conf(conf):
+    """
+    :returns: a Metrics sending to StatsD if statsd_host is set in conf
+    """
+    emitters = []
+    if conf.get('statsd_host'):
+        emitters.append(StatsdEmitter(conf['statsd_host'],
+                                      conf.get('statsd_port', 8125),
+                                      conf.get('statsd_prefix', 'sos')))
+    return Metrics(emitters)
@@ -0,0 +1,196 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Migrates an origin db written by SOS versions before 1.0.6 to the current
+metadata and hash formats.  Before 1.0.6 the hash of a container was taken
+from its quoted account and container names and the .hash_N objects could
+hold loosely typed json.  The migration runs in two passes:
+
+1. every object in the .hash_N containers is read, rewritten as current
+   HashData json at the location given by hash_path and get_hsh_obj_path,
+   and the old object is removed if it lived somewhere else.
+2. every row of every account listing container is checked and a .hash_N
+   object is created from the row's Content-Type if one is still missing.
+
+Both passes are idempotent and checkpoint the listing marker of each
+container after every page, so an interrupted run can just be restarted.
+"""
+from hashlib import md5
+from urllib import quote, unquote
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from swift.common.utils import TRUE_VALUES
+
+from sos.origin import HashData, OriginBase, InvalidUtf8, \
+    parse_listing_content_type, split_listing_cont
+from sos.utils import ClientException, ContainerWalker, \
+    iter_origin_containers, split_container_path, split_hsh_obj_path
+
+
+def _true(value):
+    if isinstance(value, basestring):
+        return value.lower() in TRUE_VALUES
+    return bool(value)
+
+
+class Migrator(ContainerWalker):
+
+    def __init__(self, conf, conn_pool, checkpoint, logger, concurrency=10,
+                 container_concurrency=4, dry_run=False):
+        ContainerWalker.__init__(self, conn_pool, checkpoint, logger,
+                                 concurrency, container_concurrency)
+        self.origin = OriginBase(None, conf, logger)
+        self.default_ttl = int(conf.get('default_ttl', 259200))
+        self.dry_run = dry_run
+
+    def legacy_hash_path(self, account, container):
+        """
+        The pre 1.0.6 hash: made from the quoted account and container.
+        """
+        return md5('/%s/%s/%s' % (quote(account), quote(container),
+                                  self.origin.hash_suffix)).hexdigest()
+
+    def parse_legacy(self, body, obj_name):
+        """
+        Builds a HashData from the json of a .hash_N object in either the
+        current or an older format.  Older versions stored quoted names and
+        hashed the quoted names, which can't be told apart from a current
+        object whose names contain %xx escapes.  So an object only counts as
+        current if its json is exactly what HashData writes today.
+
+        :raises: ValueError if body can't be understood
+        """
+        try:
+            data = json.loads(body)
+            account = data['account']
+            container = data['container']
+            if isinstance(account, unicode):
+                account = account.encode('utf-8')
+            if isinstance(container, unicode):
+                container = container.encode('utf-8')
+            ttl = int(data.get('ttl', self.default_ttl))
+            cdn_enabled = _true(data.get('cdn_enabled', True))
+            logs_enabled = _true(data.get('logs_enabled', False))
+        except (KeyError, ValueError, TypeError, AttributeError), e:
+            raise ValueError('Problem loading json: %s: %r' % (e, body))
+        try:
+            current = HashData.create_from_json(body)
+            if obj_name == self.origin.hash_path(account, container) and \
+                    data == json.loads(current.get_json_str()):
+                return current
+        except (ValueError, InvalidUtf8):
+            pass
+        unquoted = (unquote(account), unquote(container))
+        for (acc, cont), hash_path in (
+                (unquoted, self.legacy_hash_path),
+                ((account, container), self.legacy_hash_path),
+                ((account, container), self.origin.hash_path)):
+            if obj_name == hash_path(acc, cont):
+                break
+        else:
+            acc, cont = unquoted
+        try:
+            return HashData(acc, cont, ttl, cdn_enabled, logs_enabled)
+        except InvalidUtf8:
+            raise ValueError('Invalid UTF8: %r' % body)
+
+    def put_hash_data(self, hash_data):
+        """
+        Writes hash_data to where the current hash_path puts it, unless an
+        identical object is already there.
+
+        :returns: (container, object) written to
+        """
+        hsh = self.origin.hash_path(hash_data.account.encode('utf-8'),
+                                    hash_data.container.encode('utf-8'))
+        cont, obj = split_hsh_obj_path(self.origin.get_hsh_obj_path(hsh))
+        body = hash_data.get_json_str()
+        etag = md5(body).hexdigest()
+        with self.conn_pool.item() as conn:
+            try:
+                headers = conn.head_object(cont, obj)
+                if headers.get('etag', '').strip('"') == etag:
+                    self.stats['unchanged'] += 1
+                    return cont, obj
+            except ClientException, e:
+                if e.http_status != 404:
+                    raise
+            if not self.dry_run:
+                conn.put_object(cont, obj, body, etag=etag)
+        self.stats['written'] += 1
+        return cont, obj
+
+    def delete_hash_obj(self, cont, obj):
+        if not self.dry_run:
+            with self.conn_pool.item() as conn:
+                try:
+                    conn.delete_object(cont, obj)
+                except ClientException, e:
+                    if e.http_status != 404:
+                        raise
+        self.stats['deleted'] += 1
+
+    def migrate_hash_obj(self, cont, row):
+        obj = row['name']
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        with self.conn_pool.item() as conn:
+            body = conn.get_object(cont, obj)[1]
+        hash_data = self.parse_legacy(body, obj)
+        self.stats['hash_objects'] += 1
+        hsh = self.origin.hash_path(hash_data.account.encode('utf-8'),
+                                    hash_data.container.encode('utf-8'))
+        if hsh == obj and body == hash_data.get_json_str() and \
+                self.origin.get_hsh_obj_path(hsh).endswith(
+                    '/%s/%s' % (cont, obj)):
+            self.stats['unchanged'] += 1
+            return
+        if (cont, obj) != self.put_hash_data(hash_data):
+            self.delete_hash_obj(cont, obj)
+
+    def migrate_listing_row(self, listing_cont, row):
+        account = split_listing_cont(split_container_path(listing_cont)[1])
+        container = row['name']
+        if isinstance(container, unicode):
+            container = container.encode('utf-8')
+        cdn_enabled, ttl, logs_enabled = \
+            parse_listing_content_type(row['content_type'])
+        self.stats['listing_rows'] += 1
+        hsh = self.origin.hash_path(account, container)
+        cont, obj = split_hsh_obj_path(self.origin.get_hsh_obj_path(hsh))
+        with self.conn_pool.item() as conn:
+            try:
+                conn.head_object(cont, obj)
+                return
+            except ClientException, e:
+                if e.http_status != 404:
+                    raise
+        self.put_hash_data(HashData(account, container, ttl, cdn_enabled,
+                                    logs_enabled))
+
+    def listing_containers(self):
+        for path in iter_origin_containers(self.conn_pool,
+                self.origin.all_origin_accounts()):
+            if split_listing_cont(split_container_path(path)[1]) is not None:
+                yield path
+
+    def run(self):
+        self.walk_all(self.origin.hash_container_paths(),
+                      self.migrate_hash_obj)
+        self.walk_all(self.listing_containers(), self.migrate_listing_row)
+        return dict(self.stats)
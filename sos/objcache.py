@@ -0,0 +1,155 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In memory cache of the bodies of small, hot CDN objects.
+
+Objects are keyed by path and etag, so a lookup needs the etag swift has
+now and an overwritten object is never served from its old copy.  Only
+the latest copy of a path is kept.  Objects are kept for the ttl of their
+container, at most max_ttl seconds, in LRU order within max_bytes.  Admission is TinyLFU: every lookup of a
+path is counted in a count-min sketch that is halved now and then to age
+it, and when the cache is full an object only goes in if its path was
+looked up more often than those it would push out.  A few requests for
+something cold then can't flush the hot objects.
+"""
+from collections import OrderedDict
+from time import time
+
+from sos.sketch import CountMinSketch
+
+
+class CachedObject(object):
+
+    def __init__(self, body, etag, headers, expires):
+        self.body = body
+        self.etag = etag
+        # (name, value) of the response headers to send with it
+        self.headers = headers
+        self.expires = expires
+
+
+class ObjectCache(object):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_object_size=65536,
+                 max_ttl=300, width=8192, depth=4):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.max_ttl = max_ttl
+        # (path, etag) -> ((account, container), CachedObject)
+        self.entries = OrderedDict()
+        # path -> etag of the copy cached
+        self.etags = {}
+        # (account, container) -> set of the keys cached for it
+        self.containers = {}
+        self.size = 0
+        self.sketch = CountMinSketch(width, depth)
+        self.lookups = 0
+        self.reset_every = width * 10
+
+    def _record(self, path):
+        self.sketch.add(path)
+        self.lookups += 1
+        if self.lookups >= self.reset_every:
+            self.sketch.scale(0.5)
+            self.lookups = 0
+
+    def etag(self, path):
+        """
+        :returns: the etag of the copy of path cached, or None
+        """
+        return self.etags.get(path)
+
+    def get(self, path, etag, now=None):
+        """
+        :param etag: the etag path has in swift now, or None if it is not
+                     known
+        :returns: the unexpired CachedObject of path with etag, or None
+        """
+        self._record(path)
+        if etag is None:
+            return None
+        if self.etags.get(path, etag) != etag:
+            # overwritten since it was cached
+            self.forget(path)
+            return None
+        key = (path, etag)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[1].expires <= (now or time()):
+            self._forget(key, entry)
+            return None
+        self.entries[key] = entry
+        return entry[1]
+
+    def forget(self, path):
+        """
+        Drops the copy of path.
+        """
+        key = (path, self.etags.get(path))
+        entry = self.entries.pop(key, None)
+        if entry:
+            self._forget(key, entry)
+
+    def _forget(self, key, entry):
+        self.size -= len(entry[1].body)
+        if self.etags.get(key[0]) == key[1]:
+            del self.etags[key[0]]
+        keys = self.containers.get(entry[0])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self.containers[entry[0]]
+
+    def put(self, account, container, path, obj, ttl, now=None):
+        """
+        Caches obj for path for ttl seconds, unless the cache is full of
+        objects looked up more often.
+
+        :returns: True if obj was cached
+        """
+        size = len(obj.body)
+        if size > self.max_object_size or size > self.max_bytes:
+            return False
+        obj.expires = (now or time()) + min(ttl, self.max_ttl)
+        self.forget(path)
+        frequency = self.sketch.estimate(path)
+        victims = []
+        freed = 0
+        for victim in self.entries:
+            if self.size - freed + size <= self.max_bytes:
+                break
+            if self.sketch.estimate(victim[0]) >= frequency:
+                return False
+            victims.append(victim)
+            freed += len(self.entries[victim][1].body)
+        for victim in victims:
+            self._forget(victim, self.entries.pop(victim))
+        key = (path, obj.etag)
+        self.entries[key] = ((account, container), obj)
+        self.etags[path] = obj.etag
+        self.containers.setdefault((account, container), set()).add(key)
+        self.size += size
+        return True
+
+    def invalidate(self, account, container):
+        """
+        Drops the objects of a container.
+        """
+        for key in list(self.containers.get((account, container), ())):
+            entry = self.entries.pop(key, None)
+            if entry:
+                self._forget(key, entry)
+        self.containers.pop((account, container), None)
@@ -17,26 +17,65 @@ from webob import Response, Request
 from webob.exc import HTTPBadRequest, HTTPForbidden, HTTPNotFound, \
     HTTPNoContent, HTTPAccepted, HTTPCreated, HTTPMethodNotAllowed, \
     HTTPRequestRangeNotSatisfiable, HTTPInternalServerError, \
-    HTTPPreconditionFailed, HTTPNotModified, HTTPMovedPermanently
+    HTTPPreconditionFailed, HTTPNotModified, HTTPMovedPermanently, \
+    HTTPServiceUnavailable
 from urllib import unquote, quote
 from urlparse import urlparse
 from hashlib import md5, sha1
+from collections import deque
+import heapq
 import hmac
+import os
 import re
+from random import random
+import sqlite3
+import struct
+from uuid import uuid4
+
+from eventlet import GreenPile, GreenPool, Timeout, sleep, spawn_n, tpool
+from eventlet.semaphore import Semaphore
 
 from swift.common import utils
 from swift.common.utils import get_logger, get_param, TRUE_VALUES, readconf
 from swift.common.constraints import check_utf8
 from swift.common.wsgi import make_pre_authed_request
+
+from sos.blockcache import BlockCache
+from sos.breaker import CircuitBreaker
+from sos.collapse import Collapser
+from sos.concurrency import ReleasingIter, limits_from_conf
+from sos.hedge import Hedger
+from sos.metrics import NULL_METRICS, WorkerStats, metrics_from_conf
+from sos.objcache import CachedObject, ObjectCache
+from sos.ratelimit import RateLimiter, retry_after
+from sos.sketch import HotHashes
 try:
     import simplejson as json
 except ImportError:
     import json
+try:
+    from monotonic import monotonic
+except ImportError:
+    monotonic = time
 
 CACHE_BAD_URL = 86400
 CACHE_404 = 30
 SWIFT_FETCH_SIZE = 100 * 1024
 MEMCACHE_TIMEOUT = 3600
+# compact memcache encoding of HashData: version, flags, ttl, len(account)
+HASH_DATA_VERSION = 1
+HASH_DATA_HEADER = struct.Struct('!BBqH')
+HASH_DATA_CDN_ENABLED = 0x1
+HASH_DATA_LOGS_ENABLED = 0x2
+# listing shard containers are named .listing_<shard>_<account>
+LISTING_SHARD_PREFIX = '.listing_'
+LISTING_PAGE_SIZE = 10000
+EXPORT_CHECKPOINT_ROWS = 1000
+# seconds over which the request rate is measured for access_log_target_rate
+ACCESS_LOG_SAMPLE_WINDOW = 1.0
+BULK_RESULTS = ('deleted', 'not_found', 'updated', 'unchanged', 'failed')
+LISTING_CONTENT_TYPES = {'xml': 'application/xml',
+                         'json': 'application/json'}
 
 
 class InvalidContentType(Exception):
@@ -51,6 +90,14 @@ class OriginDbFailure(Exception):
     pass
 
 
+class MetadataUnavailable(OriginDbFailure):
+    pass
+
+
+class CorruptHashData(OriginDbFailure):
+    pass
+
+
 class OriginDbNotFound(Exception):
     pass
 
@@ -116,10 +163,219 @@ def split_path(path, minsegs=1, maxsegs=None, rest_with_last=False):
     return segs
 
 
+def parse_listing_content_type(content_type):
+    """
+    Parses the x-cdn/<cdn_enabled>-<ttl>-<log_retention> Content-Type of a
+    row in an origin db listing container.
+
+    :returns: tuple of (cdn_enabled, ttl, logs_enabled)
+    :raises: ValueError if content_type is not in that format
+    """
+    if not content_type.startswith('x-cdn/'):
+        raise ValueError('Invalid Content-Type: %s' % content_type)
+    cdn_enabled, ttl, log_ret = content_type[len('x-cdn/'):].split('-')
+    return (cdn_enabled.lower() in TRUE_VALUES, int(ttl),
+            log_ret.lower() in TRUE_VALUES)
+
+
+def gen_listing_content_type(cdn_enabled, ttl, logs_enabled):
+    """
+    The inverse of parse_listing_content_type.
+    """
+    return 'x-cdn/%(cdn_enabled)s-%(ttl)d-%(log_ret)s' % {
+        'cdn_enabled': cdn_enabled, 'ttl': ttl, 'log_ret': logs_enabled}
+
+
+def mod_placement(hsh, num_containers):
+    """
+    The original placement of cdn hashes: the hash modulo the number of
+    .hash containers.  Changing num_containers moves almost every hash.
+    """
+    return int(hsh, 16) % num_containers
+
+
+def jump_placement(hsh, num_containers):
+    """
+    Jump consistent hash (Lamping and Veach) of the low 64 bits of the hash.
+    Growing from n to m containers only moves (m - n) / m of the hashes.
+    """
+    key = int(hsh, 16) & 0xffffffffffffffff
+    bucket, j = -1, 0
+    while j < num_containers:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+HASH_PLACEMENTS = {'mod': mod_placement, 'jump': jump_placement}
+
+
+def split_listing_cont(name):
+    """
+    :returns: the account whose listing is (or is a shard of) the origin
+              account container name, or None for other containers such
+              as the .hash containers.
+    """
+    if name.startswith('.hash_'):
+        return None
+    if name.startswith(LISTING_SHARD_PREFIX):
+        shard, sep, account = name[len(LISTING_SHARD_PREFIX):].partition('_')
+        if not sep or not shard.isdigit():
+            return None
+        return account
+    return name
+
+
+def add_timing(env, phase, start):
+    """
+    Adds the time since start, a monotonic() value, to phase in the
+    request's timings.
+
+    :returns: the time added
+    """
+    elapsed = monotonic() - start
+    env.setdefault('sos.timings', []).append((phase, elapsed))
+    return elapsed
+
+
+def format_timings(timings, total):
+    """
+    :param timings: the request's sos.timings
+    :param total: the time the request took
+    :returns: str of the time spent in each phase of the request, in the
+              order they were first entered, then the time left for SOS
+              itself and the total, e.g.
+              memcache:0.0002,metadata:0.0051,sos:0.0010,total:0.0063
+    """
+    phases = []
+    totals = {}
+    for phase, elapsed in timings:
+        if phase not in totals:
+            phases.append(phase)
+            totals[phase] = 0
+        totals[phase] += elapsed
+    totals['sos'] = max(total - sum(totals.values()), 0)
+    totals['total'] = total
+    return ','.join('%s:%.4f' % (phase, totals[phase])
+                    for phase in phases + ['sos', 'total'])
+
+
+class TimedMemcache(object):
+    """
+    Wraps a memcache client to add the time of each call to the memcache
+    phase of the request.
+    """
+
+    def __init__(self, memcache_client, env):
+        self.memcache_client = memcache_client
+        self.env = env
+
+    def get(self, key):
+        start = monotonic()
+        try:
+            return self.memcache_client.get(key)
+        finally:
+            add_timing(self.env, 'memcache', start)
+
+    def set(self, key, value, **kwargs):
+        start = monotonic()
+        try:
+            return self.memcache_client.set(key, value, **kwargs)
+        finally:
+            add_timing(self.env, 'memcache', start)
+
+    def get_multi(self, keys, server_key):
+        start = monotonic()
+        try:
+            return self.memcache_client.get_multi(keys, server_key)
+        finally:
+            add_timing(self.env, 'memcache', start)
+
+    def set_multi(self, mapping, server_key, **kwargs):
+        start = monotonic()
+        try:
+            return self.memcache_client.set_multi(mapping, server_key,
+                                                  **kwargs)
+        finally:
+            add_timing(self.env, 'memcache', start)
+
+    def delete(self, key):
+        start = monotonic()
+        try:
+            return self.memcache_client.delete(key)
+        finally:
+            add_timing(self.env, 'memcache', start)
+
+    def incr(self, key, **kwargs):
+        start = monotonic()
+        try:
+            return self.memcache_client.incr(key, **kwargs)
+        finally:
+            add_timing(self.env, 'memcache', start)
+
+
+class CountingIter(object):
+    """
+    Wraps a response's app_iter to add the bytes sent to the metrics once
+    it is closed.  A class rather than a generator so that closing it
+    closes app_iter even if it was never iterated.
+    """
+
+    def __init__(self, app_iter, metrics):
+        self.app_iter = app_iter
+        self.metrics = metrics
+        self.streamed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.streamed += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.metrics.incr('sos_streamed_bytes_total',
+                              value=self.streamed)
+
+
+class CachingIter(object):
+    """
+    Wraps a response's app_iter to call store with the whole body once all
+    of it has been read.  Closing it closes app_iter, even if it was never
+    iterated.
+    """
+
+    def __init__(self, app_iter, store):
+        self.app_iter = app_iter
+        self.store = store
+
+    def __iter__(self):
+        chunks = []
+        for chunk in self.app_iter:
+            chunks.append(chunk)
+            yield chunk
+        self.store(''.join(chunks))
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
 class HashData(object):
     """
     Easier usage and standardized JSON handling of container hash data.
+    The JSON format is what is stored in the .hash_N objects; memcache
+    gets the versioned binary format from get_memcache_str.
     """
+    __slots__ = ('account', 'container', 'ttl', 'logs_enabled',
+                 'cdn_enabled')
 
     def __init__(self, account, container, ttl, cdn_enabled, logs_enabled):
         try:
@@ -141,6 +397,21 @@ class HashData(object):
                 'cdn_enabled': self.cdn_enabled}
         return json.dumps(data)
 
+    def get_memcache_str(self):
+        """
+        :returns: compact binary str: a HASH_DATA_HEADER followed by the
+                  utf-8 account and container.
+        """
+        account = self.account.encode('utf-8')
+        container = self.container.encode('utf-8')
+        flags = 0
+        if self.cdn_enabled:
+            flags |= HASH_DATA_CDN_ENABLED
+        if self.logs_enabled:
+            flags |= HASH_DATA_LOGS_ENABLED
+        return HASH_DATA_HEADER.pack(HASH_DATA_VERSION, flags, self.ttl,
+                                     len(account)) + account + container
+
     def __str__(self):
         return self.get_json_str()
 
@@ -157,26 +428,324 @@ class HashData(object):
         except (KeyError, ValueError, TypeError), e:
             raise ValueError("Problem loading json: %s: %r" % (e, json_str))
 
+    @classmethod
+    def create_from_memcache(cls, value):
+        """
+        Decodes a value written by get_memcache_str.  Values that look like
+        JSON (what older versions put in memcache) go to create_from_json.
+
+        :returns: HashData object init from str passed in
+        :raises: ValueError if the value can not be decoded
+        """
+        if not value or value[0] == '{':
+            return cls.create_from_json(value)
+        try:
+            version, flags, ttl, account_len = \
+                HASH_DATA_HEADER.unpack_from(value)
+        except struct.error, e:
+            raise ValueError("Problem loading HashData: %s: %r" % (e, value))
+        if version != HASH_DATA_VERSION:
+            raise ValueError("Unknown HashData version: %r" % value)
+        start = HASH_DATA_HEADER.size
+        end = start + account_len
+        if end > len(value):
+            raise ValueError("Truncated HashData: %r" % value)
+        hash_data = cls.__new__(cls)
+        try:
+            hash_data.account = value[start:end].decode('utf-8')
+            hash_data.container = value[end:].decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("Invalid UTF8 in HashData: %r" % value)
+        hash_data.ttl = ttl
+        hash_data.cdn_enabled = bool(flags & HASH_DATA_CDN_ENABLED)
+        hash_data.logs_enabled = bool(flags & HASH_DATA_LOGS_ENABLED)
+        return hash_data
+
+
+class MetadataStore(object):
+    """
+    Where the HashData of cdn enabled containers is kept, keyed by hash.
+    OriginBase uses the one named by the metadata_store conf option; the
+    account listings always stay in Swift.
+    """
+    # whether lookups are worth caching in memcache
+    use_memcache = True
+
+    def __init__(self, origin):
+        self.origin = origin
+
+    def get(self, env, hsh):
+        """
+        :returns: HashData or None if there is none for hsh
+        :raises: OriginDbFailure if the store can not be read
+        """
+        raise NotImplementedError()
+
+    def put(self, env, hsh, hash_data):
+        """
+        :raises: OriginDbFailure if hash_data could not be stored
+        """
+        raise NotImplementedError()
+
+    def delete(self, env, hsh):
+        """
+        :returns: False if there was nothing to delete
+        :raises: OriginDbFailure if it could not be deleted
+        """
+        raise NotImplementedError()
+
+
+class SwiftMetadataStore(MetadataStore):
+    """
+    Keeps the HashData json in the .hash_N containers of the origin
+    accounts, at get_hsh_obj_path.  While resharding, reads fall back to
+    and writes clean up get_prev_hsh_obj_path.
+    """
+
+    def _request(self, env, method, path, **kwargs):
+        return self.origin.make_request(env, method, path, phase='metadata',
+                                        **kwargs)
+
+    def _get(self, env, path):
+        """
+        GETs path, hedged by the origin's metadata_hedger if it has one.
+        """
+        hedger = self.origin.metadata_hedger
+        if not hedger:
+            return self._request(env, 'GET', path)
+        return hedger.call(lambda: self._request(env, 'GET', path),
+            good=lambda resp: resp.status_int // 100 == 2 or
+                              resp.status_int == 404)
+
+    def get(self, env, hsh):
+        cdn_obj_path = self.origin.get_hsh_obj_path(hsh)
+        resp = self._get(env, cdn_obj_path)
+        if resp.status_int == 404:
+            prev_obj_path = self.origin.get_prev_hsh_obj_path(hsh)
+            if prev_obj_path:
+                resp = self._get(env, prev_obj_path)
+        if resp.status_int == 404:
+            return None
+        if resp.status_int // 100 != 2:
+            raise OriginDbFailure('Could not GET .hash obj in origin '
+                'db: %s %s' % (cdn_obj_path, resp.status_int))
+        try:
+            return HashData.create_from_json(resp.body)
+        except ValueError:
+            raise CorruptHashData('Invalid HashData json: %s' % cdn_obj_path)
+
+    def put(self, env, hsh, hash_data):
+        cdn_obj_path = self.origin.get_hsh_obj_path(hsh)
+        cdn_obj_data = hash_data.get_json_str()
+        cdn_obj_etag = md5(cdn_obj_data).hexdigest()
+        # this is always a PUT because a POST needs to update the file
+        resp = self._request(env, 'PUT', cdn_obj_path, body=cdn_obj_data,
+                             headers={'Etag': cdn_obj_etag})
+        if resp.status_int // 100 != 2:
+            raise OriginDbFailure('Could not PUT .hash obj in origin '
+                'db: %s %s' % (cdn_obj_path, resp.status_int))
+        prev_obj_path = self.origin.get_prev_hsh_obj_path(hsh)
+        if prev_obj_path:
+            # the new obj shadows it but a later DELETE should not uncover it
+            prev_resp = self._request(env, 'DELETE', prev_obj_path)
+            if prev_resp.status_int // 100 != 2 and \
+                    prev_resp.status_int != 404:
+                self.origin.logger.warning('Could not DELETE previous .hash '
+                    'obj %s %s' % (prev_obj_path, prev_resp.status_int))
+
+    def delete(self, env, hsh):
+        found = False
+        # while resharding the obj may still be at its previous location
+        # where get would find it again.  That one goes first: a copy
+        # sos-reshard makes after it is gone is rolled back by sos-reshard,
+        # and one made before is removed by the DELETE that follows.
+        for cdn_obj_path in (self.origin.get_prev_hsh_obj_path(hsh),
+                             self.origin.get_hsh_obj_path(hsh)):
+            if not cdn_obj_path:
+                continue
+            resp = self._request(env, 'DELETE', cdn_obj_path)
+            # A 404 means it's already deleted, which is okay
+            if resp.status_int // 100 != 2 and resp.status_int != 404:
+                raise OriginDbFailure('Could not DELETE .hash obj in origin '
+                    'db: %s %s' % (cdn_obj_path, resp.status_int))
+            found = found or resp.status_int != 404
+        return found
+
+
+class SqliteMetadataStore(MetadataStore):
+    """
+    Keeps HashData in a local SQLite db indexed by hash, so a lookup is a
+    local read instead of a subrequest.  Only for a single proxy host: the
+    db is in WAL mode, which needs its file on a local filesystem, and is
+    shared by the workers on that host.
+
+    Each process opens the db once and its green threads take turns with
+    the connection.  Statements run in eventlet's thread pool so a slow
+    disk or a lock held by another worker doesn't stall the hub, and a
+    locked db fails after metadata_store_sqlite_timeout seconds.
+    """
+    use_memcache = False
+    _connections = {}
+
+    def __init__(self, origin):
+        MetadataStore.__init__(self, origin)
+        self.db_path = origin.conf.get('metadata_store_sqlite_path',
+                                       '/var/lib/sos/metadata.db')
+        self.busy_timeout = float(
+            origin.conf.get('metadata_store_sqlite_timeout', 0.1))
+
+    def get_conn(self):
+        """
+        :returns: (connection, semaphore to hold while using it)
+        """
+        key = (os.getpid(), self.db_path)
+        conn = self._connections.get(key)
+        if conn is None:
+            try:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                       timeout=self.busy_timeout)
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS hash_data (
+                        hsh TEXT PRIMARY KEY,
+                        account TEXT NOT NULL,
+                        container TEXT NOT NULL,
+                        ttl INTEGER NOT NULL,
+                        cdn_enabled INTEGER NOT NULL,
+                        logs_enabled INTEGER NOT NULL
+                    )""")
+            except sqlite3.Error, e:
+                raise OriginDbFailure('Could not open metadata db %s: %s' %
+                                      (self.db_path, e))
+            conn = self._connections[key] = (conn, Semaphore(1))
+        return conn
+
+    def _execute(self, func, *args):
+        """
+        Calls func(connection, *args) in the thread pool.
+        """
+        conn, lock = self.get_conn()
+        with lock:
+            return tpool.execute(func, conn, *args)
+
+    @staticmethod
+    def _select(conn, hsh):
+        return conn.execute("""
+            SELECT account, container, ttl, cdn_enabled, logs_enabled
+            FROM hash_data WHERE hsh = ?""", (hsh,)).fetchone()
+
+    @staticmethod
+    def _replace(conn, hsh, hash_data):
+        with conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO hash_data
+                VALUES (?, ?, ?, ?, ?, ?)""", (hsh, hash_data.account,
+                hash_data.container, hash_data.ttl,
+                hash_data.cdn_enabled, hash_data.logs_enabled))
+
+    @staticmethod
+    def _delete(conn, hsh):
+        with conn:
+            return conn.execute('DELETE FROM hash_data WHERE hsh = ?',
+                                (hsh,)).rowcount
+
+    def get(self, env, hsh):
+        start = monotonic()
+        try:
+            row = self._execute(self._select, hsh)
+        except sqlite3.Error, e:
+            raise OriginDbFailure('Could not read metadata db: %s' % e)
+        finally:
+            add_timing(env, 'metadata', start)
+        if row is None:
+            return None
+        return HashData(*row)
+
+    def put(self, env, hsh, hash_data):
+        start = monotonic()
+        try:
+            self._execute(self._replace, hsh, hash_data)
+        except sqlite3.Error, e:
+            raise OriginDbFailure('Could not write metadata db: %s' % e)
+        finally:
+            add_timing(env, 'metadata', start)
+
+    def delete(self, env, hsh):
+        start = monotonic()
+        try:
+            deleted = self._execute(self._delete, hsh)
+        except sqlite3.Error, e:
+            raise OriginDbFailure('Could not write metadata db: %s' % e)
+        finally:
+            add_timing(env, 'metadata', start)
+        return deleted > 0
+
+
+METADATA_STORES = {'swift': SwiftMetadataStore,
+                   'sqlite': SqliteMetadataStore}
+
 
 class OriginBase(object):
     """
     Base class for Origin Server
     """
 
-    def __init__(self, app, conf, logger):
+    handler_name = None
+
+    def __init__(self, app, conf, logger, metrics=None, hot_hashes=None,
+                 metadata_breaker=None, metadata_hedger=None):
         self.app = app
+        self.metrics = metrics or NULL_METRICS
+        self.hot_hashes = hot_hashes
+        self.metadata_breaker = metadata_breaker
+        self.metadata_hedger = metadata_hedger
         self.conf = conf
         self.logger = logger
         self.hash_suffix = conf.get('hash_path_suffix')
         self.origin_account = conf.get('origin_account', '.origin')
+        self.origin_accounts = [acc.strip() for acc in
+            conf.get('origin_accounts', '').split(',') if acc.strip()] or \
+            [self.origin_account]
+        self.prev_origin_accounts = [acc.strip() for acc in
+            conf.get('previous_origin_accounts', '').split(',')
+            if acc.strip()] or self.origin_accounts
         self.num_hash_cont = int(conf.get('number_hash_id_containers', 100))
+        placement = conf.get('hash_placement', 'mod')
+        prev_placement = conf.get('previous_hash_placement') or placement
+        for name in (placement, prev_placement):
+            if name not in HASH_PLACEMENTS:
+                raise InvalidConfiguration('Invalid hash_placement: %s' %
+                                           name)
+        self.hash_placement = HASH_PLACEMENTS[placement]
+        self.prev_hash_placement = HASH_PLACEMENTS[prev_placement]
+        self.prev_num_hash_cont = int(
+            conf.get('previous_number_hash_id_containers') or
+            self.num_hash_cont)
+        self.resharding = (placement, self.num_hash_cont,
+                           self.origin_accounts) != \
+            (prev_placement, self.prev_num_hash_cont,
+             self.prev_origin_accounts)
         self.hmac_signed_url_secret = self.conf.get('hmac_signed_url_secret')
         self.token_length = int(self.conf.get('hmac_token_length', 30))
         self.log_access_requests = conf.get('log_access_requests', 't') in \
                                    TRUE_VALUES
         self.number_dns_shards = int(conf.get('number_dns_shards', 100))
+        self.num_listing_shards = int(conf.get('number_listing_shards', 1))
+        self.prev_num_listing_shards = int(
+            conf.get('previous_number_listing_shards') or
+            self.num_listing_shards)
+        if min(self.num_listing_shards, self.prev_num_listing_shards) < 1:
+            raise InvalidConfiguration('Invalid number_listing_shards: %s' %
+                                       self.num_listing_shards)
         if not self.hash_suffix:
             raise InvalidConfiguration('Please provide a hash_path_suffix')
+        store = conf.get('metadata_store', 'swift')
+        if store not in METADATA_STORES:
+            raise InvalidConfiguration('Invalid metadata_store: %s' % store)
+        self.metadata_store = METADATA_STORES[store](self)
+        self.metadata_timeout = float(conf.get('metadata_timeout', 5))
+        self.cdn_data_stale_ttl = int(conf.get('cdn_data_stale_ttl', 86400))
+        self.listing_page_size = LISTING_PAGE_SIZE
 
     def hash_path(self, account, container):
         """
@@ -191,50 +760,327 @@ class OriginBase(object):
         Given a hash will return the path to where the cdn metadata is.
         :raises: ValueError on invalid hsh
         """
-        hsh_num = int(hsh, 16) % self.num_hash_cont
-        return '/v1/%s/.hash_%d/%s' % (self.origin_account, hsh_num, hsh)
+        hsh_num = self.hash_placement(hsh, self.num_hash_cont)
+        return '/v1/%s/.hash_%d/%s' % (self.get_hsh_origin_account(hsh),
+                                       hsh_num, hsh)
+
+    def get_prev_hsh_obj_path(self, hsh):
+        """
+        While resharding, returns where the cdn metadata was kept under the
+        previous placement.  Returns None if that is where it is now.
+        :raises: ValueError on invalid hsh
+        """
+        if not self.resharding:
+            return None
+        hsh_num = self.prev_hash_placement(hsh, self.prev_num_hash_cont)
+        path = '/v1/%s/.hash_%d/%s' % (
+            self.get_hsh_origin_account(hsh, self.prev_origin_accounts),
+            hsh_num, hsh)
+        if path == self.get_hsh_obj_path(hsh):
+            return None
+        return path
+
+    def get_origin_account(self, account, origin_accounts=None):
+        """
+        :returns: the origin account holding account's listing containers,
+                  picked from origin_accounts (the current ones by default)
+                  by jump consistent hashing so adding an account only
+                  moves the listings landing in it.
+        """
+        origin_accounts = origin_accounts or self.origin_accounts
+        if len(origin_accounts) == 1:
+            return origin_accounts[0]
+        return origin_accounts[jump_placement(md5(account).hexdigest(),
+                                              len(origin_accounts))]
+
+    def get_hsh_origin_account(self, hsh, origin_accounts=None):
+        """
+        :returns: the origin account holding the .hash containers for hsh,
+                  picked from origin_accounts like get_origin_account.
+                  Uses the high bits of the hash so it is independent of
+                  the .hash container placement, which uses the low bits.
+        :raises: ValueError on invalid hsh
+        """
+        origin_accounts = origin_accounts or self.origin_accounts
+        if len(origin_accounts) == 1:
+            return origin_accounts[0]
+        return origin_accounts[jump_placement(hsh[:16],
+                                              len(origin_accounts))]
+
+    def all_origin_accounts(self):
+        """
+        :returns: list of the origin accounts followed by the previous ones
+                  no longer in use while origin_accounts is being changed.
+        """
+        return self.origin_accounts + [acc for acc in
+            self.prev_origin_accounts if acc not in self.origin_accounts]
+
+    def hash_container_paths(self):
+        """
+        :returns: list of origin_account/container for every .hash
+                  container in every origin account, including the
+                  previous ones while resharding.
+        """
+        return ['%s/%s' % (origin_account, cont)
+                for origin_account in self.all_origin_accounts()
+                for cont in self.hash_container_names()]
+
+    def hash_container_names(self):
+        """
+        :returns: list of every .hash container that can hold cdn metadata,
+                  including the previous ones while resharding.
+        """
+        return ['.hash_%d' % i for i in
+                xrange(max(self.num_hash_cont, self.prev_num_hash_cont))]
+
+    def _listing_cont_name(self, account, shard, num_shards):
+        if num_shards == 1:
+            return account
+        return '%s%d_%s' % (LISTING_SHARD_PREFIX, shard, account)
+
+    def get_listing_cont(self, account, hsh):
+        """
+        :returns: the origin account container holding the listing row of
+                  the container with hash hsh.
+        """
+        return self._listing_cont_name(account,
+            int(hsh, 16) % self.num_listing_shards, self.num_listing_shards)
 
-    def cdn_data_memcache_key(self, cdn_obj_path):
-        return '%s/%s' % (self.origin_account, cdn_obj_path)
+    def get_prev_listing_location(self, account, hsh):
+        """
+        While number_listing_shards or origin_accounts is being changed,
+        returns the (origin_account, listing_cont) the listing row was kept
+        in under the previous_* options.  Returns None if that is where it
+        is now.
+        """
+        prev_location = (
+            self.get_origin_account(account, self.prev_origin_accounts),
+            self._listing_cont_name(account,
+                int(hsh, 16) % self.prev_num_listing_shards,
+                self.prev_num_listing_shards))
+        if prev_location == (self.get_origin_account(account),
+                             self.get_listing_cont(account, hsh)):
+            return None
+        return prev_location
+
+    def listing_locations(self, account):
+        """
+        :returns: list of (origin_account, listing_cont) for every
+                  container holding part of account's listing, the current
+                  ones first and then the previous ones while
+                  number_listing_shards or origin_accounts is changed.
+        """
+        origin_account = self.get_origin_account(account)
+        locations = [(origin_account,
+                      self._listing_cont_name(account, i,
+                                              self.num_listing_shards))
+                     for i in xrange(self.num_listing_shards)]
+        prev_origin_account = self.get_origin_account(
+            account, self.prev_origin_accounts)
+        for i in xrange(self.prev_num_listing_shards):
+            location = (prev_origin_account, self._listing_cont_name(
+                account, i, self.prev_num_listing_shards))
+            if location not in locations:
+                locations.append(location)
+        return locations
+
+    def _get_listing_page(self, env, origin_account, listing_cont, marker,
+                          limit=None, prefix=''):
+        """
+        :returns: list of listing dicts from listing_cont, or from the
+                  container listing of origin_account if listing_cont is
+                  None, after marker and starting with prefix or None if it
+                  does not exist.
+        :raises: OriginDbFailure
+        """
+        if listing_cont is None:
+            listing_path = quote('/v1/%s' % origin_account)
+        else:
+            listing_path = quote('/v1/%s/%s' % (origin_account, listing_cont))
+        listing_path += '?format=json&marker=' + quote(marker)
+        if limit is not None:
+            listing_path += '&limit=%d' % limit
+        if prefix:
+            listing_path += '&prefix=' + quote(prefix)
+        resp = self.make_request(env, 'GET', listing_path, phase='listing')
+        if resp.status_int // 100 == 2:
+            return json.loads(resp.body)
+        if resp.status_int == 404:
+            return None
+        raise OriginDbFailure('Origin db listings failure')
+
+    def _iter_listing_shard(self, env, origin_account, listing_cont, page,
+                            limit=None, prefix=''):
+        """
+        Yields (name, listing_dict) for every row of listing_cont starting
+        with page, fetching the following pages as they are needed.
+
+        :param limit: the limit page was fetched with, if it wasn't
+                      listing_page_size
+        :param prefix: the prefix page was fetched with
+        """
+        page_size = limit or self.listing_page_size
+        while page:
+            for listing_dict in page:
+                yield listing_dict['name'], listing_dict
+            if len(page) < page_size:
+                return
+            page_size = self.listing_page_size
+            marker = page[-1]['name']
+            if isinstance(marker, unicode):
+                marker = marker.encode('utf-8')
+            page = self._get_listing_page(env, origin_account, listing_cont,
+                marker, self.listing_page_size, prefix) or []
+
+    def make_request(self, env, method, path, phase='swift', **kwargs):
+        """
+        Makes a pre authed subrequest to the app, adding its time to phase
+        in the request's timings and to the subrequest histogram.
+
+        :returns: webob.Response
+        """
+        start = monotonic()
+        try:
+            return make_pre_authed_request(env, method, path,
+                agent='SwiftOrigin', **kwargs).get_response(self.app)
+        finally:
+            self.metrics.observe('sos_subrequest_seconds',
+                                 add_timing(env, phase, start), (phase,))
+
+    def get_memcache(self, env):
+        """
+        :returns: the request's memcache client wrapped in a TimedMemcache,
+                  or None
+        """
+        memcache_client = utils.cache_from_env(env)
+        if memcache_client:
+            return TimedMemcache(memcache_client, env)
+        return None
+
+    def cdn_data_memcache_key(self, hsh):
+        """
+        Keyed by the hash alone so changing number_hash_id_containers or
+        hash_placement doesn't empty the cache.
+        """
+        return '%s/hash/%s' % (self.origin_account, hsh)
+
+    def _get_from_store(self, env, hsh):
+        """
+        Looks hsh up in the metadata store within metadata_timeout seconds,
+        reporting to the metadata_breaker.
+
+        :raises: OriginDbFailure if the lookup failed or timed out,
+                 MetadataUnavailable if the breaker is open
+        """
+        breaker = self.metadata_breaker
+        if breaker and not breaker.allow():
+            raise MetadataUnavailable('Metadata circuit breaker is open')
+        timeout = None
+        if self.metadata_timeout:
+            timeout = Timeout(self.metadata_timeout)
+        try:
+            hash_data = self.metadata_store.get(env, hsh)
+        except Timeout, t:
+            if t is not timeout:
+                raise
+            if breaker:
+                breaker.failure()
+            raise OriginDbFailure('Metadata lookup of %s timed out after '
+                                  '%ss' % (hsh, self.metadata_timeout))
+        except CorruptHashData:
+            # the store answered, it's the data that is bad
+            if breaker:
+                breaker.success()
+            raise
+        except OriginDbFailure:
+            if breaker:
+                breaker.failure()
+            raise
+        finally:
+            if timeout:
+                timeout.cancel()
+        if breaker:
+            breaker.success()
+        return hash_data
+
+    def cdn_data_stale_key(self, memcache_key):
+        return 'sos-stale/%s' % memcache_key
+
+    def cache_cdn_data(self, memcache_client, memcache_key, hash_data):
+        """
+        Memcaches hash_data, or that there is none, along with the stale
+        copy get_cdn_data falls back on.
+        """
+        stale_key = self.cdn_data_stale_key(memcache_key)
+        if hash_data:
+            memcache_client.set(memcache_key, hash_data.get_memcache_str(),
+                                serialize=False, timeout=MEMCACHE_TIMEOUT)
+            if self.cdn_data_stale_ttl:
+                memcache_client.set(stale_key, hash_data.get_memcache_str(),
+                    serialize=False, timeout=self.cdn_data_stale_ttl)
+        else:
+            # only memcache for 30 secs in case adding container to swift
+            memcache_client.set(memcache_key, '404', serialize=False,
+                                timeout=CACHE_404)
+            memcache_client.delete(stale_key)
+
+    def uncache_cdn_data(self, memcache_client, memcache_key):
+        memcache_client.delete(memcache_key)
+        memcache_client.delete(self.cdn_data_stale_key(memcache_key))
 
     def get_cdn_data(self, env, cdn_obj_path):
         """
-        Retrieves HashData object from memcache or by doing a GET
-        of the cdn_obj_path which should be what is returned from
-        get_hsh_obj_path
+        Retrieves HashData object from memcache or from the metadata store.
+        cdn_obj_path should be what is returned from get_hsh_obj_path.
+
+        When the store can't be read, or the metadata_breaker is open, the
+        stale copy kept in memcache for cdn_data_stale_ttl seconds is used.
 
         :returns: HashData object.
+        :raises: MetadataUnavailable if the store can't be read and there
+                 is no stale copy
         """
-        memcache_client = utils.cache_from_env(env)
-        memcache_key = self.cdn_data_memcache_key(cdn_obj_path)
+        memcache_client = None
+        if self.metadata_store.use_memcache:
+            memcache_client = self.get_memcache(env)
+        hsh = cdn_obj_path.rsplit('/', 1)[-1]
+        memcache_key = self.cdn_data_memcache_key(hsh)
         if memcache_client:
             cached_cdn_data = memcache_client.get(memcache_key)
             if cached_cdn_data == '404':
+                self.metrics.incr('sos_cdn_data_cache_total',
+                                  ('negative_hit',))
                 return None
             if cached_cdn_data:
                 try:
-                    return HashData.create_from_json(cached_cdn_data)
+                    hash_data = HashData.create_from_memcache(cached_cdn_data)
+                    self.metrics.incr('sos_cdn_data_cache_total', ('hit',))
+                    return hash_data
                 except ValueError:
                     pass
+            self.metrics.incr('sos_cdn_data_cache_total', ('miss',))
 
-        resp = make_pre_authed_request(env, 'GET',
-            cdn_obj_path, agent='SwiftOrigin').get_response(self.app)
-        if resp.status_int // 100 == 2:
-            try:
-                if memcache_client:
-                    memcache_client.set(memcache_key, resp.body,
-                        serialize=False, timeout=MEMCACHE_TIMEOUT)
-
-                return HashData.create_from_json(resp.body)
-            except ValueError:
-                self.logger.warn('Invalid HashData json: %s' % cdn_obj_path)
-        if resp.status_int == 404:
-            if memcache_client:
-                # only memcache for 30 secs in case adding container to swift
-                memcache_client.set(memcache_key, '404',
-                    serialize=False, timeout=CACHE_404)
-
-        return None
+        try:
+            hash_data = self._get_from_store(env, hsh)
+        except OriginDbFailure, e:
+            if not isinstance(e, MetadataUnavailable):
+                self.logger.warn(str(e))
+            stale_cdn_data = None
+            if memcache_client and self.cdn_data_stale_ttl:
+                stale_cdn_data = memcache_client.get(
+                    self.cdn_data_stale_key(memcache_key))
+            if stale_cdn_data:
+                try:
+                    hash_data = HashData.create_from_memcache(stale_cdn_data)
+                    self.metrics.incr('sos_cdn_data_cache_total',
+                                      ('stale',))
+                    return hash_data
+                except ValueError:
+                    pass
+            raise MetadataUnavailable(str(e))
+        if memcache_client:
+            self.cache_cdn_data(memcache_client, memcache_key, hash_data)
+        return hash_data
 
     def get_cdn_urls(self, hsh, request_type, request_format_tag=''):
         """
@@ -284,10 +1130,16 @@ class OriginBase(object):
             (msg, container, hsh, account, txid, elapsed))
 
 class AdminHandler(OriginBase):
-
-    def __init__(self, app, conf, logger):
-        OriginBase.__init__(self, app, conf, logger)
+    handler_name = 'admin'
+
+    def __init__(self, app, conf, logger, metrics=None, hot_hashes=None,
+                 metadata_breaker=None, metadata_hedger=None,
+                 worker_stats=None):
+        OriginBase.__init__(self, app, conf, logger, metrics, hot_hashes,
+                            metadata_breaker, metadata_hedger)
+        self.worker_stats = worker_stats
         self.admin_key = conf.get('origin_admin_key')
+        self.export_concurrency = int(conf.get('export_concurrency', 10))
 
     def is_origin_admin(self, req):
         """
@@ -300,10 +1152,178 @@ class AdminHandler(OriginBase):
            req.headers.get('x-origin-admin-user') == '.origin_admin' and \
            req.headers.get('x-origin-admin-key') == self.admin_key
 
+    def _parse_checkpoint(self, checkpoint):
+        """
+        :returns: (origin_account, listing_cont, container) an export should
+                  resume after.
+        :raises: ValueError if checkpoint was not made by an export.
+        """
+        parts = checkpoint.split('/', 2)
+        if len(parts) != 3 or parts[0] not in self.all_origin_accounts() or \
+                split_listing_cont(parts[1]) is None:
+            raise ValueError('Invalid checkpoint: %s' % checkpoint)
+        return tuple(parts)
+
+    def _iter_export_conts(self, env, checkpoint=None):
+        """
+        Yields (origin_account, listing_cont, marker) for every listing
+        container of every origin account, including the previous ones
+        while origin_accounts is being changed, in order, starting at
+        checkpoint.
+        """
+        origin_accounts = self.all_origin_accounts()
+        start = 0
+        cont_marker = ''
+        if checkpoint:
+            origin_account, listing_cont, marker = checkpoint
+            yield origin_account, listing_cont, marker
+            start = origin_accounts.index(origin_account)
+            cont_marker = listing_cont
+        for origin_account in origin_accounts[start:]:
+            page = self._get_listing_page(env, origin_account, None,
+                cont_marker, self.listing_page_size)
+            cont_marker = ''
+            for name, listing_dict in self._iter_listing_shard(env,
+                    origin_account, None, page or []):
+                name = name.encode('utf-8')
+                if split_listing_cont(name) is not None:
+                    yield origin_account, name, ''
+
+    def _prefetch_first_pages(self, env, conts):
+        """
+        Yields (origin_account, listing_cont, first_page) for conts in
+        order, fetching up to export_concurrency first pages ahead.
+        """
+        pool = GreenPool(self.export_concurrency)
+        pending = deque()
+
+        def fetch(origin_account, listing_cont, marker):
+            return origin_account, listing_cont, self._get_listing_page(
+                env, origin_account, listing_cont, marker,
+                self.listing_page_size)
+
+        try:
+            for cont in conts:
+                pending.append(pool.spawn(fetch, *cont))
+                if len(pending) >= self.export_concurrency:
+                    yield pending.popleft().wait()
+            while pending:
+                yield pending.popleft().wait()
+        finally:
+            for gt in pending:
+                gt.kill()
+
+    def _is_current_row(self, env, origin_account, listing_cont, account,
+                        container):
+        """
+        Tells whether the listing row of container in origin_account/
+        listing_cont is the one in use, as reads find it: the row in its
+        current location, or else the one left in its previous location
+        while number_listing_shards or origin_accounts is being changed.
+
+        :raises: OriginDbFailure
+        """
+        hsh = self.hash_path(account, container)
+        location = (self.get_origin_account(account),
+                    self.get_listing_cont(account, hsh))
+        if location == (origin_account, listing_cont):
+            return True
+        if self.get_prev_listing_location(account, hsh) != \
+                (origin_account, listing_cont):
+            return False
+        resp = self.make_request(env, 'HEAD',
+            quote('/v1/%s/%s/%s' % (location + (container,))),
+            phase='listing')
+        if resp.status_int == 404:
+            return True
+        if resp.status_int // 100 == 2:
+            return False
+        raise OriginDbFailure('Origin db listings failure')
+
+    def _export_row(self, account, listing_dict):
+        """
+        :returns: the NDJSON line for a listing row or None if the row is
+                  not valid.
+        """
+        container = listing_dict['name']
+        try:
+            cdn_enabled, ttl, log_ret = parse_listing_content_type(
+                listing_dict['content_type'])
+        except ValueError:
+            self.logger.warning('Invalid Content-Type: %s/%s: %s' % (account,
+                container.encode('utf-8'), listing_dict['content_type']))
+            return None
+        hsh = self.hash_path(account, container.encode('utf-8'))
+        row = {'account': account.decode('utf-8'), 'container': container,
+               'hash': hsh, 'ttl': ttl, 'cdn_enabled': cdn_enabled,
+               'log_retention': log_ret}
+        row.update(self.get_cdn_urls(hsh, 'GET', request_format_tag='json'))
+        return json.dumps(row) + '\n'
+
+    def export_iter(self, env, checkpoint=None):
+        """
+        Streams every listing row of the origin db as NDJSON, once per
+        container even while its row is being moved to another shard or
+        origin account.  Every EXPORT_CHECKPOINT_ROWS rows a
+        {"checkpoint": ...} line says where to resume from; a final
+        {"done": true} line marks a complete export.  A failure ends the
+        stream without it.
+        """
+        rows = 0
+        try:
+            for origin_account, listing_cont, page in \
+                    self._prefetch_first_pages(env,
+                        self._iter_export_conts(env, checkpoint)):
+                account = split_listing_cont(listing_cont)
+                for name, listing_dict in self._iter_listing_shard(env,
+                        origin_account, listing_cont, page or []):
+                    if self._is_current_row(env, origin_account,
+                            listing_cont, account, name.encode('utf-8')):
+                        line = self._export_row(account, listing_dict)
+                        if line:
+                            yield line
+                    rows += 1
+                    if rows % EXPORT_CHECKPOINT_ROWS == 0:
+                        yield json.dumps({'checkpoint': '%s/%s/%s' % (
+                            origin_account, listing_cont,
+                            name.encode('utf-8'))}) + '\n'
+            yield json.dumps({'done': True}) + '\n'
+        except OriginDbFailure, e:
+            self.logger.exception(e)
+
+    def hot_hash_rows(self, env, limit=None):
+        """
+        :returns: list of dicts of the hottest hashes of this process, or of
+                  every worker with worker_stats_dir, with their request
+                  rate and, if they have cdn data, account and container
+        """
+        if self.worker_stats:
+            hottest = self.worker_stats.hot(limit)
+        else:
+            hottest = self.hot_hashes.top(limit)
+        rows = []
+        for hsh, rate in hottest:
+            row = {'hash': hsh, 'rate': round(rate, 3)}
+            try:
+                hash_data = self.get_cdn_data(env,
+                                              self.get_hsh_obj_path(hsh))
+            except (ValueError, OriginDbFailure):
+                hash_data = None
+            if hash_data:
+                row.update({'account': hash_data.account,
+                            'container': hash_data.container,
+                            'cdn_enabled': hash_data.cdn_enabled})
+            rows.append(row)
+        return rows
+
     def handle_request(self, env, req):
         """
         Handles the POST /origin/.prep call for preparing the backing store
-        Swift cluster for use with the origin subsystem. Can only be called by
+        Swift cluster for use with the origin subsystem, the GET
+        /origin/.export call that streams the whole origin db, the GET
+        /origin/.stats call for the metrics and the GET /origin/.hot call
+        for the hottest cdn hashes, of this process or with
+        worker_stats_dir of every worker. Can only be called by
         .origin_admin
 
         :param req: The webob.Request to process.
@@ -316,30 +1336,75 @@ class AdminHandler(OriginBase):
         except ValueError:
             return HTTPBadRequest(request=req)
         if account == '.prep':
-            path = '/v1/%s' % self.origin_account
-            resp = make_pre_authed_request(req.environ, 'PUT',
-                path, agent='SwiftOrigin').get_response(self.app)
-            if resp.status_int // 100 != 2:
-                raise Exception(
-                    'Could not create the main origin account: %s %s' %
-                    (path, resp.status))
-            for i in xrange(self.num_hash_cont):
-                cont_name = '.hash_%d' % i
-                path = '/v1/%s/%s' % (self.origin_account, cont_name)
-                resp = make_pre_authed_request(req.environ, 'PUT',
-                    path, agent='SwiftOrigin').get_response(self.app)
+            for origin_account in self.origin_accounts:
+                path = '/v1/%s' % origin_account
+                resp = self.make_request(req.environ, 'PUT', path,
+                                         phase='metadata')
                 if resp.status_int // 100 != 2:
-                    raise Exception('Could not create %s container: %s %s' %
-                                    (cont_name, path, resp.status))
+                    raise Exception(
+                        'Could not create the origin account: %s %s' %
+                        (path, resp.status))
+                for cont_name in self.hash_container_names():
+                    path = '/v1/%s/%s' % (origin_account, cont_name)
+                    resp = self.make_request(req.environ, 'PUT', path,
+                                             phase='metadata')
+                    if resp.status_int // 100 != 2:
+                        raise Exception(
+                            'Could not create %s container: %s %s' %
+                            (cont_name, path, resp.status))
             return HTTPNoContent(request=req)
+        if account == '.export':
+            if req.method != 'GET':
+                return HTTPMethodNotAllowed(request=req)
+            checkpoint = get_param(req, 'checkpoint')
+            if checkpoint:
+                try:
+                    checkpoint = self._parse_checkpoint(checkpoint)
+                except ValueError:
+                    return HTTPBadRequest('Invalid checkpoint')
+            return Response(app_iter=self.export_iter(env, checkpoint),
+                            content_type='application/x-ndjson')
+        if account == '.stats':
+            if req.method != 'GET':
+                return HTTPMethodNotAllowed(request=req)
+            if not hasattr(self.metrics, 'prometheus'):
+                return HTTPNotFound(request=req)
+            if self.worker_stats:
+                body = self.worker_stats.prometheus()
+            else:
+                body = self.metrics.prometheus()
+            return Response(body=body,
+                            content_type='text/plain; version=0.0.4')
+        if account == '.hot':
+            if req.method != 'GET':
+                return HTTPMethodNotAllowed(request=req)
+            if not self.hot_hashes:
+                return HTTPNotFound(request=req)
+            try:
+                limit = int(get_param(req, 'limit') or 0)
+            except ValueError:
+                return HTTPBadRequest('Invalid limit')
+            return Response(body=json.dumps(self.hot_hash_rows(env, limit)),
+                            content_type='application/json')
         return HTTPNotFound(request=req)
 
 
 class CdnHandler(OriginBase):
-
-    def __init__(self, app, conf, logger):
-        OriginBase.__init__(self, app, conf, logger)
+    handler_name = 'cdn'
+
+    def __init__(self, app, conf, logger, metrics=None, hot_hashes=None,
+                 rate_limiter=None, metadata_breaker=None,
+                 metadata_hedger=None, collapser=None, object_cache=None,
+                 block_cache=None):
+        OriginBase.__init__(self, app, conf, logger, metrics, hot_hashes,
+                            metadata_breaker, metadata_hedger)
         self.logger = logger
+        self.rate_limiter = rate_limiter
+        self.collapser = collapser
+        self.object_cache = object_cache
+        self.block_cache = block_cache
+        self.metadata_retry_after = int(conf.get('metadata_retry_after',
+                                                 CACHE_404))
         self.max_cdn_file_size = int(conf.get('max_cdn_file_size',
                                               10 * 1024 ** 3))
         self.allowed_origin_remote_ips = []
@@ -359,6 +1424,16 @@ class CdnHandler(OriginBase):
                                     gmtime(time() + ttl)),
                 'Cache-Control': 'max-age:%d, public' % ttl}
 
+    def _rate_limited(self, req, kind, wait):
+        """
+        :returns: a 503 the CDN may cache until it is worth retrying
+        """
+        self.metrics.incr('sos_ratelimited_total', (kind,))
+        seconds = retry_after(wait)
+        headers = self._getCacheHeaders(seconds)
+        headers['Retry-After'] = str(seconds)
+        return HTTPServiceUnavailable(request=req, headers=headers)
+
     def _getCdnHeaders(self, req):
         headers = {'X-Web-Mode': 'True', 'User-Agent': 'SOS Origin'}
         for header in ['If-Modified-Since', 'If-Match', 'Range', 'If-Range']:
@@ -366,6 +1441,105 @@ class CdnHandler(OriginBase):
                 headers[header] = req.headers[header]
         return headers
 
+    def _cache_object(self, hash_data, swift_path, resp, body):
+        """
+        Puts body, read in full from swift's resp, in the object_cache.
+        """
+        if len(body) == resp.content_length:
+            headers = [(header, resp.headers[header]) for header in (
+                'Content-Type', 'Content-Encoding', 'Content-Disposition',
+                'Last-Modified', 'Etag') if resp.headers.get(header)]
+            if self.object_cache.put(hash_data.account.encode('utf-8'),
+                    hash_data.container.encode('utf-8'), swift_path,
+                    CachedObject(body, resp.etag, headers, 0),
+                    hash_data.ttl):
+                self.metrics.incr('sos_object_cache_total', ('stored',))
+
+    def _cached_response(self, env, req, hsh, hash_data, cached):
+        """
+        :returns: a Response for req from a CachedObject, leaving Range,
+                  If-Range, If-None-Match and If-Modified-Since to webob
+        """
+        if cached.etag not in req.if_match:
+            return HTTPPreconditionFailed(request=req,
+                headers=self._getCacheHeaders(CACHE_404))
+        cdn_resp = Response(request=req, body=cached.body,
+                            conditional_response=True)
+        for header, value in cached.headers:
+            cdn_resp.headers[header] = value
+        cdn_resp.headers['Accept-Ranges'] = 'bytes'
+        cdn_resp.headers.update(self._getCacheHeaders(hash_data.ttl))
+        env['sos.hash'] = hsh
+        env['sos.bytes'] = len(cached.body)
+        if req.range:
+            content_range = req.range.content_range(len(cached.body))
+            if content_range:
+                env['sos.bytes'] = content_range.stop - content_range.start
+        return cdn_resp
+
+    def _block_range_response(self, env, req, hsh, hash_data, swift_path):
+        """
+        Assembles the response to a single Range GET of an object the
+        block_cache knows from cached blocks, GETting the missing ones.
+
+        :returns: a 206 Response, or None if req can't be answered that way
+        """
+        cache = self.block_cache
+        range_header = req.headers.get('Range')
+        if not range_header or ',' in range_header:
+            return None
+        for header in ('If-Match', 'If-None-Match', 'If-Modified-Since'):
+            if header in req.headers:
+                return None
+        info = cache.object_info(swift_path)
+        if not info:
+            return None
+        if req.headers.get('If-Range', '"%s"' % info.etag) != \
+                '"%s"' % info.etag:
+            return None
+        content_range = req.range and req.range.content_range(info.length)
+        if not content_range or content_range.stop - content_range.start > \
+                self.max_cdn_file_size:
+            return None
+
+        def fetch_block(index):
+            start, stop = cache.block_bounds(index, info.length)
+            headers = self._getCdnHeaders(req)
+            headers.pop('If-Range', None)
+            headers['Range'] = 'bytes=%d-%d' % (start, stop - 1)
+            headers['If-Match'] = '"%s"' % info.etag
+            resp = self.make_request(env, 'GET', swift_path, headers=headers)
+            if resp.status_int != 206 or len(resp.body) != stop - start:
+                # most likely the object changed
+                cache.forget(swift_path)
+                raise IOError('Could not GET block %d of %s: %s' % (
+                    index, swift_path, resp.status))
+            self.metrics.incr('sos_block_cache_total', ('miss',))
+            cache.put_block(info.etag, index, resp.body)
+            return resp.body
+
+        first_index = content_range.start // cache.block_size
+        if (info.etag, first_index) not in cache:
+            # find out the object is still there before answering
+            try:
+                fetch_block(first_index)
+            except IOError, e:
+                self.logger.info(str(e))
+                return None
+        cdn_resp = Response(request=req, status=206,
+            app_iter=cache.iter_range(info, content_range.start,
+                                      content_range.stop, fetch_block))
+        cdn_resp.content_length = content_range.stop - content_range.start
+        for header, value in info.headers:
+            cdn_resp.headers[header] = value
+        cdn_resp.etag = info.etag
+        cdn_resp.headers['Content-Range'] = str(content_range)
+        cdn_resp.headers['Accept-Ranges'] = 'bytes'
+        cdn_resp.headers.update(self._getCacheHeaders(hash_data.ttl))
+        env['sos.hash'] = hsh
+        env['sos.bytes'] = cdn_resp.content_length
+        return cdn_resp
+
     def handle_request(self, env, req):
         if req.method not in ('GET', 'HEAD'):
             headers = self._getCacheHeaders(CACHE_BAD_URL)
@@ -400,18 +1574,64 @@ class CdnHandler(OriginBase):
             self.logger.debug('get_hsh_obj_path error: %s' % e)
             headers = self._getCacheHeaders(CACHE_BAD_URL)
             return HTTPBadRequest(request=req, headers=headers)
-        hash_data = self.get_cdn_data(env, cdn_obj_path)
+        if self.hot_hashes:
+            self.hot_hashes.add(hsh)
+        memcache_client = None
+        if self.rate_limiter:
+            if self.rate_limiter.use_memcache:
+                memcache_client = self.get_memcache(env)
+            wait = self.rate_limiter.check('hash', hsh, memcache_client)
+            if wait:
+                return self._rate_limited(req, 'hash', wait)
+        try:
+            hash_data = self.get_cdn_data(env, cdn_obj_path)
+        except MetadataUnavailable:
+            headers = self._getCacheHeaders(self.metadata_retry_after)
+            headers['Retry-After'] = str(self.metadata_retry_after)
+            return HTTPServiceUnavailable(request=req, headers=headers)
         if hash_data and hash_data.cdn_enabled:
+            if self.rate_limiter:
+                # the account is only known once the metadata is
+                wait = self.rate_limiter.check('account',
+                    hash_data.account.encode('utf-8'), memcache_client)
+                if wait:
+                    return self._rate_limited(req, 'account', wait)
             # this is a cdn enabled container, proxy req to swift
             swift_path = quote('/v1/%s/%s/' % (
                 hash_data.account.encode('utf-8'),
                 hash_data.container.encode('utf-8')))
             if object_name:
                 swift_path += object_name
+            if self.object_cache:
+                etag = None
+                if self.object_cache.etag(swift_path):
+                    # the object may have been overwritten since
+                    head_resp = self.make_request(env, 'HEAD', swift_path)
+                    if head_resp.status_int // 100 == 2:
+                        etag = head_resp.etag
+                    elif head_resp.status_int == 404:
+                        self.object_cache.forget(swift_path)
+                cached = self.object_cache.get(swift_path, etag)
+                self.metrics.incr('sos_object_cache_total',
+                                  (cached and 'hit' or 'miss',))
+                if cached:
+                    return self._cached_response(env, req, hsh, hash_data,
+                                                 cached)
+            if self.block_cache and req.method == 'GET':
+                cdn_resp = self._block_range_response(env, req, hsh,
+                                                      hash_data, swift_path)
+                if cdn_resp:
+                    return cdn_resp
             headers = self._getCdnHeaders(req)
             env['swift.source'] = 'SOS'
-            resp = make_pre_authed_request(env, req.method, swift_path,
-                headers=headers, agent='SwiftOrigin').get_response(self.app)
+            if self.collapser and req.method == 'GET' and \
+                    ',' not in headers.get('Range', ''):
+                resp = self.collapser.get(swift_path, headers,
+                    lambda fetch_headers: self.make_request(env, 'GET',
+                        swift_path, headers=fetch_headers))
+            else:
+                resp = self.make_request(env, req.method, swift_path,
+                                         headers=headers)
             if resp.status_int == 301 and 'Location' in resp.headers:
                 resp_headers = self._getCacheHeaders(hash_data.ttl)
                 resp_headers['Location'] = resp.headers['Location']
@@ -424,9 +1644,21 @@ class CdnHandler(OriginBase):
                     headers=self._getCacheHeaders(CACHE_404))
             if resp.status_int in (200, 206):
                 if resp.content_length > self.max_cdn_file_size:
+                    self.metrics.incr('sos_oversized_rejected_total')
                     return HTTPBadRequest(request=req,
                         headers=self._getCacheHeaders(CACHE_404))
-                cdn_resp = Response(request=req, app_iter=resp.app_iter)
+                app_iter = resp.app_iter
+                if self.object_cache and req.method == 'GET' and \
+                        resp.status_int == 200 and \
+                        resp.content_length is not None and \
+                        resp.content_length <= \
+                        self.object_cache.max_object_size:
+                    app_iter = CachingIter(app_iter, lambda body:
+                        self._cache_object(hash_data, swift_path, resp, body))
+                if self.block_cache and req.method == 'GET':
+                    self.block_cache.learn(swift_path, resp, hash_data.ttl)
+                cdn_resp = Response(request=req,
+                    app_iter=CountingIter(app_iter, self.metrics))
                 cdn_resp.status = resp.status_int
                 cdn_resp.last_modified = resp.last_modified
                 cdn_resp.etag = resp.etag
@@ -439,9 +1671,14 @@ class CdnHandler(OriginBase):
                         cdn_resp.headers[header] = header_val
 
                 cdn_resp.headers.update(self._getCacheHeaders(hash_data.ttl))
-                self.log_info("Public CDN request %s %s" % (swift_path,
-                    resp.content_length), '-', hsh, hash_data.account,
-                    resp.environ, req.environ)
+                # goes in the request's access log line
+                env['sos.hash'] = hsh
+                if resp.content_length is not None:
+                    env['sos.bytes'] = resp.content_length
+                if not self.log_access_requests:
+                    self.log_info("Public CDN request %s %s" % (swift_path,
+                        resp.content_length), '-', hsh, hash_data.account,
+                        resp.environ, req.environ)
                 return cdn_resp
             self.logger.warning('Public CDN request ignored, container is not CDN enabled %s' % hsh)
             if resp.status_int != 404:
@@ -455,20 +1692,33 @@ class OriginDbHandler(OriginBase):
     """
     Origin server for public containers
     """
-
-    def __init__(self, app, conf, logger):
-        OriginBase.__init__(self, app, conf, logger)
+    handler_name = 'origin_db'
+
+    def __init__(self, app, conf, logger, metrics=None,
+                 metadata_breaker=None, metadata_hedger=None,
+                 object_cache=None):
+        OriginBase.__init__(self, app, conf, logger, metrics,
+                            metadata_breaker=metadata_breaker,
+                            metadata_hedger=metadata_hedger)
         self.conf = conf
+        self.object_cache = object_cache
         self.logger = logger
         self.min_ttl = int(conf.get('min_ttl', '900'))
         self.max_ttl = int(conf.get('max_ttl', '3155692600'))
         self.delete_enabled = self.conf.get('delete_enabled', 't').lower() in \
             TRUE_VALUES
         self.default_ttl = int(self.conf.get('default_ttl', 259200))
+        self.listing_cache_ttl = int(conf.get('listing_cache_ttl', 300))
+        self.listing_cache_max_size = int(conf.get('listing_cache_max_size',
+                                                   512 * 1024))
+        self.stats_concurrency = int(conf.get('stats_concurrency', 10))
+        self.stats_timeout = float(conf.get('stats_timeout', 2))
+        self.stats_cache_ttl = int(conf.get('stats_cache_ttl', 60))
+        self.bulk_concurrency = int(conf.get('bulk_concurrency', 10))
+        self.bulk_batch_size = int(conf.get('bulk_batch_size', 100))
 
     def _gen_listing_content_type(self, cdn_enabled, ttl, logs_enabled):
-        return 'x-cdn/%(cdn_enabled)s-%(ttl)d-%(log_ret)s' % {
-            'cdn_enabled': cdn_enabled, 'ttl': ttl, 'log_ret': logs_enabled}
+        return gen_listing_content_type(cdn_enabled, ttl, logs_enabled)
 
     def _parse_container_listing(self, account, listing_dict, output_format,
                                  only_cdn_enabled=None):
@@ -485,20 +1735,13 @@ class OriginDbHandler(OriginBase):
 
         cdn_data = listing_dict['content_type']
         hsh = self.hash_path(account, container)
-        if not cdn_data.startswith('x-cdn/'):
-            raise InvalidContentType('Invalid Content-Type: %s/%s: %s' %
-                                     (account, container, cdn_data))
-        try:
-            cdn_enabled, ttl, log_ret = cdn_data[len('x-cdn/'):].split('-')
-            cdn_enabled = cdn_enabled.lower() in TRUE_VALUES
-            log_ret = log_ret.lower() in TRUE_VALUES
-            ttl = int(ttl)
-            if only_cdn_enabled is not None and \
-                only_cdn_enabled != cdn_enabled:
-                return None
+        try:
+            cdn_enabled, ttl, log_ret = parse_listing_content_type(cdn_data)
         except ValueError:
             raise InvalidContentType('Invalid Content-Type: %s/%s: %s' %
                 (account, container, cdn_data))
+        if only_cdn_enabled is not None and only_cdn_enabled != cdn_enabled:
+            return None
         if output_format not in ('json', 'xml'):
             return container
         cdn_url_dict = self.get_cdn_urls(hsh, 'GET',
@@ -508,12 +1751,111 @@ class OriginDbHandler(OriginBase):
                        'ttl': ttl, 'log_retention': log_ret}
         output_dict.update(cdn_url_dict)
         if output_format == 'xml':
-            xml_data = '\n'.join(['<%s>%s</%s>' % (tag, val, tag)
-                                  for tag, val in output_dict.items()])
-            return """  <container>
+            return self._listing_xml(output_dict)
+        return output_dict
+
+    def _listing_xml(self, output_dict):
+        xml_data = '\n'.join(['<%s>%s</%s>' % (tag, val, tag)
+                              for tag, val in output_dict.items()])
+        return """  <container>
             %s
   </container>""" % xml_data
-        return output_dict
+
+    def _fetch_container_stats(self, env, account, output_dict):
+        """
+        HEADs the container of a formatted listing row and adds its count
+        and bytes to it.
+        """
+        container = output_dict['name'].encode('utf-8')
+        resp = self.make_request(env, 'HEAD',
+            quote('/v1/%s/%s' % (account, container)))
+        if resp.status_int // 100 != 2:
+            self.logger.debug('Could not HEAD %s/%s for stats: %s' %
+                              (account, container, resp.status_int))
+            return
+        try:
+            stats = {'count': int(resp.headers['x-container-object-count']),
+                     'bytes': int(resp.headers['x-container-bytes-used'])}
+        except (KeyError, ValueError):
+            return
+        output_dict.update(stats)
+        memcache_client = self.get_memcache(env)
+        if memcache_client:
+            memcache_client.set_multi(
+                {self.container_stats_key(account, container): stats},
+                self.container_stats_server_key(account),
+                timeout=self.stats_cache_ttl)
+
+    def container_stats_key(self, account, container):
+        return 'sos-stats/%s/%s' % (account, container)
+
+    def container_stats_server_key(self, account):
+        """
+        :returns: the memcache server key the stats of all of account's
+                  containers are kept under, so a listing gets them with
+                  one get_multi
+        """
+        return 'sos-stats/%s' % account
+
+    def add_container_stats(self, env, account, listing_formatted):
+        """
+        Adds the object count and bytes used of each container to the
+        formatted listing rows, from memcache in one get_multi or by
+        HEADing the containers with at most stats_concurrency at a time.
+        Best effort: rows without stats after stats_timeout seconds go
+        without.
+        """
+        memcache_client = self.get_memcache(env)
+        pool = GreenPool(self.stats_concurrency)
+        threads = []
+        with Timeout(self.stats_timeout, False):
+            cached = None
+            if memcache_client and listing_formatted:
+                cached = memcache_client.get_multi([
+                    self.container_stats_key(account,
+                        output_dict['name'].encode('utf-8'))
+                    for output_dict in listing_formatted],
+                    self.container_stats_server_key(account))
+            missing = []
+            for output_dict, stats in zip(listing_formatted,
+                    cached or [None] * len(listing_formatted)):
+                if stats:
+                    output_dict.update(stats)
+                else:
+                    missing.append(output_dict)
+            for output_dict in missing:
+                threads.append(pool.spawn(self._fetch_container_stats, env,
+                                          account, output_dict))
+            pool.waitall()
+        for thread in threads:
+            thread.kill()
+
+    def listing_generation_key(self, account):
+        return 'sos-listing-generation/%s' % account
+
+    def get_listing_generation(self, memcache_client, account):
+        """
+        :returns: the current generation of account's listing, starting a
+                  new one if memcache has none.
+        """
+        key = self.listing_generation_key(account)
+        generation = memcache_client.get(key)
+        if not generation:
+            generation = uuid4().hex
+            memcache_client.set(key, generation, serialize=False)
+        return generation
+
+    def bump_listing_generation(self, env, account):
+        """
+        Starts a new generation of account's listing, so every cached page
+        and ETag of the old one stops matching.  A fresh random value rather
+        than an incr so that a generation evicted from memcache can never
+        be reused.
+        """
+        memcache_client = self.get_memcache(env)
+        if memcache_client:
+            memcache_client.set(self.listing_generation_key(account),
+                                uuid4().hex, serialize=False)
 
     def origin_db_get(self, env, req):
         """
@@ -544,59 +1886,131 @@ class OriginDbHandler(OriginBase):
             except ValueError:
                 self.logger.debug("Invalid limit: %s" % get_param(req, 'limit'))
                 return HTTPBadRequest('Invalid limit, must be an integer')
+        # stats are merged into the json rows, xml is made from those after
+        with_stats = list_format in ('json', 'xml') and \
+            get_param(req, 'stats', '').lower() in TRUE_VALUES
+        row_format = with_stats and 'json' or list_format
+
+        content_type = LISTING_CONTENT_TYPES.get(list_format,
+                                                 'text/plain; charset=UTF-8')
+        memcache_client = None
+        if self.listing_cache_ttl and not with_stats:
+            memcache_client = self.get_memcache(env)
+        cache_key = None
+        if memcache_client:
+            generation = self.get_listing_generation(memcache_client, account)
+            etag = md5('\n'.join(str(param) for param in (account,
+                generation, marker, limit, list_format,
+                enabled_only))).hexdigest()
+            if etag in req.if_none_match:
+                return HTTPNotModified(request=req,
+                                       headers={'ETag': '"%s"' % etag})
+            cache_key = 'sos-listing/%s' % etag
+            response_body = memcache_client.get(cache_key)
+            if response_body is not None:
+                self.log_info("CDN container listing %d cached" %
+                    len(response_body), account=account, env=env)
+                return Response(body=response_body, headers={
+                    'Content-Type': content_type, 'ETag': '"%s"' % etag})
+
+        origin_account = self.get_origin_account(account)
+
+        def format_listing(listing_dict):
+            try:
+                return self._parse_container_listing(account, listing_dict,
+                    row_format, only_cdn_enabled=enabled_only)
+            except InvalidContentType, e:
+                self.logger.exception(e)
+                return None
 
         def get_listings(marker):
-            listing_path = quote('/v1/%s/%s' % (self.origin_account, account))
-            listing_path += '?format=json&marker=' + quote(marker)
-            # no limit in request because may have to filter on cdn_enabled
-            resp = make_pre_authed_request(env, 'GET',
-                listing_path, agent='SwiftOrigin').get_response(self.app)
-            resp_headers = {}
+            cont_listing = self._get_listing_page(env, origin_account,
+                                                  account, marker)
+            if cont_listing is None:
+                raise OriginDbNotFound()
             listing_formatted = []
-            if resp.status_int // 100 == 2:
-                cont_listing = json.loads(resp.body)
-                for listing_dict in cont_listing:
-                    if limit is None or len(listing_formatted) < limit:
-                        try:
-                            formatted_data = self._parse_container_listing(
-                                account, listing_dict, list_format,
-                                only_cdn_enabled=enabled_only)
-                            if formatted_data:
-                                listing_formatted.append(formatted_data)
-                        except InvalidContentType, e:
-                            self.logger.exception(e)
-                            continue
-                    else:
-                        break
-                if cont_listing and not listing_formatted:
-                    # there were rows returned but none matched enabled_only-
-                    # requery with new marker
-                    new_marker = cont_listing[-1]['name']
-                    if isinstance(new_marker, unicode):
-                        new_marker = new_marker.encode('utf-8')
-                    return get_listings(new_marker)
-            elif resp.status_int == 404:
+            for listing_dict in cont_listing:
+                if limit is None or len(listing_formatted) < limit:
+                    formatted_data = format_listing(listing_dict)
+                    if formatted_data:
+                        listing_formatted.append(formatted_data)
+                else:
+                    break
+            if cont_listing and not listing_formatted:
+                # there were rows returned but none matched enabled_only-
+                # requery with new marker
+                new_marker = cont_listing[-1]['name']
+                if isinstance(new_marker, unicode):
+                    new_marker = new_marker.encode('utf-8')
+                return get_listings(new_marker)
+            return {}, listing_formatted
+
+        def get_sharded_listings(marker):
+            locations = self.listing_locations(account)
+            max_rows = self.listing_page_size if limit is None else limit
+            # enabled_only may need more, those come with the next pages
+            first_limit = min(max_rows, self.listing_page_size)
+            pile = GreenPile(len(locations))
+            for location in locations:
+                pile.spawn(self._get_listing_page, env, location[0],
+                           location[1], marker, first_limit)
+            first_pages = list(pile)
+            if all(page is None for page in first_pages):
                 raise OriginDbNotFound()
-            else:
-                raise OriginDbFailure('Origin db listings failure')
-            return resp_headers, listing_formatted
+            listing_formatted = []
+            last_name = None
+
+            def ranked(rank, rows):
+                for name, listing_dict in rows:
+                    yield name, rank, listing_dict
+
+            # a row in both a current and a previous shard sorts first
+            # from the current one
+            merged = heapq.merge(*[
+                ranked(rank, self._iter_listing_shard(env, location[0],
+                    location[1], page or [], first_limit))
+                for rank, (location, page) in
+                enumerate(zip(locations, first_pages))])
+            for name, rank, listing_dict in merged:
+                if len(listing_formatted) >= max_rows:
+                    break
+                if name == last_name:
+                    # left in two places by a change of number_listing_shards
+                    # or origin_accounts
+                    continue
+                last_name = name
+                formatted_data = format_listing(listing_dict)
+                if formatted_data:
+                    listing_formatted.append(formatted_data)
+            return {}, listing_formatted
 
         try:
-            resp_headers, listing_formatted = get_listings(marker)
+            if len(self.listing_locations(account)) == 1:
+                resp_headers, listing_formatted = get_listings(marker)
+            else:
+                resp_headers, listing_formatted = get_sharded_listings(marker)
+            resp_headers['Content-Type'] = content_type
+            if with_stats:
+                self.add_container_stats(env, account, listing_formatted)
+                if list_format == 'xml':
+                    listing_formatted = [self._listing_xml(output_dict)
+                                         for output_dict in listing_formatted]
             if list_format == 'xml':
-                resp_headers['Content-Type'] = 'application/xml'
                 response_body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
                     '<account name="%s">\n%s\n</account>') % (account,
                         '\n'.join(listing_formatted))
 
             elif list_format == 'json':
-                resp_headers['Content-Type'] = 'application/json'
                 response_body = json.dumps(listing_formatted)
             else:
-                resp_headers['Content-Type'] = 'text/plain; charset=UTF-8'
                 response_body = '\n'.join(listing_formatted) + '\n'
             self.log_info("CDN container listing %d" % len(response_body),
                 account=account, env=env)
+            if cache_key:
+                resp_headers['ETag'] = '"%s"' % etag
+                if len(response_body) <= self.listing_cache_max_size:
+                    memcache_client.set(cache_key, response_body,
+                        serialize=False, timeout=self.listing_cache_ttl)
             return Response(body=response_body, headers=resp_headers)
         except OriginDbNotFound:
             return HTTPNotFound(request=req)
@@ -613,36 +2027,221 @@ class OriginDbHandler(OriginBase):
             return HTTPBadRequest('Invalid request. '
                 'URI format: /<api version>/<account>/<container>')
         hsh = self.hash_path(account, container)
-        cdn_obj_path = self.get_hsh_obj_path(hsh)
 
         # Remove memcache entry
-        memcache_client = utils.cache_from_env(env)
-        if memcache_client:
-            memcache_key = self.cdn_data_memcache_key(cdn_obj_path)
-            memcache_client.delete(memcache_key)
+        memcache_client = self.get_memcache(env)
+        if memcache_client and self.metadata_store.use_memcache:
+            self.uncache_cdn_data(memcache_client,
+                                  self.cdn_data_memcache_key(hsh))
 
-        resp = make_pre_authed_request(env, 'DELETE',
-                cdn_obj_path, agent='SwiftOrigin').get_response(self.app)
+        found = self._delete_container_data(env, account, container)
+        self.bump_listing_generation(env, account)
 
-        # A 404 means it's already deleted, which is okay
-        if resp.status_int // 100 != 2 and resp.status_int != 404:
-            raise OriginDbFailure('Could not DELETE .hash obj in origin '
-                'db: %s %s' % (cdn_obj_path, resp.status_int))
+        # Return 404 if container didn't exist
+        if not found:
+            return HTTPNotFound(request=req)
+        self.log_info("CDN delete", container, hsh, account, env)
+        return HTTPNoContent(request=req)
 
-        cdn_list_path = quote('/v1/%s/%s/%s' % (self.origin_account,
-                                                account, container))
-        list_resp = make_pre_authed_request(env, 'DELETE',
-                cdn_list_path, agent='SwiftOrigin').get_response(self.app)
+    def _delete_container_data(self, env, account, container,
+                               location=None):
+        """
+        Deletes the cdn metadata of container and its listing row, from
+        the (origin_account, listing_cont) location or else from the
+        listing container it belongs in and its previous one.
+        Leaves memcache alone.
 
-        if list_resp.status_int // 100 != 2 and list_resp.status_int != 404:
-            raise OriginDbFailure('Could not DELETE listing path in origin '
-                'db: %s %s' % (cdn_list_path, list_resp.status_int))
+        :returns: False if neither existed
+        :raises: OriginDbFailure
+        """
+        hsh = self.hash_path(account, container)
+        found = self.metadata_store.delete(env, hsh)
+        if self.object_cache:
+            self.object_cache.invalidate(account, container)
 
-        # Return 404 if container didn't exist
-        if resp.status_int == 404 and list_resp.status_int == 404:
+        if location:
+            locations = [location]
+        else:
+            locations = [(self.get_origin_account(account),
+                          self.get_listing_cont(account, hsh)),
+                         self.get_prev_listing_location(account, hsh)]
+        for location in filter(None, locations):
+            cdn_list_path = quote('/v1/%s/%s/%s' % (location + (container,)))
+            list_resp = self.make_request(env, 'DELETE', cdn_list_path,
+                                          phase='listing')
+            if list_resp.status_int // 100 != 2 and \
+                    list_resp.status_int != 404:
+                raise OriginDbFailure('Could not DELETE listing path in '
+                    'origin db: %s %s' % (cdn_list_path,
+                                          list_resp.status_int))
+            found = found or list_resp.status_int != 404
+        return found
+
+    def _bulk_update_row(self, env, account, location, listing_dict,
+                         cdn_enabled):
+        """
+        Applies a bulk DELETE (cdn_enabled is None) or a bulk POST of
+        X-CDN-Enabled to one listing row.  The metadata store is written
+        before the listing row so a retry after a failure redoes the row.
+
+        :returns: (result, hsh, new HashData or None) where result is one
+                  of BULK_RESULTS
+        """
+        container = listing_dict['name'].encode('utf-8')
+        hsh = self.hash_path(account, container)
+        try:
+            if cdn_enabled is None:
+                if self._delete_container_data(env, account, container,
+                                               location):
+                    return 'deleted', hsh, None
+                return 'not_found', hsh, None
+            try:
+                was_enabled, ttl, logs_enabled = parse_listing_content_type(
+                    listing_dict['content_type'])
+            except ValueError:
+                raise OriginDbFailure('Invalid Content-Type: %s/%s: %s' %
+                    (account, container, listing_dict['content_type']))
+            if was_enabled == cdn_enabled:
+                return 'unchanged', hsh, None
+            hash_data = HashData(account, container, ttl, cdn_enabled,
+                                 logs_enabled)
+            self.metadata_store.put(env, hsh, hash_data)
+            if self.object_cache:
+                self.object_cache.invalidate(account, container)
+            cdn_list_path = quote('/v1/%s/%s/%s' % (location + (container,)))
+            resp = self.make_request(env, 'POST', cdn_list_path,
+                headers={'Content-Type': self._gen_listing_content_type(
+                    cdn_enabled, ttl, logs_enabled), 'Content-Length': 0},
+                phase='listing')
+            if resp.status_int // 100 != 2:
+                raise OriginDbFailure('Could not POST to cdn listing in '
+                    'origin db: %s %s' % (cdn_list_path, resp.status_int))
+            return 'updated', hsh, hash_data
+        except OriginDbFailure, e:
+            self.logger.exception(e)
+            return 'failed', hsh, None
+
+    def _bulk_batch(self, env, account, batch, cdn_enabled, counts):
+        """
+        Updates the rows of batch bulk_concurrency at a time, then fixes up
+        memcache and the listing generation once for all of them.
+
+        :returns: list of the BULK_RESULTS of the rows of batch, in order
+        """
+        memcache_client = None
+        if self.metadata_store.use_memcache:
+            memcache_client = self.get_memcache(env)
+        pile = GreenPile(self.bulk_concurrency)
+        for location, listing_dict in batch:
+            pile.spawn(self._bulk_update_row, env, account, location,
+                       listing_dict, cdn_enabled)
+        changed = False
+        results = []
+        for result, hsh, hash_data in pile:
+            results.append(result)
+            counts[result] += 1
+            if result in ('deleted', 'updated'):
+                changed = True
+            if not memcache_client or result in ('unchanged', 'failed'):
+                continue
+            memcache_key = self.cdn_data_memcache_key(hsh)
+            if hash_data:
+                self.cache_cdn_data(memcache_client, memcache_key, hash_data)
+            else:
+                self.uncache_cdn_data(memcache_client, memcache_key)
+        if changed:
+            self.bump_listing_generation(env, account)
+        return results
+
+    def _bulk_iter(self, env, account, rows, cdn_enabled, marker,
+                   enabled_only):
+        """
+        Feeds the rows matching enabled_only to _bulk_batch in batches of
+        bulk_batch_size, yielding a progress line after each and a final
+        line with the totals.  The marker of a progress line is the last
+        row before the first failure, so resuming after it retries the
+        rows that failed.
+        """
+        counts = dict.fromkeys(BULK_RESULTS, 0)
+        marker = marker.decode('utf-8')
+        failed = False
+
+        def batches():
+            batch = []
+            for name, location, listing_dict in rows:
+                if enabled_only is not None:
+                    try:
+                        enabled = parse_listing_content_type(
+                            listing_dict['content_type'])[0]
+                    except ValueError:
+                        enabled = None
+                    if enabled != enabled_only:
+                        continue
+                batch.append((location, listing_dict))
+                if len(batch) >= self.bulk_batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        try:
+            for batch in batches():
+                results = self._bulk_batch(env, account, batch, cdn_enabled,
+                                           counts)
+                for (location, listing_dict), result in zip(batch, results):
+                    failed = failed or result == 'failed'
+                    if not failed:
+                        marker = listing_dict['name']
+                yield json.dumps(dict(counts, marker=marker)) + '\n'
+            self.log_info('CDN bulk %s' % ' '.join('%s=%d' % item
+                for item in sorted(counts.items())), account=account, env=env)
+            yield json.dumps(dict(counts, done=True)) + '\n'
+        except OriginDbFailure, e:
+            self.logger.exception(e)
+
+    def origin_db_bulk(self, env, req, account):
+        """
+        Handles DELETEs and POSTs of a whole account in the Origin database.
+        A DELETE removes every CDN container of the account, a POST sets
+        their X-CDN-Enabled; the prefix and enabled params narrow that down.
+        Streams NDJSON progress after each batch with the marker to resume
+        after.  Rows already in the requested state are left alone so a
+        retry only redoes what is left.
+        """
+        if req.method == 'DELETE':
+            if not self.delete_enabled:
+                self.logger.debug("DELETE called but not enabled")
+                return HTTPMethodNotAllowed(request=req)
+            cdn_enabled = None
+        elif 'X-CDN-Enabled' in req.headers:
+            cdn_enabled = req.headers['X-CDN-Enabled'].lower() in TRUE_VALUES
+        else:
+            return HTTPBadRequest('Account POSTs need X-CDN-Enabled')
+        marker = get_param(req, 'marker', default='')
+        prefix = get_param(req, 'prefix', default='')
+        enabled_only = None
+        if get_param(req, 'enabled'):
+            enabled_only = get_param(req, 'enabled').lower() in TRUE_VALUES
+        locations = self.listing_locations(account)
+        pile = GreenPile(len(locations))
+        for location in locations:
+            pile.spawn(self._get_listing_page, env, location[0], location[1],
+                       marker, self.listing_page_size, prefix)
+        first_pages = list(pile)
+        if all(page is None for page in first_pages):
             return HTTPNotFound(request=req)
-        self.log_info("CDN delete", container, hsh, account, resp.environ)
-        return HTTPNoContent(request=req)
+
+        def shard_rows(location, page):
+            for name, listing_dict in self._iter_listing_shard(env,
+                    location[0], location[1], page or [], prefix=prefix):
+                yield name, location, listing_dict
+
+        rows = heapq.merge(*[shard_rows(location, page)
+            for location, page in zip(locations, first_pages)])
+        return Response(app_iter=self._bulk_iter(env, account, rows,
+                                                 cdn_enabled, marker,
+                                                 enabled_only),
+                        content_type='application/x-ndjson')
 
     def origin_db_head(self, env, req):
         """
@@ -707,48 +2306,58 @@ class OriginDbHandler(OriginBase):
                 account, env, req.environ)
         new_hash_data = HashData(account, container, ttl, cdn_enabled,
                                  logs_enabled)
-        cdn_obj_data = new_hash_data.get_json_str()
-        cdn_obj_etag = md5(cdn_obj_data).hexdigest()
-        # this is always a PUT because a POST needs to update the file
         if cdn_enabled:
             self.log_info('CDN enable', container, hsh, account, req.environ)
-        cdn_obj_resp = make_pre_authed_request(env, 'PUT', cdn_obj_path,
-            body=cdn_obj_data, headers={'Etag': cdn_obj_etag},
-            agent='SwiftOrigin').get_response(self.app)
-
-        if cdn_obj_resp.status_int // 100 != 2:
-            raise OriginDbFailure('Could not PUT .hash obj in origin '
-                'db: %s %s' % (cdn_obj_path, cdn_obj_resp.status_int))
-
-        memcache_client = utils.cache_from_env(env)
-        if memcache_client:
-            memcache_key = self.cdn_data_memcache_key(cdn_obj_path)
-            memcache_client.set(memcache_key, cdn_obj_data,
-                serialize=False, timeout=MEMCACHE_TIMEOUT)
-
-        listing_cont_path = quote('/v1/%s/%s' % (self.origin_account, account))
-        resp = make_pre_authed_request(env, 'HEAD',
-            listing_cont_path, agent='SwiftOrigin').get_response(self.app)
+        self.metadata_store.put(env, hsh, new_hash_data)
+        if self.object_cache:
+            self.object_cache.invalidate(account, container)
+
+        memcache_client = self.get_memcache(env)
+        if memcache_client and self.metadata_store.use_memcache:
+            self.cache_cdn_data(memcache_client,
+                self.cdn_data_memcache_key(hsh), new_hash_data)
+
+        origin_account = self.get_origin_account(account)
+        listing_cont = self.get_listing_cont(account, hsh)
+        listing_cont_path = quote('/v1/%s/%s' % (origin_account,
+                                                 listing_cont))
+        resp = self.make_request(env, 'HEAD', listing_cont_path,
+                                 phase='listing')
         if resp.status_int == 404:
             # create new container for listings
-            resp = make_pre_authed_request(req.environ, 'PUT',
-                listing_cont_path, agent='SwiftOrigin').get_response(self.app)
+            resp = self.make_request(req.environ, 'PUT', listing_cont_path,
+                                     phase='listing')
             if resp.status_int // 100 != 2:
                 raise OriginDbFailure('Could not create listing container '
                     'in origin db: %s %s' % (listing_cont_path, resp.status))
 
-        cdn_list_path = quote('/v1/%s/%s/%s' % (self.origin_account,
-                                                account, container))
+        cdn_list_path = quote('/v1/%s/%s/%s' % (origin_account,
+                                                listing_cont, container))
+        list_headers = {'Content-Type':
+            self._gen_listing_content_type(cdn_enabled, ttl, logs_enabled),
+            'Content-Length': 0}
 
-        cdn_list_resp = make_pre_authed_request(env, req.method, cdn_list_path,
-            headers={'Content-Type':
-                self._gen_listing_content_type(cdn_enabled, ttl, logs_enabled),
-                'Content-Length': 0},
-            agent='SwiftOrigin').get_response(self.app)
+        cdn_list_resp = self.make_request(env, req.method, cdn_list_path,
+            headers=list_headers, phase='listing')
+        if req.method == 'POST' and cdn_list_resp.status_int == 404:
+            # the row is missing, or still in its previous listing shard
+            cdn_list_resp = self.make_request(env, 'PUT', cdn_list_path,
+                headers=list_headers, phase='listing')
 
         if cdn_list_resp.status_int // 100 != 2:
             raise OriginDbFailure('Could not PUT/POST to cdn listing in '
                 'origin db: %s %s' % (cdn_obj_path, cdn_list_resp.status_int))
+        prev_location = self.get_prev_listing_location(account, hsh)
+        if prev_location:
+            prev_list_path = quote('/v1/%s/%s/%s' % (prev_location +
+                                                     (container,)))
+            prev_resp = self.make_request(env, 'DELETE', prev_list_path,
+                                          phase='listing')
+            if prev_resp.status_int // 100 != 2 and \
+                    prev_resp.status_int != 404:
+                self.logger.warning('Could not DELETE previous listing row '
+                    '%s %s' % (prev_list_path, prev_resp.status_int))
+        self.bump_listing_generation(env, account)
         # PUTs and POSTs have the headers as HEAD
         cdn_url_headers = self.get_cdn_urls(hsh, 'HEAD')
         if req.method == 'POST':
@@ -768,6 +2377,14 @@ class OriginDbHandler(OriginBase):
             if aresp:
                 return aresp
         try:
+            if req.method in ('POST', 'DELETE'):
+                try:
+                    vsn, account, container = split_path(req.path, 2, 3)
+                except ValueError:
+                    pass
+                else:
+                    if container is None:
+                        return self.origin_db_bulk(env, req, account)
             if req.method in ('PUT', 'POST'):
                 return self.origin_db_puts_posts(env, req)
             if req.method == 'GET':
@@ -810,6 +2427,74 @@ class OriginServer(object):
             raise InvalidConfiguration('Please add origin_cdn_host_suffixes')
         self.log_access_requests = \
             self.conf.get('log_access_requests', 't') in TRUE_VALUES
+        self.metrics = metrics_from_conf(self.conf)
+        self.hot_hashes = None
+        hot_hashes_top_k = int(self.conf.get('hot_hashes_top_k', 20))
+        if hot_hashes_top_k:
+            self.hot_hashes = HotHashes(hot_hashes_top_k,
+                width=int(self.conf.get('hot_hashes_width', 2048)),
+                depth=int(self.conf.get('hot_hashes_depth', 4)),
+                half_life=float(self.conf.get('hot_hashes_half_life', 60)))
+        self.worker_stats = None
+        if self.conf.get('worker_stats_dir'):
+            self.worker_stats = WorkerStats(self.conf['worker_stats_dir'],
+                self.metrics, self.hot_hashes,
+                float(self.conf.get('worker_stats_interval', 10)))
+        self.rate_limiter = RateLimiter(self.conf)
+        self.concurrency_limits = limits_from_conf(self.conf)
+        self.metadata_breaker = None
+        breaker_failures = int(self.conf.get('metadata_breaker_failures', 5))
+        if breaker_failures:
+            self.metadata_breaker = CircuitBreaker('metadata',
+                breaker_failures,
+                float(self.conf.get('metadata_breaker_reset', 30)),
+                self.logger, self.metrics)
+        self.metadata_hedger = None
+        hedge_fraction = float(self.conf.get('metadata_hedge_fraction', 0))
+        if hedge_fraction > 0:
+            self.metadata_hedger = Hedger('metadata', hedge_fraction,
+                float(self.conf.get('metadata_hedge_percentile', 95)),
+                float(self.conf.get('metadata_hedge_min_delay', 0.01)),
+                metrics=self.metrics)
+        self.collapser = None
+        if self.conf.get('collapse_requests', 'f').lower() in TRUE_VALUES:
+            self.collapser = Collapser(
+                int(self.conf.get('collapse_buffer_size', 4 * 1024 * 1024)),
+                self.metrics)
+        self.object_cache = None
+        object_cache_size = int(self.conf.get('object_cache_size', 0))
+        if object_cache_size > 0:
+            self.object_cache = ObjectCache(object_cache_size,
+                int(self.conf.get('object_cache_max_object_size', 65536)),
+                int(self.conf.get('object_cache_max_ttl', 300)))
+        self.block_cache = None
+        if self.conf.get('block_cache_dir'):
+            block_size = int(self.conf.get('block_cache_block_size',
+                                           2 * 1024 * 1024))
+            self.block_cache = BlockCache(self.conf['block_cache_dir'],
+                block_size, int(self.conf.get('block_cache_size', 1024 ** 3)),
+                int(self.conf.get('block_cache_min_object_size',
+                                  2 * block_size)),
+                int(self.conf.get('block_cache_max_ttl', 300)),
+                metrics=self.metrics)
+        self.timing_header = \
+            self.conf.get('timing_header', 'f').lower() in TRUE_VALUES
+        self.access_log_buffer_size = int(
+            self.conf.get('access_log_buffer_size', 10000))
+        self.access_log_batch_size = int(
+            self.conf.get('access_log_batch_size', 100))
+        self.access_log = deque()
+        self.access_log_dropped = 0
+        self.access_log_writing = False
+        self.access_log_sample_rate = float(
+            self.conf.get('access_log_sample_rate', 1))
+        self.access_log_target_rate = float(
+            self.conf.get('access_log_target_rate', 0))
+        self.access_log_slow_time = float(
+            self.conf.get('access_log_slow_time', 1))
+        self.access_log_rate = self.access_log_sample_rate
+        self.sample_window_start = time()
+        self.sample_window_count = 0
 
     def __call__(self, env, start_response):
         """
@@ -827,22 +2512,50 @@ class OriginServer(object):
         :param start_response: WSGI callable
         """
         env['sos.start_time'] = time()
+        env['sos.start_monotonic'] = monotonic()
+        env['sos.timings'] = []
+        if self.worker_stats:
+            self.worker_stats.start()
         host = env.get('HTTP_HOST', '').split(':')[0]
         try:
             handler = None
             if host in self.origin_db_hosts:
-                handler = OriginDbHandler(self.app, self.conf, self.logger)
+                handler = OriginDbHandler(self.app, self.conf, self.logger,
+                    self.metrics, metadata_breaker=self.metadata_breaker,
+                    metadata_hedger=self.metadata_hedger,
+                    object_cache=self.object_cache)
             for cdn_host_suffix in self.origin_cdn_host_suffixes:
                 if host.endswith(cdn_host_suffix):
-                    handler = CdnHandler(self.app, self.conf, self.logger)
+                    handler = CdnHandler(self.app, self.conf, self.logger,
+                        self.metrics, self.hot_hashes, self.rate_limiter,
+                        self.metadata_breaker, self.metadata_hedger,
+                        self.collapser, self.object_cache, self.block_cache)
                     break
             if env['PATH_INFO'].startswith(self.origin_prefix):
-                handler = AdminHandler(self.app, self.conf, self.logger)
+                handler = AdminHandler(self.app, self.conf, self.logger,
+                    self.metrics, self.hot_hashes, self.metadata_breaker,
+                    self.metadata_hedger, self.worker_stats)
             if handler:
                 req = Request(env)
-                resp = handler.handle_request(env, req)
-                self._log_request(env, resp.status_int)
-                return resp(env, start_response)
+                limit = self.concurrency_limits.get(handler.handler_name)
+                if limit and not limit.acquire():
+                    self.metrics.incr('sos_shed_total',
+                                      (handler.handler_name,))
+                    return self._respond(handler, env,
+                        HTTPServiceUnavailable(request=req,
+                                               headers={'Retry-After': '1'}),
+                        start_response)
+                app_iter = None
+                try:
+                    app_iter = self._respond(handler, env,
+                        handler.handle_request(env, req), start_response)
+                finally:
+                    if limit and app_iter is None:
+                        limit.release()
+                if limit:
+                    # held until the response has been sent
+                    return ReleasingIter(app_iter, limit.release)
+                return app_iter
 
         except InvalidConfiguration, e:
             self.logger.exception(e)
@@ -854,41 +2567,147 @@ class OriginServer(object):
             self.logger.debug(e)
         return self.app(env, start_response)
 
+    def _respond(self, handler, env, resp, start_response):
+        self._log_request(env, resp.status_int)
+        self.metrics.incr('sos_requests_total',
+                          (handler.handler_name, resp.status_int))
+        if self.timing_header:
+            resp.headers['X-SOS-Timing'] = format_timings(
+                env['sos.timings'], monotonic() - env['sos.start_monotonic'])
+        return resp(env, start_response)
+
     def _log_request(self, env, status_int):
         """
         Logs requests as they were made to SOS.  Will include original
         hostname and path.  Will include the status of the response but
         will not include the bytes transferred.  For that you must look at
         the swift proxy logs which you can reference with the transaction id.
+        CDN object requests also get the hash and the object's length.
+        Then comes the sampling weight and the time spent in each phase,
+        see format_timings.
+
+        Only the raw fields are taken here; formatting and writing them is
+        left to _access_log_writer unless access_log_buffer_size is 0.
+        When the buffer is full the record is dropped and counted.
+
+        Errors and slow requests are always logged, the others are sampled
+        at get_sample_rate.  The weight field, 1 / the rate a record was
+        sampled at, is how many requests it stands for.
         """
         if not self.log_access_requests:
             return
-        trans_time = '%.4f' % (time() -
-                               env.get('sos.start_time', time()))
-        the_request = quote(unquote(env['PATH_INFO']))
-        if env.get('QUERY_STRING'):
-            the_request = the_request + '?' + env['QUERY_STRING']
+        now = time()
+        trans_time = now - env.get('sos.start_time', now)
+        weight = 1
+        if status_int < 500 and trans_time < self.access_log_slow_time:
+            rate = self.get_sample_rate(now)
+            if rate < 1:
+                if random() >= rate:
+                    return
+                weight = 1 / rate
+        record = (now, env.get('HTTP_X_CLUSTER_CLIENT_IP'),
+            env.get('HTTP_X_FORWARDED_FOR'), env.get('REMOTE_ADDR', '-'),
+            env['REQUEST_METHOD'], env.get('HTTP_HOST', '-'),
+            env['PATH_INFO'], env.get('QUERY_STRING'),
+            env['SERVER_PROTOCOL'], status_int,
+            env.get('HTTP_REFERER', '-'), env.get('HTTP_USER_AGENT', '-'),
+            env.get('HTTP_X_AUTH_TOKEN', '-'), env.get('HTTP_ETAG', '-'),
+            env.get('swift.trans_id', '-'), trans_time,
+            env.get('sos.hash', '-'), env.get('sos.bytes', '-'), weight,
+            env.get('sos.timings', ()),
+            monotonic() - env.get('sos.start_monotonic', monotonic()))
+        if not self.access_log_buffer_size:
+            self.logger.info(self._format_access_record(record))
+            return
+        if len(self.access_log) >= self.access_log_buffer_size:
+            self.access_log_dropped += 1
+            self.metrics.incr('sos_access_log_dropped_total')
+            return
+        self.access_log.append(record)
+        if not self.access_log_writing:
+            self.access_log_writing = True
+            spawn_n(self._access_log_writer)
+
+    def _format_access_record(self, record):
+        (now, cluster_client, forwarded_for, remote_addr, method, host,
+         path, query_string, protocol, status_int, referer, user_agent,
+         auth_token, etag, trans_id, trans_time, hsh, obj_bytes, weight,
+         timings, total) = record
+        the_request = quote(unquote(path))
+        if query_string:
+            the_request = the_request + '?' + query_string
         # remote user for zeus
-        client = env.get('HTTP_X_CLUSTER_CLIENT_IP')
-        if not client and 'HTTP_X_FORWARDED_FOR' in env:
+        client = cluster_client
+        if not client and forwarded_for:
             # remote user for other lbs
-            client = env['HTTP_X_FORWARDED_FOR'].split(',')[0].strip()
-        self.logger.info(' '.join(quote(str(x)) for x in (
+            client = forwarded_for.split(',')[0].strip()
+        return ' '.join(quote(str(x)) for x in (
             client or '-',
-            env.get('REMOTE_ADDR', '-'),
-            strftime('%d/%b/%Y/%H/%M/%S', gmtime()),
-            env['REQUEST_METHOD'],
-            env.get('HTTP_HOST', '-'),
+            remote_addr,
+            strftime('%d/%b/%Y/%H/%M/%S', gmtime(now)),
+            method,
+            host,
             the_request,
-            env['SERVER_PROTOCOL'],
+            protocol,
             status_int,
-            env.get('HTTP_REFERER', '-'),
-            env.get('HTTP_USER_AGENT', '-'),
-            env.get('HTTP_X_AUTH_TOKEN', '-'),
-            env.get('HTTP_ETAG', '-'),
-            env.get('swift.trans_id', '-'),
-            trans_time)))
+            referer,
+            user_agent,
+            auth_token,
+            etag,
+            trans_id,
+            '%.4f' % trans_time,
+            hsh,
+            obj_bytes,
+            '%.4g' % weight)) + ' ' + format_timings(timings, total)
+
+    def get_sample_rate(self, now):
+        """
+        :returns: the share of requests to log.  That is
+                  access_log_sample_rate, lowered when access_log_target_rate
+                  is set so that the requests seen over the last sample
+                  window would have come to that many logs per second.
+        """
+        if not self.access_log_target_rate:
+            return self.access_log_sample_rate
+        self.sample_window_count += 1
+        elapsed = now - self.sample_window_start
+        if elapsed >= ACCESS_LOG_SAMPLE_WINDOW:
+            seen_rate = self.sample_window_count / elapsed
+            self.access_log_rate = min(self.access_log_sample_rate,
+                                       self.access_log_target_rate / seen_rate)
+            self.sample_window_start = now
+            self.sample_window_count = 0
+        return self.access_log_rate
+
+    def flush_access_log(self, limit=None):
+        """
+        Writes out up to limit of the buffered access log records, and a
+        warning if any were dropped since the last flush.
 
+        :returns: the number of records written
+        """
+        written = 0
+        while self.access_log and (limit is None or written < limit):
+            self.logger.info(self._format_access_record(
+                self.access_log.popleft()))
+            written += 1
+        if self.access_log_dropped:
+            self.logger.warning('Dropped %d access log records, buffer '
+                                'full' % self.access_log_dropped)
+            self.access_log_dropped = 0
+        return written
+
+    def _access_log_writer(self):
+        """
+        Runs in its own green thread while there are buffered records,
+        writing them access_log_batch_size at a time and yielding to the
+        request green threads in between.
+        """
+        try:
+            while self.flush_access_log(self.access_log_batch_size):
+                sleep()
+        finally:
+            self.access_log_writing = False
 
 def filter_factory(global_conf, **local_conf):
     """:returns: a WSGI filter app for use with paste.deploy."""
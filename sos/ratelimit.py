@@ -0,0 +1,116 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Token bucket rate limiting of CDN requests per hash and per account.
+
+Each worker process keeps its buckets in a table of at most max_entries,
+dropping the least recently used; a dropped bucket comes back full, so
+the table size only bounds memory and never turns more requests away.
+With ratelimit_memcache on, a request the local bucket lets through is
+also counted in a memcache counter per key and second shared by every
+proxy, so the rate holds across the cluster.  That counter allows the
+larger of the rate and the burst each second.
+"""
+from collections import OrderedDict
+from math import ceil
+from time import time
+
+from swift.common.utils import TRUE_VALUES
+
+
+class TokenBuckets(object):
+    """
+    A bucket per key holding up to burst tokens, refilled at rate tokens a
+    second.
+    """
+
+    def __init__(self, rate, burst=None, max_entries=10000):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.max_entries = max_entries
+        # key -> (tokens, last refill time)
+        self.buckets = OrderedDict()
+
+    def take(self, key, now=None):
+        """
+        Takes a token from key's bucket.
+
+        :returns: 0 if there was one, otherwise the seconds until there
+                  will be
+        """
+        if now is None:
+            now = time()
+        tokens, last = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self.buckets[key] = (tokens, now)
+        while len(self.buckets) > self.max_entries:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class RateLimiter(object):
+    """
+    The hash and account TokenBuckets of the ratelimit_* options.
+    """
+
+    def __init__(self, conf):
+        max_entries = int(conf.get('ratelimit_max_entries', 10000))
+        self.buckets = {}
+        for kind in ('hash', 'account'):
+            rate = float(conf.get('ratelimit_%s_rate' % kind, 0))
+            if rate > 0:
+                self.buckets[kind] = TokenBuckets(rate,
+                    float(conf.get('ratelimit_%s_burst' % kind, 0)),
+                    max_entries)
+        self.use_memcache = \
+            conf.get('ratelimit_memcache', 'f').lower() in TRUE_VALUES
+
+    def __nonzero__(self):
+        return bool(self.buckets)
+
+    def limits(self, kind):
+        return kind in self.buckets
+
+    def check(self, kind, key, memcache_client=None, now=None):
+        """
+        :returns: 0 if a request for key is let through, otherwise the
+                  seconds to wait before retrying
+        """
+        buckets = self.buckets.get(kind)
+        if not buckets:
+            return 0
+        if now is None:
+            now = time()
+        wait = buckets.take(key, now)
+        if wait or not (self.use_memcache and memcache_client):
+            return wait
+        second = int(now)
+        count = memcache_client.incr('sos-ratelimit/%s/%s/%d' % (
+            kind, key, second), timeout=2)
+        if count is not None and count > max(buckets.rate, buckets.burst):
+            return second + 1 - now
+        return 0
+
+
+def retry_after(wait):
+    """
+    :returns: int seconds for a Retry-After header, at least 1
+    """
+    return max(1, int(ceil(wait)))
@@ -0,0 +1,114 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Background mover for changing number_hash_id_containers, hash_placement or
+origin_accounts.
+
+While previous_number_hash_id_containers / previous_hash_placement /
+previous_origin_accounts are set the middleware writes cdn metadata to its
+new .hash container, deletes the copy at the old one and falls back to
+reading the old one on a 404.  This walks every .hash container and moves
+each object that is not where the current placement puts it.  Once it has
+finished the previous_* options can be removed.
+
+A DELETE landing between reading the old copy and writing the new one
+would bring the container back, so the old copy is checked again after
+the write and the new one rolled back if it has gone.
+"""
+from hashlib import md5
+
+from sos.origin import OriginBase
+from sos.utils import ClientException, ContainerWalker, split_hsh_obj_path
+
+
+class Resharder(ContainerWalker):
+
+    def __init__(self, conf, conn_pool, checkpoint, logger, concurrency=10,
+                 container_concurrency=4):
+        ContainerWalker.__init__(self, conn_pool, checkpoint, logger,
+                                 concurrency, container_concurrency)
+        self.origin = OriginBase(None, conf, logger)
+
+    def move(self, cont, row):
+        hsh = row['name']
+        if isinstance(hsh, unicode):
+            hsh = hsh.encode('utf-8')
+        new_cont = split_hsh_obj_path(self.origin.get_hsh_obj_path(hsh))[0]
+        if new_cont == cont:
+            self.stats['in_place'] += 1
+            return
+        with self.conn_pool.item() as conn:
+            try:
+                conn.head_object(new_cont, hsh)
+                # a write since resharding started, the old copy is stale
+                self.stats['superseded'] += 1
+            except ClientException, e:
+                if e.http_status != 404:
+                    raise
+                try:
+                    body = conn.get_object(cont, hsh)[1]
+                except ClientException, e:
+                    if e.http_status != 404:
+                        raise
+                    return
+                etag = md5(body).hexdigest()
+                try:
+                    # don't clobber a write that lands after the HEAD
+                    conn.put_object(new_cont, hsh, body, etag=etag,
+                                    headers={'If-None-Match': '*'})
+                except ClientException, e:
+                    if e.http_status != 412:
+                        raise
+                    self.stats['superseded'] += 1
+                else:
+                    if not self._exists(conn, cont, hsh):
+                        self._roll_back(conn, new_cont, hsh, etag)
+                        return
+                    self.stats['moved'] += 1
+            try:
+                conn.delete_object(cont, hsh)
+            except ClientException, e:
+                if e.http_status != 404:
+                    raise
+
+    def _exists(self, conn, cont, hsh):
+        try:
+            conn.head_object(cont, hsh)
+        except ClientException, e:
+            if e.http_status != 404:
+                raise
+            return False
+        return True
+
+    def _roll_back(self, conn, new_cont, hsh, etag):
+        """
+        Deletes the copy just written to new_cont after the container was
+        deleted, unless a new write has replaced it since.
+        """
+        self.stats['deleted_during_move'] += 1
+        try:
+            if conn.head_object(new_cont, hsh).get('etag') == etag:
+                conn.delete_object(new_cont, hsh)
+        except ClientException, e:
+            if e.http_status != 404:
+                raise
+
+    def run(self):
+        if not self.origin.resharding:
+            self.logger.info('Not resharding: previous_hash_placement, '
+                'previous_number_hash_id_containers and '
+                'previous_origin_accounts are not set')
+        self.walk_all(self.origin.hash_container_paths(), self.move)
+        return dict(self.stats)
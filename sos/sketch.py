@@ -0,0 +1,130 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Fixed memory tracking of the CDN hashes getting the most requests.
+
+Counts are exponentially decayed with forward decay: rather than shrinking
+every counter as time passes, each request adds exp((now - landmark) /
+tau), a weight that grows over time, and a count is turned back into a
+decayed one by dividing by the current weight.  Counters only ever grow,
+so one add is depth array updates, and everything is rescaled to a new
+landmark once the weights get big.  A decayed count divided by tau is the
+recent request rate.
+"""
+from array import array
+from math import exp, log
+from time import time
+
+# rescale once the weight of a request gets past this
+MAX_WEIGHT = 2.0 ** 64
+
+
+class CountMinSketch(object):
+    """
+    depth rows of width counters.  A key adds to one counter per row and
+    its estimate is the smallest of them, which is never below its real
+    count and, with probability 1 - exp(-depth), at most e / width of the
+    total count above it.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('d', [0.0]) * width for i in xrange(depth)]
+
+    def _indexes(self, key):
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.width for i in xrange(self.depth)]
+
+    def add(self, key, count=1.0):
+        """
+        :returns: the estimated count of key after adding count
+        """
+        estimate = None
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index]
+                   for row, index in zip(self.rows, self._indexes(key)))
+
+    def scale(self, factor):
+        for row in self.rows:
+            for i in xrange(self.width):
+                row[i] *= factor
+
+
+class HotHashes(object):
+    """
+    The top_k hashes by exponentially decayed request count, with a half
+    life of half_life seconds.  A candidate list a few times top_k long
+    keeps each tracked hash's sketch estimate; a hash not on it replaces
+    the smallest candidate once its estimate is bigger.
+    """
+
+    def __init__(self, top_k=20, width=2048, depth=4, half_life=60.0,
+                 candidates=None):
+        self.top_k = top_k
+        self.capacity = candidates or top_k * 4
+        self.tau = half_life / log(2)
+        self.sketch = CountMinSketch(width, depth)
+        self.landmark = time()
+        self.candidates = {}
+        # a lower bound of the smallest candidate count, the candidates
+        # only grow
+        self.min_count = 0.0
+
+    def _weight(self, now):
+        weight = exp((now - self.landmark) / self.tau)
+        if weight > MAX_WEIGHT:
+            self.sketch.scale(1 / weight)
+            for key in self.candidates:
+                self.candidates[key] /= weight
+            self.min_count /= weight
+            self.landmark = now
+            weight = 1.0
+        return weight
+
+    def add(self, hsh, now=None):
+        if now is None:
+            now = time()
+        count = self.sketch.add(hsh, self._weight(now))
+        if hsh in self.candidates:
+            self.candidates[hsh] = count
+        elif len(self.candidates) < self.capacity:
+            self.candidates[hsh] = count
+        elif count > self.min_count:
+            smallest = min(self.candidates, key=self.candidates.get)
+            if count > self.candidates[smallest]:
+                del self.candidates[smallest]
+                self.candidates[hsh] = count
+            self.min_count = min(self.candidates.itervalues())
+
+    def top(self, limit=None, now=None):
+        """
+        :returns: list of (hsh, requests per second) of the limit (or
+                  top_k) hottest hashes, hottest first
+        """
+        if now is None:
+            now = time()
+        norm = exp((now - self.landmark) / self.tau) * self.tau
+        hottest = sorted(self.candidates.iteritems(),
+                         key=lambda item: -item[1])[:limit or self.top_k]
+        return [(hsh, count / norm) for hsh, count in hottest]
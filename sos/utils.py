@@ -0,0 +1,243 @@
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers shared by the SOS command line tools that talk directly to the
+origin accounts in Swift.
+
+The connections are made to the cluster's /v1 url rather than to a single
+account, so containers are named origin_account/container and an origin
+account's container listing is fetched as if the account were a container.
+"""
+import os
+from collections import defaultdict
+from tempfile import mkstemp
+
+from eventlet import GreenPool, GreenPile
+from eventlet.pools import Pool
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    from swiftclient import Connection, ClientException
+except ImportError:
+    from swift.common.client import Connection, ClientException
+
+from sos.origin import OriginServer
+
+LISTING_LIMIT = 10000
+
+
+def load_sos_conf(conf_path):
+    """
+    :returns: the [sos] section of conf_path, with the url format sections
+              merged in, just like the middleware sees it.
+    """
+    return OriginServer._translate_conf({'sos_conf': conf_path})
+
+
+def get_swift_url(storage_url):
+    """
+    Strips the account from storage_url.
+    """
+    return storage_url.rstrip('/').rsplit('/', 1)[0]
+
+
+class OriginConnectionPool(Pool):
+    """
+    eventlet pool of Connections to the origin accounts.  The auth user must
+    be a reseller admin to be able to read and write the origin accounts.
+    """
+
+    def __init__(self, auth_url, user, key, swift_url=None, max_size=10,
+                 retries=5):
+        self.auth_url = auth_url
+        self.user = user
+        self.key = key
+        self.retries = retries
+        conn = Connection(auth_url, user, key, retries=retries)
+        storage_url, self.token = conn.get_auth()
+        self.swift_url = swift_url or get_swift_url(storage_url)
+        Pool.__init__(self, max_size=max_size)
+
+    def create(self):
+        return Connection(self.auth_url, self.user, self.key,
+                          retries=self.retries, preauthurl=self.swift_url,
+                          preauthtoken=self.token)
+
+
+def iter_listing(conn_pool, container, marker='', end_marker=None,
+                 limit=LISTING_LIMIT):
+    """
+    Yields every row of a container listing, or of an origin account's
+    listing if container has no /, one page at a time.
+
+    :param conn_pool: OriginConnectionPool
+    :param container: origin_account/container or origin_account
+    :param end_marker: stop once a name is >= end_marker
+    :param limit: number of rows per page
+    :returns: generator of lists of listing dicts
+    """
+    while True:
+        with conn_pool.item() as conn:
+            page = conn.get_container(container, marker=marker,
+                                      limit=limit)[1]
+        if end_marker is not None and page and \
+                page[-1]['name'] >= end_marker:
+            page = [row for row in page if row['name'] < end_marker]
+            if page:
+                yield page
+            return
+        if not page:
+            return
+        yield page
+        marker = page[-1]['name']
+        if isinstance(marker, unicode):
+            marker = marker.encode('utf-8')
+
+
+def iter_origin_containers(conn_pool, origin_accounts):
+    """
+    Yields origin_account/container for every container in origin_accounts.
+    """
+    for origin_account in origin_accounts:
+        for page in iter_listing(conn_pool, origin_account):
+            for row in page:
+                name = row['name']
+                if isinstance(name, unicode):
+                    name = name.encode('utf-8')
+                yield '%s/%s' % (origin_account, name)
+
+
+def split_container_path(container_path):
+    """
+    :returns: (origin_account, container) of origin_account/container
+    """
+    return tuple(container_path.split('/', 1))
+
+
+def split_hsh_obj_path(hsh_obj_path):
+    """
+    :returns: (origin_account/container, object) of a path from
+              get_hsh_obj_path
+    """
+    junk, vsn, origin_account, cont, obj = hsh_obj_path.split('/', 4)
+    return '%s/%s' % (origin_account, cont), obj
+
+
+class Checkpoint(object):
+    """
+    Small JSON file of resume points (typically a listing marker per
+    container) so long running tools can be stopped and restarted.
+    Writes are atomic: the file is written to a temp file and renamed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        if path and os.path.exists(path):
+            fp = open(path)
+            try:
+                self.data = json.load(fp)
+            finally:
+                fp.close()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        fd, tmp_path = mkstemp(dir=os.path.dirname(os.path.abspath(
+            self.path)))
+        try:
+            os.write(fd, json.dumps(self.data))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, self.path)
+
+
+class ContainerWalker(object):
+    """
+    Base for tools that call a function for every row of many containers.
+    Containers are walked container_concurrency at a time, the rows of
+    each page concurrency at a time, and the marker of each container is
+    saved in the Checkpoint after each page.  The marker never goes past a
+    row that failed, so a rerun retries it.
+    """
+
+    def __init__(self, conn_pool, checkpoint, logger, concurrency=10,
+                 container_concurrency=4):
+        self.conn_pool = conn_pool
+        self.checkpoint = checkpoint
+        self.logger = logger
+        self.pool = GreenPool(concurrency)
+        self.container_pool = GreenPool(container_concurrency)
+        self.stats = defaultdict(int)
+
+    def _safe(self, func, *args):
+        """
+        :returns: False if func raised
+        """
+        try:
+            func(*args)
+        except Exception, e:
+            self.stats['errors'] += 1
+            self.logger.exception('Failed on %r: %s' % (args, e))
+            return False
+        return True
+
+    def walk_container(self, container, func):
+        """
+        Calls func(container, row) concurrently for every row of container,
+        checkpointing the marker after each page.  Once a row has failed the
+        marker stays before it and the container isn't marked done.
+        """
+        state = self.checkpoint.get(container) or {}
+        if state.get('done'):
+            return
+        marker = state.get('marker', '')
+        if isinstance(marker, unicode):
+            marker = marker.encode('utf-8')
+        failed = False
+        for page in iter_listing(self.conn_pool, container, marker=marker):
+            pile = GreenPile(self.pool)
+            for row in page:
+                pile.spawn(self._safe, func, container, row)
+            last_ok = None
+            for row, ok in zip(page, list(pile)):
+                if not ok:
+                    failed = True
+                if not failed:
+                    last_ok = row['name']
+            if last_ok is not None:
+                self.checkpoint.set(container, {'marker': last_ok})
+        if failed:
+            self.logger.info('Finished %s with errors, it is retried from '
+                             'the first failed row on the next run: %s' %
+                             (container, dict(self.stats)))
+            return
+        self.checkpoint.set(container, {'done': True})
+        self.logger.info('Finished %s: %s' % (container, dict(self.stats)))
+
+    def walk_all(self, containers, func):
+        for container in containers:
+            self.container_pool.spawn_n(self.walk_container, container, func)
+        self.container_pool.waitall()
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Microbenchmark comparing the JSON and compact memcache encodings of
+HashData.  Run with: python -m test_sos.bench_hashdata [iterations]
+"""
+
+import sys
+from timeit import Timer
+
+from sos.origin import HashData
+
+
+def main(iterations=100000):
+    hash_data = HashData('AUTH_9f1c3b2a-5d6e-4f70-8a9b-0c1d2e3f4a5b',
+                         'static-assets', 259200, True, False)
+    json_str = hash_data.get_json_str()
+    memcache_str = hash_data.get_memcache_str()
+    print 'bytes per entry: json %d, compact %d' % (len(json_str),
+                                                    len(memcache_str))
+    for name, func, value in (
+            ('create_from_json', HashData.create_from_json, json_str),
+            ('create_from_memcache', HashData.create_from_memcache,
+             memcache_str)):
+        elapsed = min(Timer(lambda: func(value)).repeat(3, iterations))
+        print '%-22s %.3f usec/decode' % (name,
+                                          elapsed * 1000000 / iterations)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
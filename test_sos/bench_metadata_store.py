@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# Copyright (c) 2011-2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares the metadata stores by running the same OriginDbHandler HEADs
+against each, without memcache.  The swift store talks to an in memory
+stand-in for the proxy, so its numbers are a lower bound: a real proxy
+subrequest adds network and object server time on top.
+Run with: python -m test_sos.bench_metadata_store [iterations]
+"""
+
+import os
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import Timer
+
+from webob import Request, Response
+
+from sos.origin import OriginDbHandler
+
+
+class NullLogger(object):
+
+    def info(self, *args, **kwargs):
+        pass
+
+    warn = warning = debug = exception = info
+
+
+class MemoryProxy(object):
+    """
+    Just enough of a proxy for the .hash object GETs and PUTs.
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        if req.method == 'PUT':
+            self.objects[req.path_info] = req.body
+            return Response(status=201)(env, start_response)
+        if req.path_info in self.objects:
+            return Response(body=self.objects[req.path_info])(
+                env, start_response)
+        return Response(status=404)(env, start_response)
+
+
+def main(iterations=10000):
+    testdir = mkdtemp()
+    try:
+        base_conf = {'hash_path_suffix': 'bench',
+                     'outgoing_url_format': {'X-CDN-URI':
+                         'http://%(hash)s.r%(hash_mod)d.origin_cdn.com'}}
+        for store in ('swift', 'sqlite'):
+            conf = dict(base_conf, metadata_store=store,
+                metadata_store_sqlite_path=os.path.join(testdir, 'bench.db'))
+            handler = OriginDbHandler(MemoryProxy(), conf, NullLogger())
+            for i in xrange(100):
+                req = Request.blank('/v1/AUTH_bench/cont%d' % i,
+                                    environ={'REQUEST_METHOD': 'PUT'})
+                handler.origin_db_puts_posts(req.environ, req)
+
+            def head():
+                req = Request.blank('/v1/AUTH_bench/cont42',
+                                    environ={'REQUEST_METHOD': 'HEAD'})
+                handler.origin_db_head(req.environ, req)
+
+            elapsed = min(Timer(head).repeat(3, iterations))
+            print '%-6s %.1f usec/HEAD' % (store,
+                                           elapsed * 1000000 / iterations)
+    finally:
+        rmtree(testdir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,90 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from webob import Response
+
+from sos import blockcache
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_learn(self):
+        cache = blockcache.BlockCache(self.testdir, block_size=4,
+                                      min_object_size=8, max_ttl=60)
+        resp = Response(status=206, body='cdef', headers={
+            'Content-Range': 'bytes 2-5/16', 'Etag': 'abc',
+            'Content-Type': 'video/mp4'})
+        cache.learn('/v1/acc/cont/obj', resp, 3600, now=100)
+        info = cache.object_info('/v1/acc/cont/obj', now=159)
+        self.assertEquals((info.etag, info.length), ('abc', 16))
+        self.assertEquals(info.headers, [('Content-Type', 'video/mp4')])
+        self.assertEquals(cache.object_info('/v1/acc/cont/obj', now=160),
+                          None)
+        # too small
+        cache.learn('/v1/acc/cont/small',
+                    Response(body='abcd', headers={'Etag': 'abc'}), 60)
+        self.assertEquals(cache.object_info('/v1/acc/cont/small'), None)
+
+    def test_blocks(self):
+        # a directory left behind by a process that is gone
+        os.mkdir(os.path.join(self.testdir, '999999999'))
+        cache = blockcache.BlockCache(self.testdir, block_size=4,
+                                      max_bytes=8)
+        self.assertEquals(cache.read_block('abc', 0), None)
+        cache.put_block('abc', 0, 'abcd')
+        self.assertEquals(os.listdir(self.testdir), [str(os.getpid())])
+        self.assertEquals(cache.read_block('abc', 0, 1, 3), 'bc')
+        cache.put_block('abc', 1, 'efgh')
+        cache.read_block('abc', 0)
+        # the least recently used block goes
+        cache.put_block('abc', 2, 'ijkl')
+        self.assertEquals(cache.blocks.keys(), [('abc', 0), ('abc', 2)])
+        self.assertEquals(len(os.listdir(cache.dir[1])), 2)
+        self.assertEquals(cache.size, 8)
+
+    def test_iter_range(self):
+        cache = blockcache.BlockCache(self.testdir, block_size=4)
+        body = 'abcdefghij'
+        info = blockcache.ObjectInfo('abc', len(body), [], 0)
+        fetched = []
+
+        def fetch_block(index):
+            fetched.append(index)
+            start, stop = cache.block_bounds(index, info.length)
+            cache.put_block(info.etag, index, body[start:stop])
+            return body[start:stop]
+
+        self.assertEquals(''.join(cache.iter_range(info, 3, 10, fetch_block)),
+                          'defghij')
+        self.assertEquals(fetched, [0, 1, 2])
+        self.assertEquals(''.join(cache.iter_range(info, 0, 6, fetch_block)),
+                          'abcdef')
+        self.assertEquals(fetched, [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from sos import breaker
+from sos.metrics import Metrics
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_and_close(self):
+        metrics = Metrics()
+        cb = breaker.CircuitBreaker('metadata', failures=2, reset_timeout=10,
+                                    metrics=metrics)
+        cb.failure(100)
+        cb.success(100)
+        cb.failure(101)
+        self.assertEquals(cb.state, breaker.CLOSED)
+        self.assertTrue(cb.allow(101))
+        cb.failure(102)
+        self.assertEquals(cb.state, breaker.OPEN)
+        self.assertFalse(cb.allow(111))
+        # one probe after reset_timeout
+        self.assertTrue(cb.allow(112))
+        self.assertEquals(cb.state, breaker.HALF_OPEN)
+        self.assertFalse(cb.allow(113))
+        cb.failure(114)
+        self.assertEquals(cb.state, breaker.OPEN)
+        self.assertFalse(cb.allow(120))
+        self.assertTrue(cb.allow(124))
+        cb.success(125)
+        self.assertEquals(cb.state, breaker.CLOSED)
+        self.assertTrue(cb.allow(125))
+        counters = metrics.counters
+        self.assertEquals(counters[('sos_breaker_transitions_total',
+                                    ('metadata', 'open'))], 2)
+        self.assertEquals(counters[('sos_breaker_transitions_total',
+                                    ('metadata', 'half_open'))], 2)
+        self.assertEquals(counters[('sos_breaker_transitions_total',
+                                    ('metadata', 'closed'))], 1)
+
+    def test_lost_probe(self):
+        cb = breaker.CircuitBreaker('metadata', failures=1, reset_timeout=10)
+        cb.failure(100)
+        self.assertTrue(cb.allow(110))
+        self.assertFalse(cb.allow(115))
+        # the probe never reported back, let another one through
+        self.assertTrue(cb.allow(120))
+
+
+if __name__ == '__main__':
+    unittest.main()
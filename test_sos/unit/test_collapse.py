@@ -0,0 +1,128 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from eventlet import GreenPool, sleep
+from webob import Response
+
+from sos import collapse
+from sos.metrics import Metrics
+
+
+class FakeFetch(object):
+
+    def __init__(self, body='abcdefghij', status=200):
+        self.body = body
+        self.status = status
+        self.calls = []
+
+    def __call__(self, headers):
+        self.calls.append(headers)
+        sleep(0.01)
+        if self.status is None:
+            raise IOError('failed')
+        status, body = self.status, self.body
+        resp_headers = {'Etag': 'theetag'}
+        if 'Range' in headers:
+            first, last = headers['Range'][6:].split('-')
+            body = body[int(first):int(last) + 1]
+            status = 206
+            resp_headers['Content-Range'] = 'bytes %s-%s/%d' % (
+                first, last, len(self.body))
+        resp = Response(status=status, headers=resp_headers,
+                        app_iter=list(body))
+        resp.content_length = len(body)
+        return resp
+
+
+class TestCollapser(unittest.TestCase):
+
+    def get_all(self, collapser, fetch, count=2, headers=None):
+        pool = GreenPool()
+        resps = [pool.spawn(collapser.get, '/v1/acc/cont/obj',
+                            headers or {}, fetch) for i in xrange(count)]
+        return [resp.wait() for resp in resps]
+
+    def test_shared(self):
+        metrics = Metrics()
+        collapser = collapse.Collapser(metrics=metrics)
+        fetch = FakeFetch()
+        resps = self.get_all(collapser, fetch, 3)
+        self.assertEquals(len(fetch.calls), 1)
+        self.assertEquals([resp.content_length for resp in resps], [10] * 3)
+        self.assertEquals([''.join(resp.app_iter) for resp in resps],
+                          ['abcdefghij'] * 3)
+        for resp in resps:
+            resp.app_iter.close()
+        self.assertEquals(collapser.fetches, {})
+        self.assertEquals(metrics.counters[('sos_collapsed_requests_total',
+                                            ('joined',))], 2)
+        # different headers don't share
+        fetch = FakeFetch()
+        collapser.get('/v1/acc/cont/obj', {}, fetch)
+        collapser.get('/v1/acc/cont/obj', {'Range': 'bytes=1-2'}, fetch)
+        self.assertEquals(len(fetch.calls), 2)
+
+    def test_slow_client(self):
+        collapser = collapse.Collapser(buffer_size=3)
+        fetch = FakeFetch()
+        fast, slow = self.get_all(collapser, fetch, 2,
+                                  {'Range': 'bytes=1-8'})
+        slow_iter = iter(slow.app_iter)
+        self.assertEquals(slow_iter.next() + slow_iter.next(), 'bc')
+        self.assertEquals(''.join(fast.app_iter), 'bcdefghi')
+        self.assertEquals(''.join(slow_iter), 'defghi')
+        self.assertEquals(len(fetch.calls), 2)
+        self.assertEquals(fetch.calls[1], {'Range': 'bytes=3-8',
+                                           'If-Match': '"theetag"'})
+
+    def test_not_shared(self):
+        fetch = FakeFetch(status=404)
+        resps = self.get_all(collapse.Collapser(), fetch)
+        self.assertEquals([resp.status_int for resp in resps], [404, 404])
+        self.assertEquals(len(fetch.calls), 1)
+        # a body without a length can't be shared
+        fetch = FakeFetch()
+        orig_fetch = fetch.__call__
+
+        def unknown_length(headers):
+            resp = orig_fetch(headers)
+            del resp.content_length
+            return resp
+        resps = self.get_all(collapse.Collapser(), unknown_length)
+        self.assertEquals([resp.body for resp in resps], ['abcdefghij'] * 2)
+        self.assertEquals(len(fetch.calls), 2)
+        # a failed GET is tried again by the clients that joined it
+        fetch = FakeFetch(status=None)
+        collapser = collapse.Collapser()
+        pool = GreenPool()
+        results = []
+
+        def get():
+            try:
+                results.append(collapser.get('/v1/acc/cont/obj', {}, fetch))
+            except IOError:
+                results.append(None)
+        pool.spawn(get)
+        pool.spawn(get)
+        pool.waitall()
+        self.assertEquals(results, [None, None])
+        self.assertEquals(len(fetch.calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
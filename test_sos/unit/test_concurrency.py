@@ -0,0 +1,65 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from eventlet import GreenPool, sleep
+
+from sos import concurrency
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_limit(self):
+        limit = concurrency.ConcurrencyLimit(1, queue_size=1,
+                                             queue_timeout=0.05)
+        self.assertTrue(limit.acquire())
+        pool = GreenPool()
+        results = []
+        # one request may wait for the slot, the next is turned away
+        waiter = pool.spawn(limit.acquire)
+        sleep()
+        self.assertEquals(limit.waiting, 1)
+        self.assertFalse(limit.acquire())
+        limit.release()
+        self.assertTrue(waiter.wait())
+        # a waiter gives up after queue_timeout
+        self.assertFalse(limit.acquire())
+        self.assertEquals(limit.waiting, 0)
+        limit.release()
+        self.assertEquals(limit.semaphore.counter, 1)
+
+    def test_releasing_iter(self):
+        released = []
+        app_iter = concurrency.ReleasingIter(iter(['a', 'b']),
+                                             lambda: released.append(1))
+        self.assertEquals(''.join(app_iter), 'ab')
+        app_iter.close()
+        app_iter.close()
+        self.assertEquals(released, [1])
+
+    def test_limits_from_conf(self):
+        limits = concurrency.limits_from_conf({'cdn_concurrency': '50',
+                                               'admin_concurrency': '0',
+                                               'origin_db_queue_size': '5'})
+        self.assertEquals(sorted(limits), ['cdn', 'origin_db'])
+        self.assertEquals(limits['cdn'].queue_size, 50)
+        self.assertEquals(limits['origin_db'].size, 100)
+        self.assertEquals(limits['origin_db'].queue_size, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
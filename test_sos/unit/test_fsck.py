@@ -0,0 +1,295 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from contextlib import contextmanager
+from hashlib import md5
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from sos import fsck
+from sos.origin import HashData
+from sos.utils import ClientException
+
+
+class FakeLogger(object):
+
+    def __init__(self):
+        self.exceptions = []
+
+    def info(self, *args, **kwargs):
+        pass
+
+    def exception(self, *args, **kwargs):
+        self.exceptions.append(args)
+
+
+class FakeConn(object):
+    """
+    Keeps the origin account in a dict of container -> {name: body}.
+    Listing containers are dicts of name -> content_type.
+    """
+
+    def __init__(self, containers):
+        self.containers = containers
+
+    def get_container(self, container, marker='', limit=None):
+        if '/' not in container:
+            # an origin account listing
+            return {}, [{'name': name} for name in sorted(
+                c.split('/', 1)[1] for c in self.containers
+                if c.startswith(container + '/')) if name > marker][:limit]
+        names = sorted(n for n in self.containers.get(container, {})
+                       if n > marker)[:limit]
+        rows = []
+        for name in names:
+            val = self.containers[container][name]
+            rows.append({'name': name, 'content_type': val,
+                         'hash': md5(val).hexdigest()})
+        return {}, rows
+
+    def get_object(self, container, obj):
+        return {}, self.containers[container][obj]
+
+    def put_container(self, container):
+        self.containers.setdefault(container, {})
+
+    def put_object(self, container, obj, body, etag=None, content_type=None):
+        self.containers[container][obj] = content_type or body
+
+    def delete_object(self, container, obj):
+        try:
+            del self.containers[container][obj]
+        except KeyError:
+            raise ClientException('not found', http_status=404)
+
+
+class FakeConnPool(object):
+
+    def __init__(self, containers):
+        self.conn = FakeConn(containers)
+
+    @contextmanager
+    def item(self):
+        yield self.conn
+
+
+class TestExternalSorter(unittest.TestCase):
+
+    def test_sort_runs(self):
+        testdir = mkdtemp()
+        try:
+            sorter = fsck.ExternalSorter(run_size=3, tmpdir=testdir)
+            for line in ['e', 'b', 'g', 'a', 'f', 'c', 'd']:
+                sorter.add(line)
+            self.assertEquals(list(sorter), list('abcdefg'))
+            self.assertEquals(len(os.listdir(testdir)), 3)
+            sorter.close()
+            self.assertEquals(os.listdir(testdir), [])
+        finally:
+            rmtree(testdir)
+
+
+class TestFsck(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.containers = dict(('.origin/.hash_%d' % i, {})
+                               for i in xrange(4))
+        self.problems = []
+        self.fsck = self._fsck()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def _fsck(self, repair=False, **kwargs):
+        conf = {'hash_path_suffix': 'testing',
+                'number_hash_id_containers': '4'}
+        conf.update(kwargs)
+        return fsck.Fsck(conf, FakeConnPool(self.containers), FakeLogger(),
+                         run_size=2, tmpdir=self.testdir, repair=repair,
+                         report=lambda *args: self.problems.append(args))
+
+    def _add(self, account, container, ttl=1234, cdn_enabled=True,
+             listing=True, hash_obj=True, hash_cont=None):
+        hsh = self.fsck.origin.hash_path(account, container)
+        if listing:
+            self.containers.setdefault(
+                self.fsck.listing_cont(account, hsh), {})[container] = \
+                'x-cdn/%s-%d-False' % (cdn_enabled, ttl)
+        if hash_obj:
+            hash_cont = hash_cont or self.fsck.hash_cont(hsh)
+            self.containers.setdefault(hash_cont, {})[hsh] = HashData(
+                account, container, ttl, cdn_enabled, False).get_json_str()
+        return hsh
+
+    def test_join(self):
+        joined = list(self.fsck.join(
+            iter([('a', 1), ('c', 2), ('c', 3)]),
+            iter([('b', 4), ('c', 5), ('d', 6)])))
+        self.assertEquals(joined, [('a', [1], []), ('b', [], [4]),
+                                   ('c', [2, 3], [5]), ('d', [], [6])])
+
+    def test_consistent(self):
+        for i in xrange(5):
+            self._add('acc', 'cont%d' % i)
+        stats = self.fsck.run()
+        self.assertEquals(stats['ok'], 5)
+        self.assertEquals(stats['listing_rows'], 5)
+        self.assertEquals(self.problems, [])
+
+    def test_problems(self):
+        self._add('acc', 'ok')
+        missing = self._add('acc', 'missing', hash_obj=False)
+        orphan = self._add('acc', 'orphan', listing=False)
+        mismatch = self._add('acc2', 'mismatch')
+        self.containers['.origin/acc2']['mismatch'] = 'x-cdn/True-9999-False'
+        misplaced_hsh = self.fsck.origin.hash_path('acc', 'misplaced')
+        wrong_cont = '.origin/.hash_%d' % (
+            (int(self.fsck.hash_cont(misplaced_hsh)[14:]) + 1) % 4)
+        misplaced = self._add('acc', 'misplaced', hash_cont=wrong_cont)
+        junk_cont = self.fsck.hash_cont('f' * 32)
+        self.containers[junk_cont]['f' * 32] = 'junk'
+        stats = self.fsck.run()
+        found = sorted((p[0], p[1]) for p in self.problems)
+        self.assertEquals(found, sorted([
+            ('missing_hash', missing), ('orphan_hash', orphan),
+            ('mismatch', mismatch), ('misplaced', misplaced),
+            ('invalid', 'f' * 32)]))
+        self.assertEquals(stats['ok'], 2)
+
+        self.problems = []
+        self._fsck(repair=True).run()
+        self.assertTrue('missing' not in self.containers['.origin/acc'])
+        self.assertTrue('orphan' in self.containers['.origin/acc'])
+        self.assertEquals(self.containers['.origin/acc2']['mismatch'],
+                          'x-cdn/True-1234-False')
+        self.assertTrue(misplaced in
+            self.containers[self.fsck.hash_cont(misplaced)])
+        self.assertTrue(misplaced not in self.containers[wrong_cont])
+
+        self.problems = []
+        stats = self._fsck().run()
+        self.assertEquals(self.problems, [
+            ('invalid', 'f' * 32, '-', '-', junk_cont)])
+        self.assertEquals(stats['ok'], 4)
+
+    def test_origin_accounts(self):
+        self.containers.clear()
+        self.fsck = self._fsck(origin_accounts='.o0,.o1')
+        for i in xrange(10):
+            self._add('acc%d' % i, 'cont')
+        self.assertEquals(set(cont.split('/')[0] for cont in self.containers),
+                          set(['.o0', '.o1']))
+        stats = self.fsck.run()
+        self.assertEquals(stats['ok'], 10)
+        self.assertEquals(self.problems, [])
+
+    def test_origin_accounts_changed(self):
+        self.containers.clear()
+        self.fsck = self._fsck(origin_accounts='.o0')
+        for i in xrange(10):
+            self._add('acc%d' % i, 'cont')
+        # made by swift-origin-prep
+        for i in xrange(4):
+            self.containers['.o1/.hash_%d' % i] = {}
+        self.fsck = self._fsck(repair=True, origin_accounts='.o0,.o1',
+                               previous_origin_accounts='.o0')
+        stats = self.fsck.run()
+        self.assertFalse(stats.get('errors'))
+        self.assertTrue(stats['misplaced'] + stats['misplaced_row'] > 0)
+        self.assertEquals(set(cont.split('/')[0] for cont, objs in
+                              self.containers.items() if objs),
+                          set(['.o0', '.o1']))
+
+        self.problems = []
+        self.fsck = self._fsck(origin_accounts='.o0,.o1')
+        stats = self.fsck.run()
+        self.assertEquals(self.problems, [])
+        self.assertEquals(stats['ok'], 10)
+
+    def test_misplaced_listing_rows(self):
+        for i in xrange(6):
+            self._add('acc', 'cont%d' % i)
+        # rows written before number_listing_shards was raised
+        conf = {'hash_path_suffix': 'testing',
+                'number_hash_id_containers': '4',
+                'number_listing_shards': '2'}
+        sharded = fsck.Fsck(conf, FakeConnPool(self.containers), FakeLogger(),
+                            run_size=2, tmpdir=self.testdir, repair=True,
+                            report=lambda *args: self.problems.append(args))
+        stats = sharded.run()
+        self.assertEquals(stats['misplaced_row'], 6)
+        self.assertEquals(stats['ok'], 6)
+        self.assertEquals(self.containers['.origin/acc'], {})
+        self.assertEquals(len(self.containers['.origin/.listing_0_acc']) +
+                          len(self.containers['.origin/.listing_1_acc']), 6)
+
+        self.problems = []
+        sharded.repair = False
+        sharded.stats.clear()
+        stats = sharded.run()
+        self.assertEquals(self.problems, [])
+        self.assertEquals(stats['ok'], 6)
+
+    def test_misplaced_copy_of_placed_row(self):
+        self._add('acc', 'cont', ttl=1234)
+        conf = {'hash_path_suffix': 'testing',
+                'number_hash_id_containers': '4',
+                'number_listing_shards': '2'}
+        sharded = fsck.Fsck(conf, FakeConnPool(self.containers), FakeLogger(),
+                            run_size=2, tmpdir=self.testdir, repair=True,
+                            report=lambda *args: self.problems.append(args))
+        hsh = sharded.origin.hash_path('acc', 'cont')
+        right_cont = sharded.listing_cont('acc', hsh)
+        # the row in the right shard is current, the one left behind in
+        # the previous shard has an older ttl
+        current = self.containers['.origin/acc']['cont']
+        self.containers[right_cont] = {'cont': current}
+        self.containers['.origin/acc']['cont'] = 'x-cdn/True-9999-False'
+        sharded.repair = False
+        stats = sharded.run()
+        self.assertEquals(stats['misplaced_row'], 1)
+        self.assertEquals(stats['ok'], 1)
+
+        sharded.repair = True
+        sharded.stats.clear()
+        sharded.run()
+        self.assertEquals(self.containers[right_cont], {'cont': current})
+        self.assertEquals(self.containers['.origin/acc'], {})
+
+    def test_misplaced_copy_of_placed_hash(self):
+        hsh = self._add('acc', 'cont', ttl=1234)
+        right_cont = self.fsck.hash_cont(hsh)
+        wrong_cont = '.origin/.hash_%d' % ((int(right_cont[14:]) + 1) % 4)
+        # an old copy left behind by a reshard, with an older ttl
+        self.containers[wrong_cont][hsh] = HashData(
+            'acc', 'cont', 9999, True, False).get_json_str()
+        current = self.containers[right_cont][hsh]
+        self._fsck(repair=True).run()
+        self.assertEquals(self.problems, [
+            ('misplaced', hsh, '-', '-', wrong_cont)])
+        self.assertEquals(self.containers[right_cont][hsh], current)
+        self.assertTrue(hsh not in self.containers[wrong_cont])
+
+        self.problems = []
+        stats = self._fsck().run()
+        self.assertEquals(self.problems, [])
+        self.assertEquals(stats['ok'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from eventlet import sleep
+
+from sos import hedge
+from sos.metrics import Metrics
+
+
+class TestHedger(unittest.TestCase):
+
+    def test_delay(self):
+        hedger = hedge.Hedger('test', percentile=90, min_delay=0.01,
+                              window=10)
+        self.assertEquals(hedger.delay, None)
+        hedger.observe(0.001)
+        self.assertEquals(hedger.delay, 0.01)
+        for i in xrange(10):
+            hedger.observe(i / 10.0)
+        self.assertEquals(hedger.delay, 0.9)
+
+    def test_call(self):
+        metrics = Metrics()
+        hedger = hedge.Hedger('test', fraction=0.25, min_delay=0.01,
+                              metrics=metrics)
+        hedger.observe(0.001)
+        calls = []
+
+        def func():
+            calls.append(1)
+            if len(calls) == 1:
+                sleep(10)
+                return 'slow'
+            return 'fast'
+
+        self.assertEquals(hedger.call(func), 'fast')
+        self.assertEquals(len(calls), 2)
+        # the slow call was killed
+        sleep(0)
+        self.assertEquals(metrics.counters[('sos_hedged_requests_total',
+                                            ('test', 'won'))], 1)
+        # the budget is spent, the slow call is waited for
+        del calls[:]
+        self.assertEquals(hedger.call(lambda: sleep(0.02) or 'slow'), 'slow')
+        self.assertEquals(hedger.credit, 0.5)
+
+    def test_bad_result(self):
+        hedger = hedge.Hedger('test', min_delay=0.5)
+        hedger.observe(0.001)
+        results = iter([503, 200])
+        self.assertEquals(hedger.call(results.next,
+                                      good=lambda status: status == 200), 200)
+
+        def fail():
+            raise ValueError('failed')
+        hedger.credit = 1
+        self.assertRaises(ValueError, hedger.call, fail)
+        # without a delay yet nothing is hedged
+        hedger = hedge.Hedger('test')
+        results = iter([503, 200])
+        self.assertEquals(hedger.call(results.next,
+                                      good=lambda status: status == 200), 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
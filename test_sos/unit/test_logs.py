@@ -0,0 +1,199 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gzip
+import os
+import unittest
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+from sos import logs
+from sos.origin import HashData
+from sos.utils import ClientException, split_hsh_obj_path
+
+
+class FakeLogger(object):
+
+    def info(self, *args, **kwargs):
+        pass
+
+    warning = error = info
+
+    def exception(self, *args, **kwargs):
+        raise Exception(args)
+
+
+class FakeConn(object):
+
+    def __init__(self, containers):
+        self.containers = containers
+        self.gets = 0
+
+    def get_object(self, container, obj):
+        self.gets += 1
+        try:
+            return {}, self.containers[container][obj]
+        except KeyError:
+            raise ClientException('not found', http_status=404)
+
+    def put_container(self, container):
+        self.containers.setdefault(container, {})
+
+    def put_object(self, container, obj, contents, content_length=None,
+                   content_type=None):
+        self.containers[container][obj] = contents.read()
+
+
+def access_line(hsh, date='18/Oct/2012/10/59/59', path='/obj.jpg',
+                client='1.2.3.4'):
+    return ('Oct 18 10:59:59 proxy1 proxy-server: %s 5.6.7.8 %s GET '
+            '%s.r3.origin_cdn.com %s HTTP/1.0 200 - curl AUTH_tk123 "etag" '
+            'tx1 0.0100 %s 14 1 memcache:0.0010,sos:0.0090,total:0.0100' %
+            (client, date, hsh, path, hsh))
+
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_parse_access_record(self):
+        record, hsh, bucket = logs.parse_access_record(access_line('abc'))
+        self.assertEquals(hsh, 'abc')
+        self.assertEquals(bucket, '2012/10/18/10')
+        self.assertTrue(record.startswith('1.2.3.4 5.6.7.8 18/Oct/2012/'))
+        self.assertEquals(len(record.split()), logs.ACCESS_RECORD_FIELDS)
+        self.assertEquals(logs.parse_access_record(access_line('-')), None)
+        self.assertEquals(logs.parse_access_record(
+            'Oct 18 proxy1 proxy-server: CDN enable cont abc acc tx1 0.0100'),
+            None)
+        self.assertEquals(logs.parse_access_record(''), None)
+
+    def test_redact_access_record(self):
+        record = logs.parse_access_record(access_line('abc'))[0]
+        fields = logs.redact_access_record(record).split()
+        self.assertEquals(len(fields), logs.ACCESS_RECORD_FIELDS)
+        self.assertEquals(fields[:3], ['1.2.3.4', '-', '18/Oct/2012/10/59/59'])
+        self.assertEquals(fields[10:13], ['-', '"etag"', '-'])
+        self.assertEquals(fields[13:], ['0.0100', 'abc', '14', '-', '-'])
+        for client in ('10.1.2.3', '172.20.0.1', '192.168.1.1', '127.0.0.1',
+                       'fd00::1', '::1'):
+            record = logs.parse_access_record(
+                access_line('abc', client=client))[0]
+            self.assertEquals(logs.redact_access_record(record).split()[0],
+                              '-')
+        for client in ('172.32.0.1', '11.0.0.1', '2001:db8::1'):
+            record = logs.parse_access_record(
+                access_line('abc', client=client))[0]
+            self.assertEquals(logs.redact_access_record(record).split()[0],
+                              client)
+
+    def test_lru_cache(self):
+        cache = logs.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertFalse('b' in cache)
+        self.assertEquals(cache.pop_oldest(), ('a', 1))
+        self.assertEquals(len(cache), 1)
+
+    def test_deliver(self):
+        conf = {'hash_path_suffix': 'testing'}
+        conn = FakeConn({})
+        splitter = logs.LogSplitter(conf, conn, FakeLogger(),
+                                    max_open_files=1, tmpdir=self.testdir,
+                                    hostname='proxy1')
+        logged = splitter.origin.hash_path('acc', 'logged')
+        quiet = splitter.origin.hash_path('acc', 'quiet')
+        for hsh, logs_enabled in ((logged, True), (quiet, False)):
+            cont, obj = split_hsh_obj_path(
+                splitter.origin.get_hsh_obj_path(hsh))
+            conn.containers.setdefault(cont, {})[obj] = HashData(
+                'acc', hsh == logged and 'logged' or 'quiet', 3600, True,
+                logs_enabled).get_json_str()
+        lines = [access_line(logged, path='/a.jpg'),
+                 access_line(quiet),
+                 access_line(logged, date='18/Oct/2012/11/00/00',
+                             path='/b.jpg'),
+                 access_line('-'),
+                 access_line('f' * 32),
+                 access_line(logged, path='/c.jpg')]
+        log_path = os.path.join(self.testdir, 'proxy1.log.gz')
+        fp = gzip.open(log_path, 'wb')
+        fp.write('\n'.join(lines) + '\n')
+        fp.close()
+        stats = splitter.deliver(log_path)
+        self.assertEquals(splitter.deliver(log_path)['objects'], 4)
+        self.assertEquals(stats['delivered'], 3)
+        self.assertEquals(stats['not_enabled'], 2)
+        self.assertEquals(stats['skipped'], 1)
+        self.assertEquals(stats['objects'], 2)
+        self.assertEquals(stats['lookups'], 3)
+        self.assertEquals(conn.gets, 3)
+        delivered = conn.containers['acc/.CDN_ACCESS_LOGS']
+        # delivering the same file again replaces its objects
+        source = logs.md5('proxy1/%s' % logs.md5(
+            '\n'.join(lines) + '\n').hexdigest()).hexdigest()
+        self.assertEquals(sorted(delivered), [
+            'logged/2012/10/18/10/%s.log.gz' % source,
+            'logged/2012/10/18/11/%s.log.gz' % source])
+        # the 10 o'clock file was reopened after the 11 o'clock one pushed
+        # it out, so it has two gzip members
+        body = gzip.GzipFile(fileobj=StringIO(
+            delivered['logged/2012/10/18/10/%s.log.gz' % source])).read()
+        self.assertEquals([line.split()[5] for line in body.splitlines()],
+                          ['/a.jpg', '/c.jpg'])
+        for line in body.splitlines():
+            self.assertFalse('AUTH_tk123' in line)
+            self.assertFalse('5.6.7.8' in line)
+            self.assertFalse('tx1' in line)
+            self.assertFalse('total:' in line)
+        self.assertEquals(os.listdir(self.testdir), ['proxy1.log.gz'])
+
+    def test_deliver_same_file_name(self):
+        conf = {'hash_path_suffix': 'testing'}
+        conn = FakeConn({})
+        delivered = []
+        for host, path in (('proxy1', '/a.jpg'), ('proxy2', '/b.jpg'),
+                           ('proxy2', '/c.jpg')):
+            splitter = logs.LogSplitter(conf, conn, FakeLogger(),
+                                        tmpdir=self.testdir, hostname=host)
+            hsh = splitter.origin.hash_path('acc', 'logged')
+            cont, obj = split_hsh_obj_path(
+                splitter.origin.get_hsh_obj_path(hsh))
+            conn.containers.setdefault(cont, {})[obj] = HashData(
+                'acc', 'logged', 3600, True, True).get_json_str()
+            log_dir = mkdtemp(dir=self.testdir)
+            log_path = os.path.join(log_dir, 'sos.log.1.gz')
+            fp = gzip.open(log_path, 'wb')
+            fp.write(access_line(hsh, path=path) + '\n')
+            fp.close()
+            self.assertEquals(splitter.deliver(log_path)['objects'], 1)
+        # every proxy's file and every rotation of it is kept
+        objects = conn.containers['acc/.CDN_ACCESS_LOGS']
+        self.assertEquals(len(objects), 3)
+        self.assertEquals(sorted(
+            gzip.GzipFile(fileobj=StringIO(body)).read().split()[5]
+            for body in objects.values()), ['/a.jpg', '/b.jpg', '/c.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from sos import logstats
+
+CONF = {'origin_db_hosts': 'origin_db.com',
+        'origin_cdn_host_suffixes': 'origin_cdn.com'}
+
+
+def access_line(host='1234.r3.origin_cdn.com', path='/obj.jpg', status=200,
+                trans_time=0.01, hsh='1234', weight=1,
+                date='18/Oct/2012/10/59/59'):
+    return ('Oct 18 10:59:59 proxy1 proxy-server: 1.2.3.4 5.6.7.8 %s GET '
+            '%s %s HTTP/1.0 %d - curl - - tx1 %.4f %s - %s '
+            'sos:0.0010,total:%.4f' % (date, host, path, status, trans_time,
+                                       hsh, weight, trans_time))
+
+
+class TestLogStats(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_parse_record(self):
+        classifier = logstats.Classifier(CONF)
+        self.assertEquals(logstats.parse_record(access_line(), classifier),
+                          (1350557999, 0.01, 1.0, ('cdn', 200), '1234', None))
+        self.assertEquals(logstats.parse_record(access_line(
+            host='origin_db.com%3A8080', path='/v1/AUTH_test/cont%3Fformat'
+            '%3Djson', hsh='-', weight=4), classifier)[2:],
+            (4.0, ('origin_db', 200), None, 'AUTH_test'))
+        self.assertEquals(logstats.parse_record(access_line(
+            host='origin_db.com', path='/origin/.stats', hsh='-'),
+            classifier)[3], ('admin', 200))
+        self.assertEquals(logstats.parse_record(
+            'CDN enable cont 1234 acc tx1 0.0100', classifier), None)
+
+    def test_percentile(self):
+        counts = [0.0] * (len(logstats.LATENCY_BOUNDS) + 1)
+        self.assertEquals(logstats.percentile(counts, 50), None)
+        counts[20] = 98
+        counts[40] = 1
+        counts[-1] = 1
+        self.assertEquals(logstats.percentile(counts, 50), 0.001)
+        self.assertAlmostEquals(logstats.percentile(counts, 99), 0.01)
+        self.assertEquals(logstats.percentile(counts, 99.9), float('inf'))
+
+    def test_stats(self):
+        lines = [access_line(trans_time=0.002, hsh='aaa')] * 9 + [
+            access_line(status=404, trans_time=0.5, hsh='bbb'),
+            access_line(host='origin_db.com', path='/v1/AUTH_test', hsh='-',
+                        weight=10, date='18/Oct/2012/11/00/01'),
+            'not an access log line']
+        stats = logstats.stats_for_lines(lines, logstats.Classifier(CONF),
+                                         chunk_size=4)
+        self.assertEquals(stats.records, 11)
+        self.assertEquals(stats.skipped, 1)
+        self.assertEquals(logstats.top(stats.hashes, 1), [(9, 'aaa')])
+        self.assertEquals(dict(stats.accounts), {'AUTH_test': 10})
+        self.assertEquals(dict(stats.rates), {1350557940: 10,
+                                              1350558000: 10})
+        self.assertEquals(sum(stats.latency_counts('cdn')), 10)
+        self.assertEquals(sum(stats.latency_counts(status=200)), 19)
+        cdn_404 = stats.latency_counts('cdn', 404)
+        self.assertTrue(0.5 <= logstats.percentile(cdn_404, 50) < 0.57)
+        # the pure python aggregation gets the same results as numpy's
+        orig_numpy = logstats.numpy
+        try:
+            logstats.numpy = None
+            python_stats = logstats.stats_for_lines(lines,
+                logstats.Classifier(CONF), chunk_size=4)
+        finally:
+            logstats.numpy = orig_numpy
+        for attr in ('latencies', 'hashes', 'accounts', 'rates'):
+            self.assertEquals(getattr(python_stats, attr),
+                              getattr(stats, attr))
+        report = logstats.format_report(stats, 1, {'aaa': 'acc/cont'})
+        self.assertTrue('  cdn        all          10  ' in report)
+        self.assertTrue('           9  aaa acc/cont\n' in report)
+        self.assertTrue('  2012-10-18 11:00:00  0.17\n' in report)
+
+    def test_collect_stats_split(self):
+        path = os.path.join(self.testdir, 'sos.log')
+        fp = open(path, 'w')
+        for i in xrange(100):
+            fp.write(access_line(hsh='hash%d' % (i % 7)) + '\n')
+        fp.close()
+        size = os.path.getsize(path)
+        jobs = logstats.split_jobs([path], split_size=size // 3)
+        self.assertEquals(len(jobs), 4)
+        self.assertEquals(sum(len(list(logstats.iter_lines(*job)))
+                              for job in jobs), 100)
+        for workers in (1, 2):
+            stats = logstats.collect_stats(CONF, [path], workers=workers,
+                                           split_size=size // 3)
+            self.assertEquals(stats.records, 100)
+            self.assertEquals(stats.hashes['hash0'], 15)
+            self.assertEquals(sum(stats.latency_counts()), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
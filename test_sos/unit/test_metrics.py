@@ -0,0 +1,156 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import socket
+import subprocess
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from sos import metrics
+from sos.sketch import HotHashes
+
+
+class FakeEmitter(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def incr(self, name, labels=(), value=1):
+        self.calls.append(('incr', name, labels, value))
+
+    def observe(self, name, seconds, labels=()):
+        self.calls.append(('observe', name, labels, seconds))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_aggregation(self):
+        emitter = FakeEmitter()
+        m = metrics.Metrics([emitter], buckets=(0.01, 0.1))
+        m.incr('sos_requests_total', ('cdn', 200))
+        m.incr('sos_requests_total', ('cdn', 200))
+        m.incr('sos_streamed_bytes_total', value=100)
+        for seconds in (0.001, 0.01, 0.05, 1):
+            m.observe('sos_subrequest_seconds', seconds, ('swift',))
+        self.assertEquals(m.counters, {
+            ('sos_requests_total', ('cdn', 200)): 2,
+            ('sos_streamed_bytes_total', ()): 100})
+        self.assertEquals(m.histograms,
+            {('sos_subrequest_seconds', ('swift',)): [2, 1, 1]})
+        self.assertEquals(len(emitter.calls), 7)
+        self.assertEquals(emitter.calls[-1],
+            ('observe', 'sos_subrequest_seconds', ('swift',), 1))
+
+    def test_prometheus(self):
+        m = metrics.Metrics(buckets=(0.01, 0.1))
+        m.incr('sos_requests_total', ('cdn', 404))
+        m.incr('sos_cdn_data_cache_total', ('hit',), 3)
+        m.observe('sos_subrequest_seconds', 0.05, ('metadata',))
+        m.observe('sos_subrequest_seconds', 0.5, ('metadata',))
+        lines = m.prometheus().splitlines()
+        pid = os.getpid()
+        self.assertTrue('# TYPE sos_requests_total counter' in lines)
+        self.assertTrue('sos_requests_total{handler="cdn",status="404",'
+                        'pid="%d"} 1' % pid in lines)
+        self.assertTrue('sos_cdn_data_cache_total{result="hit",'
+                        'pid="%d"} 3' % pid in lines)
+        self.assertTrue('# TYPE sos_subrequest_seconds histogram' in lines)
+        self.assertEquals([line for line in lines
+                           if line.startswith('sos_subrequest_seconds')], [
+            'sos_subrequest_seconds_bucket{phase="metadata",le="0.01",'
+            'pid="%d"} 0' % pid,
+            'sos_subrequest_seconds_bucket{phase="metadata",le="0.1",'
+            'pid="%d"} 1' % pid,
+            'sos_subrequest_seconds_bucket{phase="metadata",le="+Inf",'
+            'pid="%d"} 2' % pid,
+            'sos_subrequest_seconds_sum{phase="metadata",'
+            'pid="%d"} 0.550000' % pid,
+            'sos_subrequest_seconds_count{phase="metadata",'
+            'pid="%d"} 2' % pid])
+
+    def test_merge(self):
+        m = metrics.Metrics(buckets=(0.01, 0.1))
+        m.incr('sos_requests_total', ('cdn', 200))
+        m.observe('sos_subrequest_seconds', 0.05, ('swift',))
+        other = metrics.Metrics(buckets=(0.01, 0.1))
+        other.incr('sos_requests_total', ('cdn', 200), 2)
+        other.incr('sos_shed_total', ('cdn',))
+        other.observe('sos_subrequest_seconds', 0.5, ('swift',))
+        m.merge(json.loads(json.dumps(other.snapshot())))
+        self.assertEquals(m.counters, {
+            ('sos_requests_total', ('cdn', 200)): 3,
+            ('sos_shed_total', ('cdn',)): 1})
+        self.assertEquals(m.histograms,
+            {('sos_subrequest_seconds', ('swift',)): [0, 1, 1]})
+        self.assertEquals(m.histogram_sums,
+            {('sos_subrequest_seconds', ('swift',)): 0.55})
+        lines = m.prometheus(per_process=False).splitlines()
+        self.assertTrue('sos_requests_total{handler="cdn",status="200"} 3'
+                        in lines)
+        self.assertFalse([line for line in lines if 'pid=' in line])
+
+    def test_worker_stats(self):
+        testdir = mkdtemp()
+        try:
+            m = metrics.Metrics()
+            m.incr('sos_requests_total', ('cdn', 200))
+            hot = HotHashes(top_k=2)
+            for hsh in ('a', 'a', 'b'):
+                hot.add(hsh)
+            stats = metrics.WorkerStats(testdir, m, hot)
+            other = metrics.Metrics()
+            other.incr('sos_requests_total', ('cdn', 200), 4)
+            # another live worker and one that is gone
+            dead = subprocess.Popen(['true'])
+            dead.wait()
+            for pid in (os.getppid(), dead.pid):
+                with open(os.path.join(testdir, '%d.json' % pid), 'w') as fp:
+                    json.dump({'metrics': other.snapshot(),
+                               'hot': [['c', 100.0], ['b', 50.0]]}, fp)
+            self.assertTrue('sos_requests_total{handler="cdn",status="200"} 5'
+                            in stats.prometheus().splitlines())
+            self.assertEquals(sorted(os.listdir(testdir)), sorted(
+                ['%d.json' % os.getpid(), '%d.json' % os.getppid()]))
+            self.assertEquals([hsh for hsh, rate in stats.hot()], ['c', 'b'])
+            self.assertEquals([hsh for hsh, rate in stats.hot(3)],
+                              ['c', 'b', 'a'])
+        finally:
+            rmtree(testdir)
+
+    def test_statsd(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        try:
+            m = metrics.metrics_from_conf({
+                'statsd_host': '127.0.0.1',
+                'statsd_port': str(listener.getsockname()[1]),
+                'statsd_prefix': 'sos.proxy1'})
+            m.incr('sos_requests_total', ('origin_db', 201))
+            self.assertEquals(listener.recv(1024),
+                              'sos.proxy1.requests_total.origin_db.201:1|c')
+            m.observe('sos_subrequest_seconds', 0.0125, ('listing',))
+            self.assertEquals(listener.recv(1024),
+                'sos.proxy1.subrequest_seconds.listing:12.500|ms')
+        finally:
+            listener.close()
+        self.assertEquals(metrics.metrics_from_conf({}).emitters, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import os
+import unittest
+from contextlib import contextmanager
+from hashlib import md5
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from sos import migrate
+from sos.utils import Checkpoint, ClientException, split_hsh_obj_path
+
+
+class FakeLogger(object):
+
+    def __init__(self):
+        self.exceptions = []
+
+    def info(self, *args, **kwargs):
+        pass
+
+    def exception(self, *args, **kwargs):
+        self.exceptions.append(args)
+
+
+class FakeConn(object):
+    """
+    Keeps the origin account in a dict of container -> {name: body}.
+    Listing containers are dicts of name -> content_type.
+    """
+
+    def __init__(self, containers):
+        self.containers = containers
+
+    def get_container(self, container, marker='', limit=None):
+        if '/' not in container:
+            # an origin account listing
+            return {}, [{'name': name} for name in sorted(
+                c.split('/', 1)[1] for c in self.containers
+                if c.startswith(container + '/')) if name > marker][:limit]
+        names = sorted(n for n in self.containers.get(container, {})
+                       if n > marker)[:limit]
+        rows = []
+        for name in names:
+            val = self.containers[container][name]
+            rows.append({'name': name, 'content_type': val})
+        return {}, rows
+
+    def get_object(self, container, obj):
+        return {}, self.containers[container][obj]
+
+    def head_object(self, container, obj):
+        try:
+            body = self.containers[container][obj]
+        except KeyError:
+            raise ClientException('not found', http_status=404)
+        return {'etag': md5(body).hexdigest()}
+
+    def put_object(self, container, obj, body, etag=None):
+        self.containers.setdefault(container, {})[obj] = body
+
+    def delete_object(self, container, obj):
+        del self.containers[container][obj]
+
+
+class FakeConnPool(object):
+
+    def __init__(self, containers):
+        self.conn = FakeConn(containers)
+
+    @contextmanager
+    def item(self):
+        yield self.conn
+
+
+class TestMigrator(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.conf = {'hash_path_suffix': 'testing',
+                     'number_hash_id_containers': '4'}
+        self.containers = dict(('.origin/.hash_%d' % i, {})
+                               for i in xrange(4))
+        self.migrator = self._migrator()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def _migrator(self):
+        return migrate.Migrator(self.conf, FakeConnPool(self.containers),
+            Checkpoint(os.path.join(self.testdir, 'checkpoint')),
+            FakeLogger())
+
+    def _hash_cont(self, hsh):
+        return split_hsh_obj_path(
+            self.migrator.origin.get_hsh_obj_path(hsh))[0]
+
+    def test_parse_legacy(self):
+        hsh = self.migrator.legacy_hash_path('acc', 'my cont')
+        hash_data = self.migrator.parse_legacy(json.dumps(
+            {'account': 'acc', 'container': 'my%20cont', 'ttl': '1234',
+             'cdn_enabled': 'true', 'logs_enabled': 'false'}), hsh)
+        self.assertEquals(hash_data.container, 'my cont')
+        self.assertEquals(hash_data.ttl, 1234)
+        self.assertTrue(hash_data.cdn_enabled)
+        self.assertFalse(hash_data.logs_enabled)
+
+        # literal % in a current style object is left alone
+        hsh = self.migrator.origin.hash_path('acc', '100%25')
+        hash_data = self.migrator.parse_legacy(json.dumps(
+            {'account': 'acc', 'container': '100%25', 'ttl': 1234,
+             'cdn_enabled': True, 'logs_enabled': False}), hsh)
+        self.assertEquals(hash_data.container, '100%25')
+
+        self.assertRaises(ValueError, self.migrator.parse_legacy,
+                          '{"ttl": 5}', hsh)
+        self.assertRaises(ValueError, self.migrator.parse_legacy, 'junk', hsh)
+
+    def test_migrate_moves_legacy_hash_obj(self):
+        old_hsh = self.migrator.legacy_hash_path('acc', 'my cont')
+        new_hsh = self.migrator.origin.hash_path('acc', 'my cont')
+        old_cont = self._hash_cont(old_hsh)
+        self.containers[old_cont][old_hsh] = json.dumps(
+            {'account': 'acc', 'container': 'my%20cont', 'ttl': '1234',
+             'cdn_enabled': 'True', 'logs_enabled': 'False'})
+        stats = self.migrator.run()
+        self.assertTrue(old_hsh not in self.containers[old_cont])
+        body = self.containers[self._hash_cont(new_hsh)][new_hsh]
+        self.assertEquals(json.loads(body)['container'], 'my cont')
+        self.assertEquals(stats['written'], 1)
+        self.assertEquals(stats['deleted'], 1)
+
+        # second run is a no-op
+        self.migrator = self._migrator()
+        os.unlink(self.migrator.checkpoint.path)
+        self.migrator.checkpoint.data = {}
+        stats = self.migrator.run()
+        self.assertEquals(stats['unchanged'], 1)
+        self.assertFalse(stats.get('written'))
+
+    def test_migrate_listing_row_without_hash_obj(self):
+        self.containers['.origin/acc'] = {'cont': 'x-cdn/true-1234-false',
+                                  'bad': 'x-cdn/junk'}
+        stats = self.migrator.run()
+        hsh = self.migrator.origin.hash_path('acc', 'cont')
+        data = json.loads(self.containers[self._hash_cont(hsh)][hsh])
+        self.assertEquals(data['ttl'], 1234)
+        self.assertEquals(stats['listing_rows'], 1)
+        self.assertEquals(stats['errors'], 1)
+
+    def test_checkpoint_keeps_failed_rows(self):
+        self.containers['.origin/acc'] = {'a': 'x-cdn/true-1234-false',
+                                          'b': 'x-cdn/junk',
+                                          'c': 'x-cdn/true-1234-false'}
+        stats = self.migrator.run()
+        self.assertEquals(stats['errors'], 1)
+        # the marker stops before the failed row and the container isn't done
+        self.assertEquals(Checkpoint(self.migrator.checkpoint.path).get(
+            '.origin/acc'), {'marker': 'a'})
+        self.containers['.origin/acc']['b'] = 'x-cdn/true-1234-false'
+        self.migrator = self._migrator()
+        stats = self.migrator.run()
+        self.assertFalse(stats.get('errors'))
+        self.assertEquals(stats['listing_rows'], 2)
+        hsh = self.migrator.origin.hash_path('acc', 'b')
+        self.assertTrue(hsh in self.containers[self._hash_cont(hsh)])
+        self.assertEquals(Checkpoint(self.migrator.checkpoint.path).get(
+            '.origin/acc'), {'done': True})
+
+    def test_checkpoint_resume(self):
+        self.containers['.origin/acc'] = {'cont': 'x-cdn/true-1234-false'}
+        self.migrator.checkpoint.set('.origin/acc', {'done': True})
+        self.migrator.run()
+        hsh = self.migrator.origin.hash_path('acc', 'cont')
+        self.assertTrue(hsh not in self.containers[self._hash_cont(hsh)])
+        self.assertEquals(Checkpoint(self.migrator.checkpoint.path).get(
+            '.origin/.hash_0'), {'done': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
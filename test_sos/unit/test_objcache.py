@@ -0,0 +1,94 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from sos import objcache
+
+
+def obj(body):
+    return objcache.CachedObject(body, 'etag', [], 0)
+
+
+class TestObjectCache(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = objcache.ObjectCache(max_bytes=10, max_object_size=5,
+                                     max_ttl=60)
+        self.assertEquals(cache.get('/a', 'etag', now=100), None)
+        self.assertTrue(cache.put('acc', 'cont', '/a', obj('aaaa'), 30,
+                                  now=100))
+        self.assertEquals(cache.etag('/a'), 'etag')
+        self.assertEquals(cache.get('/a', 'etag', now=129).body, 'aaaa')
+        self.assertEquals(cache.get('/a', 'etag', now=130), None)
+        self.assertEquals(cache.size, 0)
+        self.assertEquals(cache.etag('/a'), None)
+        # too big
+        self.assertFalse(cache.put('acc', 'cont', '/b', obj('bbbbbb'), 30))
+        # the ttl is capped at max_ttl
+        cache.put('acc', 'cont', '/a', obj('aaaa'), 3600, now=100)
+        self.assertEquals(cache.entries['/a', 'etag'][1].expires, 160)
+
+    def test_overwritten(self):
+        cache = objcache.ObjectCache()
+        cache.put('acc', 'cont', '/a', obj('aaaa'), 60)
+        self.assertEquals(cache.get('/a', None), None)
+        self.assertEquals(cache.etag('/a'), 'etag')
+        # swift has a new etag now, the old copy goes
+        self.assertEquals(cache.get('/a', 'etag2'), None)
+        self.assertEquals(cache.etag('/a'), None)
+        self.assertEquals(cache.size, 0)
+        self.assertEquals(cache.containers, {})
+        cache.put('acc', 'cont', '/a',
+                  objcache.CachedObject('bb', 'etag2', [], 0), 60)
+        self.assertEquals(cache.get('/a', 'etag2').body, 'bb')
+        cache.put('acc', 'cont', '/a', obj('aaaa'), 60)
+        self.assertEquals(cache.entries.keys(), [('/a', 'etag')])
+        self.assertEquals(cache.size, 4)
+
+    def test_admission(self):
+        cache = objcache.ObjectCache(max_bytes=8, max_object_size=8)
+        for i in xrange(3):
+            cache.get('/hot', 'etag')
+        cache.put('acc', 'cont', '/hot', obj('hhhh'), 60)
+        cache.get('/warm', 'etag')
+        cache.put('acc', 'cont', '/warm', obj('wwww'), 60)
+        # /warm is the least recently used now
+        cache.get('/hot', 'etag')
+        # looked up no more often than /warm, it stays out
+        cache.get('/cold', 'etag')
+        self.assertFalse(cache.put('acc', 'cont', '/cold', obj('cccc'), 60))
+        cache.get('/cold', 'etag')
+        self.assertTrue(cache.put('acc', 'cont', '/cold', obj('cccc'), 60))
+        self.assertEquals(cache.entries.keys(),
+                          [('/hot', 'etag'), ('/cold', 'etag')])
+        self.assertEquals(cache.size, 8)
+
+    def test_invalidate(self):
+        cache = objcache.ObjectCache()
+        cache.put('acc', 'cont', '/v1/acc/cont/a', obj('a'), 60)
+        cache.put('acc', 'cont', '/v1/acc/cont/b', obj('b'), 60)
+        cache.put('acc', 'cont2', '/v1/acc/cont2/a', obj('a'), 60)
+        cache.invalidate('acc', 'cont')
+        self.assertEquals(cache.entries.keys(),
+                          [('/v1/acc/cont2/a', 'etag')])
+        self.assertEquals(cache.etags.keys(), ['/v1/acc/cont2/a'])
+        self.assertEquals(cache.size, 1)
+        self.assertEquals(cache.containers.keys(), [('acc', 'cont2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
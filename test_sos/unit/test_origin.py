@@ -17,13 +17,21 @@ try:
     import simplejson as json
 except ImportError:
     import json
+import os
+import sqlite3
 import unittest
+from time import time
 from hashlib import md5
+from shutil import rmtree
+from tempfile import mkdtemp
+from urllib import quote
 
+from eventlet import sleep
 from webob import Request, Response
 from webob.exc import HTTPUnauthorized
 
 from sos import origin
+from sos.metrics import Metrics
 from swift.common import utils
 
 
@@ -122,6 +130,8 @@ class FakeMemcache(object):
     def __init__(self, override_get=''):
         self.store = {}
         self.timeouts = {}
+        self.deleted = []
+        self.multi_gets = []
         self.override_get = override_get
 
     def get(self, key):
@@ -135,7 +145,32 @@ class FakeMemcache(object):
         return True
 
     def delete(self, key):
-        raise Exception('delete called')
+        self.deleted.append(key)
+        self.store.pop(key, None)
+
+    def get_multi(self, keys, server_key):
+        self.multi_gets.append(server_key)
+        return [self.get(key) for key in keys]
+
+    def set_multi(self, mapping, server_key, serialize=True, timeout=0):
+        for key, value in mapping.iteritems():
+            self.set(key, value, serialize, timeout)
+
+
+class ClosingIter(object):
+    """
+    A response body that remembers being closed.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
 
 
 class FakeLogger(object):
@@ -147,6 +182,75 @@ class FakeLogger(object):
         self.debug_calls.append((args, kwargs))
 
 
+class FakeListingApp(object):
+    """
+    Keeps origin account containers in a dict of container ->
+    {name: content_type} and serves listings with marker, limit and prefix.
+    Object bodies are kept in a dict of (container, name) -> body.  The
+    (method, path) requests in failing get a 503.
+    """
+
+    def __init__(self):
+        self.containers = {}
+        self.bodies = {}
+        self.requests = []
+        self.failing = set()
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        self.requests.append((req.method, req.path_info))
+        if (req.method, req.path_info) in self.failing:
+            return Response(status=503)(env, start_response)
+        vsn, acc, cont, obj = origin.split_path(req.path_info, 2, 4, True)
+        marker = req.GET.get('marker', '')
+        if not isinstance(marker, unicode):
+            marker = marker.decode('utf-8')
+        prefix = req.GET.get('prefix', '')
+        if not isinstance(prefix, unicode):
+            prefix = prefix.decode('utf-8')
+        limit = int(req.GET.get('limit', 10000))
+        if not cont and req.method == 'GET':
+            rows = [{'name': name} for name in sorted(self.containers)
+                    if name > marker and name.startswith(prefix)]
+            return Response(body=json.dumps(rows[:limit]))(env,
+                                                           start_response)
+        if not cont:
+            return Response(status=201)(env, start_response)
+        if req.method == 'GET' and not obj and cont in self.containers:
+            rows = [{'name': name, 'content_type': content_type}
+                    for name, content_type in
+                    sorted(self.containers[cont].items())
+                    if name > marker and name.startswith(prefix)]
+            return Response(body=json.dumps(rows[:limit]))(env,
+                                                           start_response)
+        if req.method == 'HEAD' and not obj and cont in self.containers:
+            return Response(status=204)(env, start_response)
+        if req.method == 'HEAD' and \
+                obj and obj.decode('utf-8') in self.containers.get(cont, {}):
+            return Response(status=204)(env, start_response)
+        if req.method == 'PUT' and not obj:
+            self.containers.setdefault(cont, {})
+            return Response(status=201)(env, start_response)
+        if req.method == 'PUT':
+            self.containers.setdefault(cont, {})[obj.decode('utf-8')] = \
+                req.headers.get('content-type')
+            self.bodies[cont, obj] = req.body
+            return Response(status=201)(env, start_response)
+        if req.method == 'GET' and (cont, obj) in self.bodies and \
+                obj.decode('utf-8') in self.containers.get(cont, {}):
+            return Response(body=self.bodies[cont, obj])(env, start_response)
+        if req.method == 'POST' and \
+                obj and obj.decode('utf-8') in self.containers.get(cont, {}):
+            self.containers[cont][obj.decode('utf-8')] = \
+                req.headers.get('content-type')
+            return Response(status=202)(env, start_response)
+        if req.method == 'DELETE' and \
+                obj and obj.decode('utf-8') in self.containers.get(cont, {}):
+            del self.containers[cont][obj.decode('utf-8')]
+            return Response(status=204)(env, start_response)
+        return Response(status=404)(env, start_response)
+
+
 class TestHashData(unittest.TestCase):
 
     def test_init(self):
@@ -178,6 +282,43 @@ class TestHashData(unittest.TestCase):
         self.assertTrue(h.cdn_enabled)
         self.assertFalse(h.logs_enabled)
 
+    def test_slots(self):
+        h = origin.HashData('a', 'c', '123', True, False)
+        self.assertFalse(hasattr(h, '__dict__'))
+        self.assertRaises(AttributeError, setattr, h, 'junk', 1)
+
+    def test_create_from_memcache(self):
+        h = origin.HashData(u'a\u2603', 'c/d', '123', False, True)
+        memcache_str = h.get_memcache_str()
+        self.assertTrue(len(memcache_str) < len(h.get_json_str()))
+        h2 = origin.HashData.create_from_memcache(memcache_str)
+        self.assertEquals(h2.account, u'a\u2603')
+        self.assertEquals(h2.container, u'c/d')
+        self.assertEquals(h2.ttl, 123)
+        self.assertFalse(h2.cdn_enabled)
+        self.assertTrue(h2.logs_enabled)
+
+    def test_create_from_memcache_json(self):
+        h = origin.HashData.create_from_memcache(
+            str(origin.HashData('a', 'c', '123', True, False)))
+        self.assertEquals(h.account, 'a')
+        self.assertEquals(h.ttl, 123)
+        self.assertTrue(h.cdn_enabled)
+
+    def test_create_from_memcache_bad(self):
+        good = origin.HashData('acc', 'c', '123', True, False)
+        memcache_str = good.get_memcache_str()
+        self.assertRaises(ValueError, origin.HashData.create_from_memcache,
+                          memcache_str[:5])
+        self.assertRaises(ValueError, origin.HashData.create_from_memcache,
+                          memcache_str[:origin.HASH_DATA_HEADER.size + 1])
+        self.assertRaises(ValueError, origin.HashData.create_from_memcache,
+                          '\x09' + memcache_str[1:])
+        self.assertRaises(ValueError, origin.HashData.create_from_memcache,
+                          '{"ttl": 5}')
+        self.assertRaises(ValueError, origin.HashData.create_from_memcache,
+                          '')
+
 
 class TestOriginBase(unittest.TestCase):
 
@@ -190,7 +331,7 @@ class TestOriginBase(unittest.TestCase):
         env = {'swift.cache': memcache}
         hsh = self.origin_base.hash_path('a', 'c')
         path = self.origin_base.get_hsh_obj_path(hsh)
-        key = self.origin_base.cdn_data_memcache_key(path)
+        key = self.origin_base.cdn_data_memcache_key(hsh)
         make_pre_authed_request_calls = []
 
         def _make_pre_authed_request(*args, **kwargs):
@@ -215,6 +356,113 @@ class TestOriginBase(unittest.TestCase):
         self.assertEquals(self.origin_base.get_cdn_data(env, path), None)
         self.assertEquals(len(make_pre_authed_request_calls), 0)
 
+    def test_jump_placement(self):
+        hashes = [md5(str(i)).hexdigest() for i in xrange(2000)]
+        for hsh in hashes:
+            self.assertTrue(0 <= origin.jump_placement(hsh, 100) < 100)
+        moved = [hsh for hsh in hashes if origin.jump_placement(hsh, 100) !=
+                 origin.jump_placement(hsh, 110)]
+        # only the hashes landing in the 10 new containers move
+        self.assertTrue(0 < len(moved) < 400)
+        for hsh in moved:
+            self.assertTrue(origin.jump_placement(hsh, 110) >= 100)
+        self.assertRaises(ValueError, origin.jump_placement, 'one', 100)
+
+    def test_placement_conf(self):
+        conf = origin.OriginServer._translate_conf({'sos_conf': FakeConf()})
+        self.assertFalse(self.origin_base.resharding)
+        self.assertEquals(self.origin_base.get_prev_hsh_obj_path('ab'), None)
+        self.assertEquals(len(self.origin_base.hash_container_names()), 100)
+        conf['hash_placement'] = 'junk'
+        self.assertRaises(origin.InvalidConfiguration, origin.OriginBase,
+                          FakeApp(), conf, FakeLogger())
+        conf['hash_placement'] = 'jump'
+        conf['previous_hash_placement'] = 'mod'
+        conf['number_hash_id_containers'] = '150'
+        base = origin.OriginBase(FakeApp(), conf, FakeLogger())
+        self.assertTrue(base.resharding)
+        self.assertEquals(len(base.hash_container_names()), 150)
+        hsh = md5('a').hexdigest()
+        self.assertEquals(base.get_hsh_obj_path(hsh),
+            '/v1/.origin/.hash_%d/%s' % (origin.jump_placement(hsh, 150), hsh))
+        self.assertEquals(base.get_prev_hsh_obj_path(hsh),
+            '/v1/.origin/.hash_%d/%s' % (int(hsh, 16) % 100, hsh))
+
+    def test_origin_account_placement(self):
+        conf = origin.OriginServer._translate_conf({'sos_conf': FakeConf()})
+        conf['origin_accounts'] = '.o0,.o1,.o2,.o3'
+        base = origin.OriginBase(FakeApp(), conf, FakeLogger())
+        self.assertFalse(base.resharding)
+        conf['origin_accounts'] += ',.o4'
+        conf['previous_origin_accounts'] = '.o0,.o1,.o2,.o3'
+        grown = origin.OriginBase(FakeApp(), conf, FakeLogger())
+        self.assertTrue(grown.resharding)
+        accounts = ['acc%d' % i for i in xrange(500)]
+        moved = [acc for acc in accounts if base.get_origin_account(acc) !=
+                 grown.get_origin_account(acc)]
+        # only the accounts landing in the new origin account move
+        self.assertTrue(0 < len(moved) < 200)
+        self.assertEquals(set(grown.get_origin_account(acc)
+                              for acc in moved), set(['.o4']))
+        hashes = [base.hash_path(acc, 'cont') for acc in accounts]
+        moved = [hsh for hsh in hashes if base.get_hsh_origin_account(hsh) !=
+                 grown.get_hsh_origin_account(hsh)]
+        self.assertTrue(0 < len(moved) < 200)
+        for hsh in moved:
+            self.assertEquals(grown.get_prev_hsh_obj_path(hsh),
+                              base.get_hsh_obj_path(hsh))
+        self.assertEquals(grown.get_prev_hsh_obj_path(
+            [hsh for hsh in hashes if hsh not in moved][0]), None)
+        self.assertEquals(len(grown.hash_container_paths()), 500)
+        self.assertEquals(grown.all_origin_accounts(),
+                          ['.o0', '.o1', '.o2', '.o3', '.o4'])
+
+        acc = [acc for acc in accounts if base.get_origin_account(acc) !=
+               grown.get_origin_account(acc)][0]
+        hsh = base.hash_path(acc, 'cont')
+        self.assertEquals(grown.listing_locations(acc), [
+            ('.o4', acc), (base.get_origin_account(acc), acc)])
+        self.assertEquals(grown.get_prev_listing_location(acc, hsh),
+                          (base.get_origin_account(acc), acc))
+        self.assertEquals(base.listing_locations(acc),
+                          [(base.get_origin_account(acc), acc)])
+        self.assertEquals(base.get_prev_listing_location(acc, hsh), None)
+
+    def test_get_cdn_data_resharding(self):
+        conf = origin.OriginServer._translate_conf({'sos_conf': FakeConf()})
+        conf['previous_number_hash_id_containers'] = '50'
+        base = origin.OriginBase(FakeApp(), conf, FakeLogger())
+        # find a container that moves
+        for i in xrange(100):
+            hsh = base.hash_path('a', 'c%d' % i)
+            prev_path = base.get_prev_hsh_obj_path(hsh)
+            if prev_path:
+                break
+        path = base.get_hsh_obj_path(hsh)
+        self.assertNotEquals(path, prev_path)
+        calls = []
+
+        def _make_pre_authed_request(env, method, path, **kwargs):
+            calls.append(path)
+            resp = PropertyObject()
+            resp.status_int = 404
+            if path == prev_path:
+                resp.status_int = 200
+                resp.body = origin.HashData('a', 'c%d' % i, 1234, True,
+                                            False).get_json_str()
+            req = PropertyObject()
+            req.get_response = lambda *a, **kwargs: resp
+            return req
+
+        make_pre_authed_request_orig = origin.make_pre_authed_request
+        try:
+            origin.make_pre_authed_request = _make_pre_authed_request
+            hash_data = base.get_cdn_data({}, path)
+        finally:
+            origin.make_pre_authed_request = make_pre_authed_request_orig
+        self.assertEquals(calls, [path, prev_path])
+        self.assertEquals(hash_data.ttl, 1234)
+
 
 class TestCdnHandler(unittest.TestCase):
 
@@ -376,6 +624,267 @@ class TestOrigin(unittest.TestCase):
                      'X-Origin-Admin-Key': 'unittest'})
         self.assertRaises(Exception, req.get_response, self.test_origin)
 
+    def test_admin_export(self):
+        app = FakeListingApp()
+        test_origin = origin.filter_factory({'sos_conf': FakeConf()})(app)
+        admin_headers = {'X-Origin-Admin-User': '.origin_admin',
+                         'X-Origin-Admin-Key': 'unittest'}
+        resp = Request.blank('/origin/.prep', environ={'REQUEST_METHOD':
+            'PUT'}, headers=admin_headers).get_response(test_origin)
+        self.assertEquals(resp.status_int, 204)
+        for path in ('/v1/acc1/c1', '/v1/acc1/c2', '/v1/acc1/c3',
+                     '/v1/acc2/c1', '/v1/acc2/c\xc3\xa9'):
+            req = Request.blank('http://origin_db.com:8080' + path,
+                                environ={'REQUEST_METHOD': 'PUT'})
+            self.assertEquals(req.get_response(test_origin).status_int, 201)
+
+        def export(query=''):
+            resp = Request.blank('/origin/.export' + query,
+                headers=admin_headers).get_response(test_origin)
+            self.assertEquals(resp.status_int, 200)
+            self.assertEquals(resp.content_type, 'application/x-ndjson')
+            return [json.loads(line) for line in resp.body.splitlines()]
+
+        resp = Request.blank('/origin/.export').get_response(test_origin)
+        self.assertEquals(resp.status_int, 403)
+        resp = Request.blank('/origin/.export', environ={'REQUEST_METHOD':
+            'POST'}, headers=admin_headers).get_response(test_origin)
+        self.assertEquals(resp.status_int, 405)
+        resp = Request.blank('/origin/.export?checkpoint=.hash_1/x/y',
+            headers=admin_headers).get_response(test_origin)
+        self.assertEquals(resp.status_int, 400)
+
+        orig_page_size = origin.LISTING_PAGE_SIZE
+        orig_checkpoint_rows = origin.EXPORT_CHECKPOINT_ROWS
+        try:
+            origin.LISTING_PAGE_SIZE = 2
+            origin.EXPORT_CHECKPOINT_ROWS = 2
+            lines = export()
+        finally:
+            origin.LISTING_PAGE_SIZE = orig_page_size
+            origin.EXPORT_CHECKPOINT_ROWS = orig_checkpoint_rows
+        self.assertEquals(lines[-1], {'done': True})
+        rows = [line for line in lines if 'account' in line]
+        self.assertEquals([(row['account'], row['container']) for row in rows],
+            [('acc1', 'c1'), ('acc1', 'c2'), ('acc1', 'c3'), ('acc2', 'c1'),
+             ('acc2', u'c\xe9')])
+        base = origin.OriginBase(None, {'hash_path_suffix': 'testing'}, None)
+        self.assertEquals(rows[4]['hash'],
+                          base.hash_path('acc2', 'c\xc3\xa9'))
+        self.assertEquals(rows[0]['ttl'], 259200)
+        self.assertTrue(rows[0]['cdn_enabled'])
+        self.assertFalse(rows[0]['log_retention'])
+        self.assertTrue('x-cdn-uri' in rows[0])
+        checkpoints = [line['checkpoint'] for line in lines
+                       if 'checkpoint' in line]
+        self.assertEquals(checkpoints, ['.origin/acc1/c2', '.origin/acc2/c1'])
+
+        # resuming picks up right after the checkpoint
+        for checkpoint, expected in zip(checkpoints, (rows[2:], rows[4:])):
+            lines = export('?checkpoint=' + quote(checkpoint))
+            self.assertEquals(lines[-1], {'done': True})
+            self.assertEquals(lines[:-1], expected)
+
+    def test_admin_export_listing_shard_change(self):
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'number_listing_shards = 2')
+        fake_conf.data.insert(1, 'previous_number_listing_shards = 1')
+        fake_conf.data.insert(1, 'origin_accounts = .origin0, .origin1')
+        fake_conf.data.insert(1, 'previous_origin_accounts = .origin0')
+        app = FakeListingApp()
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+        base = origin.OriginBase(None, {'hash_path_suffix': 'testing',
+                                        'number_listing_shards': '2'}, None)
+        old = origin.gen_listing_content_type(True, 1234, False)
+        new = origin.gen_listing_content_type(False, 1234, False)
+        # c1 hasn't been moved yet, c2 has but its old row is still there
+        app.containers['acc'] = {u'c1': old, u'c2': old}
+        for cont in ('c2', 'c3'):
+            app.containers.setdefault(base.get_listing_cont('acc',
+                base.hash_path('acc', cont)), {})[cont.decode('utf-8')] = new
+        resp = Request.blank('/origin/.export', headers={
+            'X-Origin-Admin-User': '.origin_admin',
+            'X-Origin-Admin-Key': 'unittest'}).get_response(test_origin)
+        lines = [json.loads(line) for line in resp.body.splitlines()]
+        self.assertEquals(lines[-1], {'done': True})
+        # the fake swift lists the same containers in both origin accounts
+        # but each container is only exported once, from where it is kept
+        self.assertEquals(sorted((line['container'], line['cdn_enabled'])
+                                 for line in lines[:-1]),
+                          [('c1', True), ('c2', False), ('c3', False)])
+        # checkpoints in the previous origin accounts are still valid
+        resp = Request.blank('/origin/.export?checkpoint=' + quote(
+            '.origin0/acc/c1'), headers={
+            'X-Origin-Admin-User': '.origin_admin',
+            'X-Origin-Admin-Key': 'unittest'}).get_response(test_origin)
+        self.assertEquals(resp.status_int, 200)
+
+    def test_admin_setup_origin_accounts(self):
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'origin_accounts = .origin0, .origin1')
+        conf_data = list(fake_conf.data)
+        app = FakeListingApp()
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+        resp = Request.blank('/origin/.prep',
+            environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Origin-Admin-User': '.origin_admin',
+                     'X-Origin-Admin-Key': 'unittest'}).get_response(
+                     test_origin)
+        self.assertEquals(resp.status_int, 204)
+        self.assertEquals(len(app.requests), 202)
+        self.assertEquals(app.requests[0], ('PUT', '/v1/.origin0'))
+        self.assertEquals(app.requests[101], ('PUT', '/v1/.origin1'))
+        self.assertEquals(app.requests[201], ('PUT', '/v1/.origin1/.hash_99'))
+
+        # the listing lives in the account's origin account, the .hash obj
+        # in the one picked by the hash
+        del app.requests[:]
+        base = origin.OriginBase(None, origin.OriginServer._translate_conf(
+            {'sos_conf': FakeConf(data=conf_data)}), None)
+        for acc in ('acc', 'acc2', 'acc3', 'acc4'):
+            req = Request.blank('http://origin_db.com:8080/v1/%s/cont' % acc,
+                                environ={'REQUEST_METHOD': 'PUT'})
+            self.assertEquals(req.get_response(test_origin).status_int, 201)
+            hsh = base.hash_path(acc, 'cont')
+            self.assertTrue(('PUT', base.get_hsh_obj_path(hsh)) in
+                            app.requests)
+            self.assertTrue(('PUT', '/v1/%s/%s/cont' % (
+                base.get_origin_account(acc), acc)) in app.requests)
+            req = Request.blank('http://origin_db.com:8080/v1/%s' % acc,
+                                environ={'REQUEST_METHOD': 'GET'})
+            self.assertEquals(req.get_response(test_origin).body, 'cont\n')
+        self.assertEquals(set(base.get_origin_account(acc) for acc in
+                              ('acc', 'acc2', 'acc3', 'acc4')),
+                          set(['.origin0', '.origin1']))
+
+    def test_sqlite_metadata_store(self):
+        testdir = mkdtemp()
+        try:
+            fake_conf = FakeConf()
+            fake_conf.data[1:1] = ['metadata_store = sqlite',
+                'metadata_store_sqlite_path = %s' %
+                os.path.join(testdir, 'metadata.db')]
+            app = FakeListingApp()
+            test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+            memcache = FakeMemcache()
+
+            def req(method, path, host='origin_db.com', headers=None):
+                return Request.blank('http://%s:8080%s' % (host, path),
+                    environ={'REQUEST_METHOD': method,
+                             'swift.cache': memcache},
+                    headers=headers or {}).get_response(test_origin)
+
+            self.assertEquals(req('HEAD', '/v1/acc/cont').status_int, 404)
+            self.assertEquals(req('PUT', '/v1/acc/cont',
+                headers={'X-TTL': '1234'}).status_int, 201)
+            self.assertEquals(req('POST', '/v1/acc/cont',
+                headers={'X-Log-Retention': 'true'}).status_int, 202)
+            resp = req('HEAD', '/v1/acc/cont')
+            self.assertEquals(resp.status_int, 204)
+            self.assertEquals(resp.headers['x-ttl'], 1234)
+            self.assertEquals(resp.headers['x-log-retention'], 'True')
+            # the listing is still in swift but the metadata never is
+            self.assertEquals(req('GET', '/v1/acc').body, 'cont\n')
+            self.assertFalse([path for method, path in app.requests
+                              if '/.hash_' in path])
+            self.assertFalse([key for key in memcache.store
+                              if '/hash/' in key])
+
+            hsh = origin.OriginBase(None, {'hash_path_suffix': 'testing'},
+                                    None).hash_path('acc', 'cont')
+            app.containers['acc'] = {}
+            resp = req('GET', '/obj', host='%s.r1.origin_cdn.com' % hsh)
+            self.assertEquals(resp.status_int, 404)
+            self.assertEquals(app.requests[-1], ('GET', '/v1/acc/cont/obj'))
+
+            self.assertEquals(req('DELETE', '/v1/acc/cont').status_int, 204)
+            self.assertEquals(req('HEAD', '/v1/acc/cont').status_int, 404)
+            self.assertEquals(req('DELETE', '/v1/acc/cont').status_int, 404)
+        finally:
+            rmtree(testdir)
+
+    def test_sqlite_metadata_store_locked(self):
+        testdir = mkdtemp()
+        try:
+            db_path = os.path.join(testdir, 'metadata.db')
+            base = origin.OriginBase(None, {'hash_path_suffix': 'testing',
+                'metadata_store': 'sqlite',
+                'metadata_store_sqlite_path': db_path,
+                'metadata_store_sqlite_timeout': '0.05'}, FakeLogger())
+            store = base.metadata_store
+            hash_data = origin.HashData('acc', 'cont', 1234, True, False)
+            store.put({}, 'abc', hash_data)
+            # another worker holding the write lock
+            other = sqlite3.connect(db_path)
+            other.execute('BEGIN EXCLUSIVE')
+            try:
+                start = time()
+                self.assertRaises(origin.OriginDbFailure, store.put, {},
+                                  'abc', hash_data)
+                self.assertTrue(time() - start < 1)
+                self.assertEquals(store.get({}, 'abc').ttl, 1234)
+            finally:
+                other.rollback()
+                other.close()
+            self.assertTrue(store.delete({}, 'abc'))
+            self.assertEquals(store.get({}, 'abc'), None)
+        finally:
+            rmtree(testdir)
+
+    def test_origin_db_get_cached(self):
+        app = FakeListingApp()
+        test_origin = origin.filter_factory({'sos_conf': FakeConf()})(app)
+        memcache = FakeMemcache()
+        memcache.delete = lambda key: memcache.store.pop(key, None)
+
+        def req(method, path, headers=None):
+            return Request.blank('http://origin_db.com:8080%s' % path,
+                environ={'REQUEST_METHOD': method, 'swift.cache': memcache},
+                headers=headers or {}).get_response(test_origin)
+
+        self.assertEquals(req('PUT', '/v1/acc/cont1').status_int, 201)
+        resp = req('GET', '/v1/acc?format=json')
+        self.assertEquals(resp.status_int, 200)
+        etag = resp.headers['etag']
+        self.assertEquals([c['name'] for c in json.loads(resp.body)],
+                          ['cont1'])
+
+        # cached pages and 304s don't touch swift
+        del app.requests[:]
+        resp = req('GET', '/v1/acc?format=json')
+        self.assertEquals(resp.headers['etag'], etag)
+        self.assertEquals(resp.headers['content-type'], 'application/json')
+        self.assertEquals([c['name'] for c in json.loads(resp.body)],
+                          ['cont1'])
+        resp = req('GET', '/v1/acc?format=json',
+                   headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_int, 304)
+        self.assertEquals(resp.headers['etag'], etag)
+        self.assertEquals(app.requests, [])
+        resp = req('GET', '/v1/acc?format=json&limit=1',
+                   headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_int, 200)
+        self.assertNotEquals(resp.headers['etag'], etag)
+
+        # writes start a new generation
+        for method, path in (('PUT', '/v1/acc/cont2'),
+                             ('POST', '/v1/acc/cont2'),
+                             ('DELETE', '/v1/acc/cont2')):
+            self.assertEquals(req(method, path).status_int // 100, 2)
+            resp = req('GET', '/v1/acc?format=json',
+                       headers={'If-None-Match': etag})
+            self.assertEquals(resp.status_int, 200)
+            self.assertNotEquals(resp.headers['etag'], etag)
+            etag = resp.headers['etag']
+        self.assertEquals([c['name'] for c in json.loads(resp.body)],
+                          ['cont1'])
+
+    def test_invalid_metadata_store(self):
+        conf = origin.OriginServer._translate_conf({'sos_conf': FakeConf()})
+        conf['metadata_store'] = 'junk'
+        self.assertRaises(origin.InvalidConfiguration, origin.OriginBase,
+                          FakeApp(), conf, FakeLogger())
+
     def test_origin_db_valid_setup(self):
         fake_conf = FakeConf(data=['[sos]',
             'origin_cdn_host_suffixes = origin_cdn.com'])
@@ -615,8 +1124,10 @@ delete_enabled = true
         resp = req.get_response(test_origin)
         self.assertEquals(resp.status_int, 204)
 
+        memcache = FakeMemcache()
+
         def mock_memcache(env):
-            return FakeMemcache()
+            return memcache
         was_memcache = utils.cache_from_env
 
         try:
@@ -638,13 +1149,110 @@ delete_enabled = true
                 ])))
             req = Request.blank('http://origin_db.com:8080/v1/acc/cont',
                 environ={'REQUEST_METHOD': 'DELETE',})
-            try:
-                resp = req.get_response(test_origin)
-            except Exception, e:
-                self.assertEquals(str(e), 'delete called')
+            resp = req.get_response(test_origin)
+            base = origin.OriginBase(FakeApp(), test_origin.conf,
+                                     FakeLogger())
+            memcache_key = base.cdn_data_memcache_key(
+                base.hash_path('acc', 'cont'))
+            self.assertEquals(memcache.deleted,
+                              [memcache_key, 'sos-stale/' + memcache_key])
         finally:
             utils.cache_from_env = was_memcache
 
+    def test_origin_db_bulk(self):
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'bulk_batch_size = 2')
+        app = FakeListingApp()
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+        memcache = FakeMemcache()
+        memcache.delete = lambda key: memcache.store.pop(key, None)
+
+        def req(method, path, headers=None):
+            return Request.blank('http://origin_db.com:8080%s' % path,
+                environ={'REQUEST_METHOD': method, 'swift.cache': memcache},
+                headers=headers or {}).get_response(test_origin)
+
+        def bulk(method, path, headers=None):
+            resp = req(method, path, headers)
+            self.assertEquals(resp.status_int, 200)
+            return [json.loads(line) for line in resp.body.splitlines()]
+
+        self.assertEquals(req('DELETE', '/v1/acc').status_int, 404)
+        for cont in ('c1', 'c2', 'c3', 'c4', 'd1'):
+            self.assertEquals(req('PUT', '/v1/acc/' + cont).status_int, 201)
+        self.assertEquals(req('POST', '/v1/acc/c2',
+            headers={'X-CDN-Enabled': 'false'}).status_int, 202)
+        self.assertEquals(req('POST', '/v1/acc').status_int, 400)
+
+        lines = bulk('POST', '/v1/acc', headers={'X-CDN-Enabled': 'false'})
+        self.assertEquals([line.get('marker') for line in lines],
+                          ['c2', 'c4', 'd1', None])
+        self.assertEquals(lines[0]['updated'], 1)
+        self.assertEquals(lines[0]['unchanged'], 1)
+        self.assertEquals(lines[-1], {'done': True, 'deleted': 0,
+            'not_found': 0, 'updated': 4, 'unchanged': 1, 'failed': 0})
+        resp = req('HEAD', '/v1/acc/c1')
+        self.assertEquals(resp.headers['x-cdn-enabled'], 'False')
+        self.assertEquals(app.containers['acc']['c1'],
+                          'x-cdn/False-259200-False')
+
+        # filtered, resumable and idempotent
+        lines = bulk('POST', '/v1/acc?marker=c3&enabled=false',
+                     headers={'X-CDN-Enabled': 'true'})
+        self.assertEquals(lines[-1]['updated'], 2)
+        self.assertEquals(app.containers['acc']['c3'],
+                          'x-cdn/False-259200-False')
+        self.assertEquals(app.containers['acc']['c4'],
+                          'x-cdn/True-259200-False')
+        # the marker stops before a row that failed, even when later
+        # batches go well, so resuming from it retries the row
+        listing_post = [(method, path) for method, path in app.requests
+                        if method == 'POST' and path.endswith('/acc/c2')][0]
+        app.failing.add(listing_post)
+        lines = bulk('POST', '/v1/acc', headers={'X-CDN-Enabled': 'true'})
+        self.assertEquals([line.get('marker') for line in lines],
+                          ['c1', 'c1', 'c1', None])
+        self.assertEquals(lines[-1]['failed'], 1)
+        app.failing.clear()
+        lines = bulk('POST', '/v1/acc?marker=c1',
+                     headers={'X-CDN-Enabled': 'true'})
+        self.assertEquals([line.get('marker') for line in lines],
+                          ['c3', 'd1', None])
+        self.assertEquals(lines[-1]['failed'], 0)
+        self.assertEquals(app.containers['acc']['c2'],
+                          'x-cdn/True-259200-False')
+
+        lines = bulk('DELETE', '/v1/acc?prefix=c')
+        self.assertEquals(lines[-1]['deleted'], 4)
+        self.assertEquals(app.containers['acc'].keys(), [u'd1'])
+        self.assertEquals(req('HEAD', '/v1/acc/c1').status_int, 404)
+        lines = bulk('DELETE', '/v1/acc?prefix=c')
+        self.assertEquals(lines, [{'done': True, 'deleted': 0,
+            'not_found': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}])
+        self.assertEquals(req('HEAD', '/v1/acc/d1').status_int, 204)
+
+    def test_origin_db_delete_resharding(self):
+        fake_conf = FakeConf(data='''[sos]
+origin_admin_key = unittest
+origin_cdn_host_suffixes = origin_cdn.com
+origin_db_hosts = origin_db.com
+hash_path_suffix = testing
+previous_number_hash_id_containers = 50
+'''.split('\n'))
+        test_origin = origin.filter_factory(
+            {'sos_conf': fake_conf})
+        app = FakeApp(iter([
+            ('404 Not Found', {}, ''), # DELETE .hash obj
+            ('204 No Content', {}, ''), # DELETE previous .hash obj
+            ('204 No Content', {}, '') # DELETE listing
+            ]))
+        test_origin = test_origin(app)
+        req = Request.blank('http://origin_db.com:8080/v1/acc/cont',
+            environ={'REQUEST_METHOD': 'DELETE',})
+        resp = req.get_response(test_origin)
+        self.assertEquals(resp.status_int, 204)
+        self.assertEquals(app.calls, 3)
+
     def test_origin_db_delete_bad_request(self):
         fake_conf = FakeConf(data='''[sos]
 origin_admin_key = unittest
@@ -781,10 +1389,12 @@ delete_enabled = true
                 'container': 'cont', 'ttl': 5555, 'logs_enabled': True,
                 'cdn_enabled': False}))
             def check_set(key, value, serialize=True, timeout=0):
-                data = json.loads(value)
-                if data['ttl'] != 5555:
+                if key.startswith('sos-listing'):
+                    return
+                data = origin.HashData.create_from_memcache(value)
+                if data.ttl != 5555:
                     raise Exception('Memcache not working')
-                if data['cdn_enabled'] != True:
+                if data.cdn_enabled != True:
                     raise Exception('Memcache not working')
             fake_mem.set = check_set
             return fake_mem
@@ -886,6 +1496,80 @@ hash_path_suffix = testing
         self.assert_('<ttl>1234</ttl>' in resp.body)
         self.assertEquals(resp.status_int, 200)
 
+    def test_origin_db_get_stats(self):
+        listing_data = json.dumps([
+            {'name': 'test1', 'content_type': 'x-cdn/true-1234-false'},
+            {'name': 'test2', 'content_type': 'x-cdn/true-2234-false'},
+            {'name': 'test3', 'content_type': 'x-cdn/true-3234-false'}])
+        memcache = FakeMemcache()
+        memcache.set('sos-stats/acc/test1', {'count': 1, 'bytes': 10})
+        self.test_origin.app = FakeApp(iter([('200 Ok', {}, listing_data),
+            ('204 No Content', {'X-Container-Object-Count': '2',
+                                'X-Container-Bytes-Used': '20'}, ''),
+            ('404 Not Found', {}, '')]))
+        req = Request.blank(
+            'http://origin_db.com:8080/v1/acc?format=json&stats=true',
+            environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+        resp = req.get_response(self.test_origin)
+        self.assertEquals(resp.status_int, 200)
+        data = json.loads(resp.body)
+        self.assertEquals([(row.get('count'), row.get('bytes'))
+                           for row in data],
+                          [(1, 10), (2, 20), (None, None)])
+        self.assertEquals(self.test_origin.app.calls, 3)
+        # one memcache round trip for all the rows
+        self.assertEquals(memcache.multi_gets, ['sos-stats/acc'])
+        self.assertEquals(memcache.store['sos-stats/acc/test2'],
+                          {'count': 2, 'bytes': 20})
+        self.assertEquals(memcache.timeouts['sos-stats/acc/test2'], 60)
+        self.assertFalse('etag' in resp.headers)
+
+        self.test_origin.app = FakeApp(iter([('200 Ok', {}, listing_data),
+                                             ('404 Not Found', {}, '')]))
+        req = Request.blank(
+            'http://origin_db.com:8080/v1/acc?format=xml&stats=true',
+            environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+        resp = req.get_response(self.test_origin)
+        self.assertTrue('<count>1</count>' in resp.body)
+        self.assertTrue('<ttl>1234</ttl>' in resp.body)
+
+        # HEADs not done by the deadline leave their rows without stats
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'stats_timeout = 0.01')
+        listing_app = FakeApp(iter([('200 Ok', {}, listing_data)]))
+
+        def slow_app(env, start_response):
+            if env['REQUEST_METHOD'] == 'HEAD':
+                sleep(1)
+            return listing_app(env, start_response)
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(slow_app)
+        req = Request.blank(
+            'http://origin_db.com:8080/v1/acc?format=json&stats=true',
+            environ={'REQUEST_METHOD': 'GET'})
+        start = time()
+        resp = req.get_response(test_origin)
+        self.assertTrue(time() - start < 0.5)
+        self.assertEquals([row['name'] for row in json.loads(resp.body)],
+                          ['test1', 'test2', 'test3'])
+        self.assertFalse('count' in resp.body)
+
+        # and so does a slow memcache
+        listing_app.status_headers_body_iter = iter([
+            ('200 Ok', {}, listing_data)])
+
+        def slow_get_multi(keys, server_key):
+            sleep(1)
+            return [None] * len(keys)
+        memcache.get_multi = slow_get_multi
+        req = Request.blank(
+            'http://origin_db.com:8080/v1/acc?format=json&stats=true',
+            environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+        start = time()
+        resp = req.get_response(test_origin)
+        self.assertTrue(time() - start < 0.5)
+        self.assertEquals(len(json.loads(resp.body)), 3)
+        self.assertFalse('count' in resp.body)
+
     def test_origin_db_get_marker(self):
         listing_data = json.dumps([
             {'name': 'test1', 'content_type': 'x-cdn/false-1234-false'},
@@ -903,6 +1587,126 @@ hash_path_suffix = testing
         self.assert_('test3' in resp.body)
         self.assertEquals(resp.status_int, 200)
 
+    def test_split_listing_cont(self):
+        self.assertEquals(origin.split_listing_cont('acc'), 'acc')
+        self.assertEquals(origin.split_listing_cont('.listing_3_acc_x'),
+                          'acc_x')
+        self.assertEquals(origin.split_listing_cont('.hash_3'), None)
+        self.assertEquals(origin.split_listing_cont('.listing_x_acc'), None)
+
+    def test_origin_db_sharded_listing(self):
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'number_listing_shards = 3')
+        app = FakeListingApp()
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+        names = ['cont%02d' % i for i in xrange(20)]
+        for i, name in enumerate(names):
+            req = Request.blank('http://origin_db.com:8080/v1/acc/%s' % name,
+                environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-CDN-Enabled': str(i % 2 == 0)})
+            self.assertEquals(req.get_response(test_origin).status_int, 201)
+        self.assertEquals(sorted(cont for cont in app.containers
+                                 if not cont.startswith('.hash_')),
+                          ['.listing_0_acc', '.listing_1_acc',
+                           '.listing_2_acc'])
+        self.assertEquals(sum(len(app.containers['.listing_%d_acc' % i])
+                              for i in xrange(3)), 20)
+
+        def get(query):
+            req = Request.blank('http://origin_db.com:8080/v1/acc?' + query,
+                                environ={'REQUEST_METHOD': 'GET'})
+            resp = req.get_response(test_origin)
+            self.assertEquals(resp.status_int, 200)
+            return resp.body.split('\n')[:-1]
+
+        self.assertEquals(get(''), names)
+        self.assertEquals(get('marker=cont05&limit=4'), names[6:10])
+        self.assertEquals(get('enabled=true&marker=cont03&limit=3'),
+                          ['cont04', 'cont06', 'cont08'])
+
+        # paging through a shard
+        handler = origin.OriginDbHandler(app,
+            origin.OriginServer._translate_conf({'sos_conf': FakeConf()}),
+            FakeLogger())
+        handler.listing_page_size = 2
+        handler.num_listing_shards = 3
+        env = Request.blank('/').environ
+        del app.requests[:]
+        rows = list(handler._iter_listing_shard(env, '.origin',
+            '.listing_0_acc', handler._get_listing_page(env, '.origin',
+                                                        '.listing_0_acc', '',
+                                                        2)))
+        self.assertEquals([name for name, row in rows],
+                          sorted(app.containers['.listing_0_acc']))
+        self.assertEquals(len(app.requests), len(rows) // 2 + 1)
+
+        req = Request.blank('http://origin_db.com:8080/v1/acc/cont07',
+                            environ={'REQUEST_METHOD': 'DELETE'})
+        self.assertEquals(req.get_response(test_origin).status_int, 204)
+        self.assertEquals(get('marker=cont05&limit=3'),
+                          ['cont06', 'cont08', 'cont09'])
+
+        req = Request.blank('http://origin_db.com:8080/v1/nope',
+                            environ={'REQUEST_METHOD': 'GET'})
+        self.assertEquals(req.get_response(test_origin).status_int, 404)
+
+    def test_origin_db_listing_shard_change(self):
+        app = FakeListingApp()
+        test_origin = origin.filter_factory({'sos_conf': FakeConf()})(app)
+        names = ['cont%02d' % i for i in xrange(10)]
+        for name in names:
+            req = Request.blank('http://origin_db.com:8080/v1/acc/%s' % name,
+                                environ={'REQUEST_METHOD': 'PUT'})
+            self.assertEquals(req.get_response(test_origin).status_int, 201)
+        self.assertEquals(sorted(app.containers['acc']), names)
+
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'number_listing_shards = 3')
+        fake_conf.data.insert(1, 'previous_number_listing_shards = 1')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+
+        def get(query):
+            req = Request.blank('http://origin_db.com:8080/v1/acc?' + query,
+                                environ={'REQUEST_METHOD': 'GET'})
+            resp = req.get_response(test_origin)
+            self.assertEquals(resp.status_int, 200)
+            return resp.body.split('\n')[:-1]
+
+        self.assertEquals(get(''), names)
+        del app.requests[:]
+        self.assertEquals(get('marker=cont02&limit=2'), names[3:5])
+        self.assertEquals(set(path for method, path in app.requests
+                              if method == 'GET'),
+                          set(['/v1/.origin/acc', '/v1/.origin/.listing_0_acc',
+                               '/v1/.origin/.listing_1_acc',
+                               '/v1/.origin/.listing_2_acc']))
+
+        # a POST moves the row to its new shard
+        req = Request.blank('http://origin_db.com:8080/v1/acc/cont03',
+                            environ={'REQUEST_METHOD': 'POST'},
+                            headers={'X-TTL': '4321'})
+        self.assertEquals(req.get_response(test_origin).status_int, 202)
+        self.assertTrue('cont03' not in app.containers['acc'])
+        self.assertEquals(sum(len(app.containers.get('.listing_%d_acc' % i,
+                                                     {}))
+                              for i in xrange(3)), 1)
+        self.assertEquals(get(''), names)
+        # a row left behind in the previous shard loses to the moved one
+        app.containers['acc']['cont03'] = 'x-cdn/True-1234-False'
+        req = Request.blank('http://origin_db.com:8080/v1/acc?'
+                            'format=json&marker=cont02&limit=2',
+                            environ={'REQUEST_METHOD': 'GET'})
+        rows = json.loads(req.get_response(test_origin).body)
+        self.assertEquals([(row['name'], row['ttl']) for row in rows],
+                          [('cont03', 4321), ('cont04', 259200)])
+
+        # a DELETE finds the row in either shard
+        for name in ('cont03', 'cont04'):
+            req = Request.blank('http://origin_db.com:8080/v1/acc/%s' % name,
+                                environ={'REQUEST_METHOD': 'DELETE'})
+            self.assertEquals(req.get_response(test_origin).status_int, 204)
+        self.assertEquals(get(''), names[:3] + names[5:])
+
     def test_origin_db_head(self):
         prev_data = json.dumps({'account': 'acc', 'container': 'cont',
                 'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': False})
@@ -1008,6 +1812,632 @@ hash_path_suffix = testing
         self.assertEquals(resp.status_int, 200)
         self.assertEquals(resp.body, 'Test obj body.')
 
+    def test_cdn_get_timing(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+            environ={'REQUEST_METHOD': 'GET', 'swift.cache': FakeMemcache()})
+        self.test_origin.app = FakeApp(iter([
+            ('204 No Content', {}, prev_data), # call to _get_cdn_data
+            ('200 Ok', {}, 'Test obj body.')])) #call to get obj
+        resp = req.get_response(self.test_origin)
+        self.assertEquals(resp.status_int, 200)
+        self.assertFalse('x-sos-timing' in resp.headers)
+
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'timing_header = true')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('204 No Content', {}, prev_data),
+                          ('200 Ok', {}, 'Test obj body.')])))
+        req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+            environ={'REQUEST_METHOD': 'GET', 'swift.cache': FakeMemcache()})
+        resp = req.get_response(test_origin)
+        self.assertEquals(resp.status_int, 200)
+        timings = [timing.split(':')
+                   for timing in resp.headers['x-sos-timing'].split(',')]
+        self.assertEquals([phase for phase, elapsed in timings],
+                          ['memcache', 'metadata', 'swift', 'sos', 'total'])
+        self.assertAlmostEquals(
+            sum(float(elapsed) for phase, elapsed in timings[:-1]),
+            float(timings[-1][1]), places=3)
+
+    def test_metrics(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        memcache = FakeMemcache()
+        self.test_origin.app = FakeApp(iter([
+            ('204 No Content', {}, prev_data), # call to _get_cdn_data
+            ('200 Ok', {}, 'Test obj body.'),
+            ('200 Ok', {}, 'Test obj body.'),
+            ('200 Ok', {'Content-Length': '10000000000000'}, '')]))
+        for i in xrange(3):
+            req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+                environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+            resp = req.get_response(self.test_origin)
+            resp.body
+        self.assertEquals(resp.status_int, 400)
+        counters = self.test_origin.metrics.counters
+        self.assertEquals(counters[('sos_requests_total', ('cdn', 200))], 2)
+        self.assertEquals(counters[('sos_requests_total', ('cdn', 400))], 1)
+        self.assertEquals(counters[('sos_cdn_data_cache_total', ('miss',))],
+                          1)
+        self.assertEquals(counters[('sos_cdn_data_cache_total', ('hit',))],
+                          2)
+        self.assertEquals(counters[('sos_streamed_bytes_total', ())], 28)
+        self.assertEquals(counters[('sos_oversized_rejected_total', ())], 1)
+        self.assertEquals(sum(self.test_origin.metrics.histograms[
+            ('sos_subrequest_seconds', ('swift',))]), 3)
+
+        resp = Request.blank('/origin/.stats').get_response(self.test_origin)
+        self.assertEquals(resp.status_int, 403)
+        resp = Request.blank('/origin/.stats',
+            headers={'X-Origin-Admin-User': '.origin_admin',
+                     'X-Origin-Admin-Key': 'unittest'}).get_response(
+                     self.test_origin)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.content_type, 'text/plain')
+        self.assertTrue('sos_oversized_rejected_total{pid="%d"} 1' %
+                        os.getpid() in resp.body.splitlines())
+
+    def test_worker_stats(self):
+        testdir = mkdtemp()
+        try:
+            fake_conf = FakeConf()
+            fake_conf.data.insert(1, 'worker_stats_dir = %s' % testdir)
+            test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+                FakeApp())
+            # no dump loop to outlive testdir
+            test_origin.worker_stats.pid = os.getpid()
+            other = Metrics()
+            other.incr('sos_oversized_rejected_total', (), 2)
+            with open(os.path.join(testdir, '%d.json' % os.getppid()),
+                      'w') as fp:
+                json.dump({'metrics': other.snapshot(), 'hot': []}, fp)
+            test_origin.metrics.incr('sos_oversized_rejected_total')
+            resp = Request.blank('/origin/.stats',
+                headers={'X-Origin-Admin-User': '.origin_admin',
+                         'X-Origin-Admin-Key': 'unittest'}).get_response(
+                         test_origin)
+            self.assertEquals(resp.status_int, 200)
+            self.assertTrue('sos_oversized_rejected_total 3' in
+                            resp.body.splitlines())
+            self.assertTrue('%d.json' % os.getpid() in os.listdir(testdir))
+        finally:
+            rmtree(testdir)
+
+    def test_hot_hashes(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        memcache = FakeMemcache()
+        self.test_origin.app = FakeApp(iter([
+            ('204 No Content', {}, prev_data), # call to _get_cdn_data
+            ('200 Ok', {}, 'Test obj body.'),
+            ('200 Ok', {}, 'Test obj body.'),
+            ('200 Ok', {}, 'Test obj body.'),
+            ('404 Not Found', {}, ''), # call to _get_cdn_data
+            ('404 Not Found', {}, '')]))
+        for hsh in ('1234', '1234', '5678', '1234'):
+            req = Request.blank('http://%s.r3.origin_cdn.com:8080/obj1.jpg' %
+                hsh, environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+            req.get_response(self.test_origin).body
+        self.assertEquals([hsh for hsh, rate in
+                           self.test_origin.hot_hashes.top()],
+                          ['1234', '5678'])
+
+        resp = Request.blank('/origin/.hot').get_response(self.test_origin)
+        self.assertEquals(resp.status_int, 403)
+        admin_headers = {'X-Origin-Admin-User': '.origin_admin',
+                         'X-Origin-Admin-Key': 'unittest'}
+        resp = Request.blank('/origin/.hot?limit=1', environ={
+            'swift.cache': memcache}, headers=admin_headers).get_response(
+            self.test_origin)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.content_type, 'application/json')
+        rows = json.loads(resp.body)
+        self.assertEquals(len(rows), 1)
+        self.assertTrue(rows[0].pop('rate') > 0)
+        self.assertEquals(rows[0], {'hash': '1234', 'account': 'acc',
+                                    'container': 'cont', 'cdn_enabled': True})
+        resp = Request.blank('/origin/.hot', environ={'swift.cache': memcache},
+            headers=admin_headers).get_response(self.test_origin)
+        self.assertEquals([row.get('account') for row in json.loads(resp.body)],
+                          ['acc', None])
+        resp = Request.blank('/origin/.hot?limit=x',
+            headers=admin_headers).get_response(self.test_origin)
+        self.assertEquals(resp.status_int, 400)
+        self.test_origin.hot_hashes = None
+        resp = Request.blank('/origin/.hot',
+            headers=admin_headers).get_response(self.test_origin)
+        self.assertEquals(resp.status_int, 404)
+
+    def test_cdn_rate_limit(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'ratelimit_hash_rate = 0.5')
+        fake_conf.data.insert(1, 'ratelimit_hash_burst = 2')
+        fake_conf.data.insert(1, 'ratelimit_account_rate = 0.5')
+        fake_conf.data.insert(1, 'ratelimit_account_burst = 3')
+        memcache = FakeMemcache()
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('204 No Content', {}, prev_data)] +
+                         [('200 Ok', {}, 'Test obj body.')] * 2 +
+                         [('204 No Content', {}, prev_data),
+                          ('200 Ok', {}, 'Test obj body.')])))
+
+        def get(hsh):
+            req = Request.blank('http://%s.r3.origin_cdn.com:8080/obj1.jpg' %
+                hsh, environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+            return req.get_response(test_origin)
+
+        self.assertEquals([get('1234').status_int for i in xrange(3)],
+                          [200, 200, 503])
+        resp = get('1234')
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(resp.headers['Retry-After'], '2')
+        self.assertEquals(resp.headers['Cache-Control'], 'max-age:2, public')
+        # another hash of the same account gets its own hash bucket but
+        # shares the account one
+        self.assertEquals([get('5678').status_int for i in xrange(2)],
+                          [200, 503])
+        counters = test_origin.metrics.counters
+        self.assertEquals(counters[('sos_ratelimited_total', ('hash',))], 2)
+        self.assertEquals(counters[('sos_ratelimited_total', ('account',))],
+                          1)
+
+    def test_concurrency_limit(self):
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'origin_db_concurrency = 1')
+        fake_conf.data.insert(1, 'origin_db_queue_size = 0')
+        listing_data = json.dumps([
+            {'name': 'test1', 'content_type': 'x-cdn/true-1234-false'}])
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('200 Ok', {}, listing_data)] * 2 +
+                         [('204 No Content', {}, '')])))
+
+        def call(url, method='GET'):
+            env = Request.blank(url, environ={'REQUEST_METHOD': method,
+                                              'swift.cache': FakeMemcache()}
+                                ).environ
+            status = []
+            app_iter = test_origin(env, lambda s, h: status.append(s))
+            return int(status[0].split()[0]), app_iter
+
+        status, app_iter = call('http://origin_db.com:8080/v1/acc')
+        self.assertEquals(status, 200)
+        # the slot is held until the listing has been sent
+        self.assertEquals(call('http://origin_db.com:8080/v1/acc')[0], 503)
+        self.assertEquals(''.join(app_iter), 'test1\n')
+        app_iter.close()
+        status, app_iter = call('http://origin_db.com:8080/v1/acc')
+        self.assertEquals(status, 200)
+        app_iter.close()
+        # HEADs release it too
+        status, app_iter = call('http://origin_db.com:8080/v1/acc/cont',
+                                'HEAD')
+        app_iter.close()
+        self.assertEquals(test_origin.concurrency_limits[
+            'origin_db'].semaphore.counter, 1)
+        self.assertEquals(test_origin.metrics.counters[
+            ('sos_shed_total', ('origin_db',))], 1)
+        # cdn requests are not limited by default
+        self.assertFalse('cdn' in test_origin.concurrency_limits)
+
+    def test_metadata_stale_and_breaker(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'metadata_breaker_failures = 2')
+        memcache = FakeMemcache()
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('204 No Content', {}, prev_data),
+                          ('200 Ok', {}, 'Test obj body.'),
+                          ('503 Service Unavailable', {}, ''),
+                          ('200 Ok', {}, 'Test obj body.'),
+                          ('503 Service Unavailable', {}, '')])))
+
+        def get(memcache):
+            req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+                environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+            return req.get_response(test_origin)
+
+        self.assertEquals(get(memcache).status_int, 200)
+        stale_keys = [key for key in memcache.store
+                      if key.startswith('sos-stale/')]
+        self.assertEquals(len(stale_keys), 1)
+        self.assertEquals(memcache.timeouts[stale_keys[0]], 86400)
+        for key in memcache.store.keys():
+            if key not in stale_keys:
+                del memcache.store[key]
+        # the store fails, the stale copy is used
+        self.assertEquals(get(memcache).status_int, 200)
+        # without one the request fails, and the breaker opens
+        resp = get(FakeMemcache())
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(resp.headers['Retry-After'], '30')
+        self.assertEquals(test_origin.metadata_breaker.state, 'open')
+        calls = test_origin.app.calls
+        self.assertEquals(get(FakeMemcache()).status_int, 503)
+        self.assertEquals(test_origin.app.calls, calls)
+        counters = test_origin.metrics.counters
+        self.assertEquals(counters[('sos_cdn_data_cache_total', ('stale',))],
+                          1)
+        self.assertEquals(counters[('sos_breaker_transitions_total',
+                                    ('metadata', 'open'))], 1)
+
+    def test_metadata_hedge(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'metadata_hedge_fraction = 0.5')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('503 Service Unavailable', {}, ''),
+                          ('204 No Content', {}, prev_data),
+                          ('200 Ok', {}, 'Test obj body.')])))
+        test_origin.metadata_hedger.observe(0.001)
+        req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+            environ={'REQUEST_METHOD': 'GET', 'swift.cache': FakeMemcache()})
+        resp = req.get_response(test_origin)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.body, 'Test obj body.')
+        self.assertEquals(test_origin.metrics.counters[
+            ('sos_hedged_requests_total', ('metadata', 'won'))], 1)
+
+    def test_collapse_requests(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'collapse_requests = true')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('204 No Content', {}, prev_data),
+                          ('200 Ok', {'Content-Length': 14}, 'Test obj body.'),
+                          ('200 Ok', {'Content-Length': 14}, 'Test obj body.')
+                          ])))
+        memcache = FakeMemcache()
+        for method in ('GET', 'HEAD'):
+            req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+                environ={'REQUEST_METHOD': method, 'swift.cache': memcache})
+            resp = req.get_response(test_origin)
+            self.assertEquals(resp.status_int, 200)
+            self.assertEquals(resp.content_length, 14)
+            if method == 'GET':
+                self.assertEquals(resp.body, 'Test obj body.')
+        self.assertEquals(test_origin.metrics.counters[
+            ('sos_collapsed_requests_total', ('fetched',))], 1)
+        self.assertEquals(test_origin.collapser.fetches, {})
+
+    def test_object_cache(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'object_cache_size = 1024')
+        swift = {'etag': 'abc', 'body': 'Test obj body.'}
+        requests = []
+
+        def app(env, start_response):
+            requests.append(env['REQUEST_METHOD'])
+            if env['PATH_INFO'].startswith('/v1/.origin/'):
+                start_response('204 No Content', [])
+                return [prev_data]
+            start_response('200 Ok', [
+                ('Content-Length', str(len(swift['body']))),
+                ('Etag', swift['etag']), ('Content-Type', 'text/plain')])
+            if env['REQUEST_METHOD'] == 'HEAD':
+                return ['']
+            return [swift['body']]
+
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+        memcache = FakeMemcache()
+
+        def get(headers=None):
+            req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+                environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache},
+                headers=headers or {})
+            return req.get_response(test_origin)
+
+        self.assertEquals(get().body, 'Test obj body.')
+        del requests[:]
+        resp = get()
+        # only a HEAD to check the etag, the body comes from memory
+        self.assertEquals(requests, ['HEAD'])
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.body, 'Test obj body.')
+        self.assertEquals(resp.etag, 'abc')
+        self.assertEquals(resp.content_type, 'text/plain')
+        self.assertEquals(resp.headers['Cache-Control'],
+                          'max-age:1234, public')
+        resp = get({'Range': 'bytes=5-7'})
+        self.assertEquals(resp.status_int, 206)
+        self.assertEquals(resp.body, 'obj')
+        self.assertEquals(resp.headers['Content-Range'], 'bytes 5-7/14')
+        self.assertEquals(get({'Range': 'bytes=20-'}).status_int, 416)
+        self.assertEquals(get({'If-None-Match': '"abc"'}).status_int, 304)
+        self.assertEquals(get({'If-Match': '"abc"'}).status_int, 200)
+        self.assertEquals(get({'If-Match': '"def"'}).status_int, 412)
+        counters = test_origin.metrics.counters
+        self.assertEquals(counters[('sos_object_cache_total', ('stored',))],
+                          1)
+        self.assertEquals(counters[('sos_object_cache_total', ('hit',))], 6)
+        # an object overwritten in swift is not served from its old copy
+        swift.update(etag='def', body='New obj body.')
+        del requests[:]
+        self.assertEquals(get().body, 'New obj body.')
+        self.assertEquals(requests, ['HEAD', 'GET'])
+        self.assertEquals(get().body, 'New obj body.')
+        self.assertEquals(counters[('sos_object_cache_total', ('stored',))],
+                          2)
+        # changing the container drops its objects
+        test_origin.app = FakeApp(iter([
+            ('204 No Content', {}, prev_data), # call to _get_cdn_data
+            ('204 No Content', {}, ''), # put to .hash file
+            ('204 No Content', {}, ''), # HEAD listing container
+            ('204 No Content', {}, ''), # post to listing
+            ]))
+        req = Request.blank('http://origin_db.com:8080/v1/acc/cont',
+            environ={'REQUEST_METHOD': 'POST'},
+            headers={'X-CDN-Enabled': 'false'})
+        self.assertEquals(req.get_response(test_origin).status_int, 202)
+        self.assertEquals(test_origin.object_cache.entries, {})
+
+    def test_object_cache_closes_swift_body(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        bodies = []
+
+        def app(env, start_response):
+            if env['PATH_INFO'].startswith('/v1/.origin/'):
+                start_response('200 Ok', [])
+                return [prev_data]
+            start_response('200 Ok', [('Content-Length', '14'),
+                                      ('Etag', 'abc')])
+            bodies.append(ClosingIter(['Test obj ', 'body.']))
+            return bodies[-1]
+
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'object_cache_size = 1024')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(app)
+        env = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+            environ={'REQUEST_METHOD': 'GET',
+                     'swift.cache': FakeMemcache()}).environ
+        # a client that goes away part way through
+        app_iter = test_origin(env, lambda *args: None)
+        self.assertEquals(iter(app_iter).next(), 'Test obj ')
+        app_iter.close()
+        self.assertTrue(bodies[-1].closed)
+        self.assertEquals(test_origin.object_cache.entries, {})
+        req = Request.blank('http://1234.r3.origin_cdn.com:8080/obj1.jpg',
+            environ={'REQUEST_METHOD': 'GET', 'swift.cache': FakeMemcache()})
+        self.assertEquals(req.get_response(test_origin).body,
+                          'Test obj body.')
+        self.assertTrue(bodies[-1].closed)
+        self.assertEquals(len(test_origin.object_cache.entries), 1)
+
+    def test_counting_iter(self):
+        metrics = Metrics()
+        body = ClosingIter(['abc', 'de'])
+        app_iter = origin.CountingIter(body, metrics)
+        self.assertEquals(list(app_iter), ['abc', 'de'])
+        self.assertFalse(body.closed)
+        app_iter.close()
+        app_iter.close()
+        self.assertTrue(body.closed)
+        self.assertEquals(
+            metrics.counters[('sos_streamed_bytes_total', ())], 5)
+        # closed before it was ever iterated
+        body = ClosingIter(['abc'])
+        origin.CountingIter(body, metrics).close()
+        self.assertTrue(body.closed)
+        self.assertEquals(
+            metrics.counters[('sos_streamed_bytes_total', ())], 5)
+
+    def test_caching_iter(self):
+        stored = []
+        body = ClosingIter(['abc', 'de'])
+        app_iter = origin.CachingIter(body, stored.append)
+        self.assertEquals(list(app_iter), ['abc', 'de'])
+        self.assertEquals(stored, ['abcde'])
+        app_iter.close()
+        self.assertTrue(body.closed)
+        # closed before it was ever iterated
+        body = ClosingIter(['abc'])
+        origin.CachingIter(body, stored.append).close()
+        self.assertTrue(body.closed)
+        self.assertEquals(stored, ['abcde'])
+
+    def test_block_cache(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        testdir = mkdtemp()
+        try:
+            fake_conf = FakeConf()
+            fake_conf.data.insert(1, 'block_cache_dir = %s' % testdir)
+            fake_conf.data.insert(1, 'block_cache_block_size = 4')
+            fake_conf.data.insert(1, 'block_cache_min_object_size = 8')
+
+            def block(first, body):
+                last = first + len(body) - 1
+                return ('206 Partial Content', {
+                    'Content-Range': 'bytes %d-%d/16' % (first, last),
+                    'Content-Length': len(body), 'Etag': 'abc',
+                    'Content-Type': 'video/mp4'}, body,
+                    lambda req: req.headers['Range'] !=
+                        'bytes=%d-%d' % (first, last) and 'bad range')
+
+            test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+                FakeApp(iter([('204 No Content', {}, prev_data),
+                              block(2, 'cdef'), block(0, 'abcd'),
+                              block(4, 'efgh'), block(8, 'ijkl')])))
+            memcache = FakeMemcache()
+
+            def get(range_header):
+                req = Request.blank(
+                    'http://1234.r3.origin_cdn.com:8080/obj1.mp4',
+                    environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache},
+                    headers={'Range': range_header})
+                return req.get_response(test_origin)
+
+            # the first request tells the size and etag of the object
+            self.assertEquals(get('bytes=2-5').body, 'cdef')
+            resp = get('bytes=3-9')
+            self.assertEquals(resp.status_int, 206)
+            self.assertEquals(resp.body, 'defghij')
+            self.assertEquals(resp.headers['Content-Range'], 'bytes 3-9/16')
+            self.assertEquals(resp.content_type, 'video/mp4')
+            self.assertEquals(resp.etag, 'abc')
+            calls = test_origin.app.calls
+            self.assertEquals(get('bytes=5-6').body, 'fg')
+            self.assertEquals(test_origin.app.calls, calls)
+            counters = test_origin.metrics.counters
+            self.assertEquals(counters[('sos_block_cache_total', ('miss',))],
+                              3)
+        finally:
+            rmtree(testdir)
+
+    def test_metadata_stale_after_change(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'metadata_breaker_failures = 1')
+        memcache = FakeMemcache()
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('204 No Content', {}, prev_data),
+                          ('200 Ok', {}, 'Test obj body.'),
+                          ('204 No Content', {}, ''), # put to .hash file
+                          ('204 No Content', {}, ''), # HEAD listing cont
+                          ('204 No Content', {}, ''), # post to listing
+                          ('503 Service Unavailable', {}, ''),
+                          ('204 No Content', {}, ''), # DELETE .hash file
+                          ('204 No Content', {}, ''), # DELETE listing row
+                          ])))
+        hsh = origin.OriginBase(FakeApp(), test_origin.conf,
+                                FakeLogger()).hash_path('acc', 'cont')
+
+        def cdn_get():
+            # the fresh copy has expired
+            for key in memcache.store.keys():
+                if not key.startswith('sos-stale/'):
+                    del memcache.store[key]
+            req = Request.blank(
+                'http://%s.r3.origin_cdn.com:8080/obj1.jpg' % hsh,
+                environ={'REQUEST_METHOD': 'GET', 'swift.cache': memcache})
+            return req.get_response(test_origin)
+
+        self.assertEquals(cdn_get().status_int, 200)
+        req = Request.blank('http://origin_db.com:8080/v1/acc/cont',
+            environ={'REQUEST_METHOD': 'POST', 'swift.cache': memcache},
+            headers={'X-CDN-Enabled': 'false'})
+        self.assertEquals(req.get_response(test_origin).status_int, 202)
+        # the store fails and opens the breaker, the stale copy is disabled
+        self.assertEquals(cdn_get().status_int, 404)
+        self.assertEquals(test_origin.metadata_breaker.state, 'open')
+        self.assertEquals(cdn_get().status_int, 404)
+        # once deleted there is no stale copy to serve
+        req = Request.blank('http://origin_db.com:8080/v1/acc/cont',
+            environ={'REQUEST_METHOD': 'DELETE', 'swift.cache': memcache})
+        self.assertEquals(req.get_response(test_origin).status_int, 204)
+        self.assertFalse([key for key in memcache.store if hsh in key])
+        self.assertEquals(cdn_get().status_int, 503)
+
+    def test_format_timings(self):
+        env = {'sos.timings': [('metadata', 0.25), ('memcache', 0.125),
+                               ('metadata', 0.25)]}
+        self.assertEquals(origin.format_timings(env['sos.timings'], 1),
+            'metadata:0.5000,memcache:0.1250,sos:0.3750,total:1.0000')
+        self.assertEquals(origin.format_timings((), 0.5),
+                          'sos:0.5000,total:0.5000')
+        origin.add_timing(env, 'swift', origin.monotonic())
+        self.assertEquals(env['sos.timings'][-1][0], 'swift')
+        self.assertTrue(env['sos.timings'][-1][1] >= 0)
+
+    def test_access_log(self):
+        prev_data = json.dumps({'account': 'acc', 'container': 'cont',
+                'ttl': 1234, 'logs_enabled': True, 'cdn_enabled': True})
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'access_log_buffer_size = 2')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([('204 No Content', {}, prev_data),
+                          ('200 Ok', {'Content-Length': '14'},
+                           'Test obj body.')] +
+                         [('404 Not Found', {}, '')] * 2)))
+        test_origin.logger = logger = FakeLogger()
+        logger.info_calls = []
+        logger.info = lambda msg: logger.info_calls.append(msg)
+        logger.warning = lambda msg: logger.info_calls.append(msg)
+        for path in ('/obj1.jpg', '/obj2.jpg', '/obj3.jpg'):
+            req = Request.blank('http://1234.r3.origin_cdn.com:8080' + path,
+                environ={'REQUEST_METHOD': 'GET',
+                         'swift.cache': FakeMemcache()},
+                headers={'X-Forwarded-For': '1.2.3.4, 5.6.7.8'})
+            req.get_response(test_origin)
+        # nothing is written until the request green threads yield
+        self.assertEquals(logger.info_calls, [])
+        self.assertEquals(len(test_origin.access_log), 2)
+        self.assertEquals(test_origin.metrics.counters[
+            ('sos_access_log_dropped_total', ())], 1)
+        sleep()
+        self.assertEquals(len(logger.info_calls), 3)
+        fields = logger.info_calls[0].split()
+        self.assertEquals(fields[0], '1.2.3.4')
+        self.assertEquals(fields[3:8], ['GET', '1234.r3.origin_cdn.com%3A8080',
+                                        '/obj1.jpg', 'HTTP/1.0', '200'])
+        self.assertEquals(fields[14:17], ['1234', '14', '1'])
+        self.assertTrue(fields[17].startswith('memcache:'))
+        self.assertEquals(logger.info_calls[1].split()[14:17],
+                          ['-', '-', '1'])
+        self.assertEquals(logger.info_calls[2],
+                          'Dropped 1 access log records, buffer full')
+        # the writer stops once it finds the buffer empty
+        sleep()
+        self.assertFalse(test_origin.access_log_writing)
+
+    def test_access_log_sampling(self):
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'access_log_buffer_size = 0')
+        fake_conf.data.insert(1, 'access_log_sample_rate = 0.25')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([])))
+        test_origin.logger = logger = FakeLogger()
+        logger.info_calls = []
+        logger.info = lambda msg: logger.info_calls.append(msg)
+
+        def log(status_int, trans_time=0):
+            env = Request.blank('/v1/acc').environ
+            env['sos.start_time'] = time() - trans_time
+            test_origin._log_request(env, status_int)
+
+        orig_random = origin.random
+        try:
+            origin.random = lambda: 0.5
+            log(200)
+            log(404)
+            self.assertEquals(logger.info_calls, [])
+            # errors and slow requests are always logged
+            log(503)
+            log(200, trans_time=2)
+            self.assertEquals([line.split()[16] for line in
+                               logger.info_calls], ['1', '1'])
+            origin.random = lambda: 0.1
+            log(200)
+            self.assertEquals(logger.info_calls[-1].split()[16], '4')
+        finally:
+            origin.random = orig_random
+
+    def test_access_log_target_rate(self):
+        fake_conf = FakeConf()
+        fake_conf.data.insert(1, 'access_log_target_rate = 10')
+        fake_conf.data.insert(1, 'access_log_sample_rate = 0.5')
+        test_origin = origin.filter_factory({'sos_conf': fake_conf})(
+            FakeApp(iter([])))
+        start = test_origin.sample_window_start
+        self.assertEquals(test_origin.get_sample_rate(start), 0.5)
+        for i in xrange(98):
+            test_origin.get_sample_rate(start + 0.5)
+        # 100 requests in 2 secs is 50/sec, 10/sec of which should be logged
+        self.assertEquals(test_origin.get_sample_rate(start + 2), 0.2)
+        self.assertEquals(test_origin.get_sample_rate(start + 2.5), 0.2)
+        # never above access_log_sample_rate
+        self.assertEquals(test_origin.get_sample_rate(start + 12), 0.5)
+
     def test_cdn_get_disabled(self):
         prev_data = json.dumps({'account': 'acc', 'container': 'cont',
                 'ttl': 1234, 'logs_enabled': 'true', 'cdn_enabled': False})
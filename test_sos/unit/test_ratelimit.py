@@ -0,0 +1,68 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from sos import ratelimit
+
+
+class FakeMemcache(object):
+
+    def __init__(self):
+        self.store = {}
+
+    def incr(self, key, delta=1, timeout=0):
+        self.store[key] = self.store.get(key, 0) + delta
+        return self.store[key]
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_token_buckets(self):
+        buckets = ratelimit.TokenBuckets(2, burst=3, max_entries=2)
+        self.assertEquals([buckets.take('a', 100) for i in xrange(4)],
+                          [0, 0, 0, 0.5])
+        # the failed take didn't use a token
+        self.assertEquals(buckets.take('a', 100.25), 0.25)
+        self.assertEquals(buckets.take('a', 100.5), 0)
+        buckets.take('b', 100.5)
+        buckets.take('c', 100.5)
+        # 'a' was the least recently used, it comes back full
+        self.assertEquals(sorted(buckets.buckets), ['b', 'c'])
+        self.assertEquals(buckets.take('a', 100.5), 0)
+        self.assertEquals(buckets.buckets['a'][0], 2)
+
+    def test_rate_limiter(self):
+        self.assertFalse(ratelimit.RateLimiter({}))
+        limiter = ratelimit.RateLimiter({'ratelimit_account_rate': '10',
+                                         'ratelimit_memcache': 'true'})
+        self.assertTrue(limiter)
+        self.assertFalse(limiter.limits('hash'))
+        self.assertEquals(limiter.check('hash', 'abc', now=0), 0)
+        memcache = FakeMemcache()
+        # another proxy already used this second's requests
+        memcache.store['sos-ratelimit/account/acc/100'] = 10
+        self.assertEquals(limiter.check('account', 'acc', memcache,
+                                        now=100.75), 0.25)
+        self.assertEquals(limiter.check('account', 'acc', memcache,
+                                        now=101), 0)
+        self.assertEquals(memcache.store['sos-ratelimit/account/acc/101'], 1)
+        self.assertEquals(ratelimit.retry_after(0.25), 1)
+        self.assertEquals(ratelimit.retry_after(2.5), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
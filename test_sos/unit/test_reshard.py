@@ -0,0 +1,200 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from contextlib import contextmanager
+from hashlib import md5
+
+from eventlet import sleep, spawn
+from eventlet.event import Event
+from webob import Request, Response
+
+from sos import origin, reshard
+from sos.utils import Checkpoint, ClientException, split_hsh_obj_path
+
+
+class FakeLogger(object):
+
+    def info(self, *args, **kwargs):
+        pass
+
+    def exception(self, *args, **kwargs):
+        raise Exception(args)
+
+
+class FakeConn(object):
+
+    def __init__(self, containers):
+        self.containers = containers
+        # called after each get_object and put_object, as a concurrent
+        # request
+        self.after_get = None
+        self.after_put = None
+
+    def get_container(self, container, marker='', limit=None):
+        return {}, [{'name': name} for name in
+                    sorted(self.containers.get(container, {}))
+                    if name > marker][:limit]
+
+    def _get(self, container, obj):
+        try:
+            return self.containers[container][obj]
+        except KeyError:
+            raise ClientException('not found', http_status=404)
+
+    def head_object(self, container, obj):
+        return {'etag': md5(self._get(container, obj)).hexdigest()}
+
+    def get_object(self, container, obj):
+        body = self._get(container, obj)
+        if self.after_get:
+            self.after_get(container, obj)
+        return {}, body
+
+    def put_object(self, container, obj, body, etag=None, headers=None):
+        self.containers.setdefault(container, {})[obj] = body
+        if self.after_put:
+            self.after_put(container, obj)
+
+    def delete_object(self, container, obj):
+        self._get(container, obj)
+        del self.containers[container][obj]
+
+
+class FakeConnPool(object):
+
+    def __init__(self, containers):
+        self.conn = FakeConn(containers)
+
+    @contextmanager
+    def item(self):
+        yield self.conn
+
+
+class TestResharder(unittest.TestCase):
+
+    def test_move(self):
+        conf = {'hash_path_suffix': 'testing',
+                'number_hash_id_containers': '6',
+                'hash_placement': 'jump',
+                'previous_number_hash_id_containers': '4',
+                'previous_hash_placement': 'mod'}
+        containers = {}
+        resharder = reshard.Resharder(conf, FakeConnPool(containers),
+                                      Checkpoint(None), FakeLogger())
+        hashes = [md5(str(i)).hexdigest() for i in xrange(50)]
+        for hsh in hashes:
+            containers.setdefault('.origin/.hash_%d' % (int(hsh, 16) % 4),
+                                  {})[hsh] = 'data %s' % hsh
+        # a write that happened during resharding
+        new_cont = split_hsh_obj_path(
+            resharder.origin.get_hsh_obj_path(hashes[0]))[0]
+        old_cont = '.origin/.hash_%d' % (int(hashes[0], 16) % 4)
+        if new_cont != old_cont:
+            containers.setdefault(new_cont, {})[hashes[0]] = 'new'
+        stats = resharder.run()
+        for hsh in hashes:
+            cont = split_hsh_obj_path(
+                resharder.origin.get_hsh_obj_path(hsh))[0]
+            self.assertTrue(hsh in containers[cont])
+            self.assertEquals(sum(hsh in objs
+                                  for objs in containers.values()), 1)
+        if new_cont != old_cont:
+            self.assertEquals(containers[new_cont][hashes[0]], 'new')
+        to_move = [hsh for hsh in hashes
+                   if int(hsh, 16) % 4 != origin.jump_placement(hsh, 6)]
+        self.assertTrue(to_move)
+        self.assertEquals(stats['moved'] + stats.get('superseded', 0),
+                          len(to_move))
+
+    def test_delete_during_move(self):
+        conf = {'hash_path_suffix': 'testing',
+                'number_hash_id_containers': '6',
+                'previous_number_hash_id_containers': '4'}
+        containers = {}
+        pool = FakeConnPool(containers)
+        resharder = reshard.Resharder(conf, pool, Checkpoint(None),
+                                      FakeLogger())
+        hsh = [hsh for hsh in (md5(str(i)).hexdigest() for i in xrange(100))
+               if int(hsh, 16) % 4 != int(hsh, 16) % 6][0]
+        old_cont = '.origin/.hash_%d' % (int(hsh, 16) % 4)
+        new_cont = '.origin/.hash_%d' % (int(hsh, 16) % 6)
+        containers[old_cont] = {hsh: 'data'}
+
+        def delete(container, obj):
+            # the container's DELETE, which finds nothing at new_cont yet
+            pool.conn.after_put = None
+            del containers[old_cont][hsh]
+
+        pool.conn.after_put = delete
+        stats = resharder.run()
+        self.assertEquals(stats['deleted_during_move'], 1)
+        self.assertFalse(stats.get('moved'))
+        self.assertEquals(containers[new_cont], {})
+        self.assertEquals(containers[old_cont], {})
+
+    def test_metadata_delete_during_move(self):
+        conf = {'hash_path_suffix': 'testing',
+                'number_hash_id_containers': '6',
+                'previous_number_hash_id_containers': '4'}
+        containers = {}
+        pool = FakeConnPool(containers)
+        resharder = reshard.Resharder(conf, pool, Checkpoint(None),
+                                      FakeLogger())
+        hsh = [hsh for hsh in (md5(str(i)).hexdigest() for i in xrange(100))
+               if int(hsh, 16) % 4 != int(hsh, 16) % 6][0]
+        old_cont = '.origin/.hash_%d' % (int(hsh, 16) % 4)
+        new_cont = '.origin/.hash_%d' % (int(hsh, 16) % 6)
+        containers[old_cont] = {hsh: 'data'}
+        deletes = []
+        second_delete = Event()
+
+        def app(env, start_response):
+            # the origin db's swift, which holds back the second DELETE of
+            # the store until the move is done
+            req = Request(env)
+            if deletes:
+                second_delete.wait()
+            deletes.append(req.path_info)
+            cont, obj = req.path_info[len('/v1/'):].rsplit('/', 1)
+            try:
+                pool.conn.delete_object(cont, obj)
+            except reshard.ClientException:
+                return Response(status=404)(env, start_response)
+            return Response(status=204)(env, start_response)
+
+        store = origin.OriginBase(app, conf, FakeLogger()).metadata_store
+        deleting = []
+
+        def delete(container, obj):
+            # the container's DELETE, between the move's GET and PUT
+            pool.conn.after_get = None
+            deleting.append(spawn(store.delete, Request.blank('/').environ,
+                                  hsh))
+            sleep()
+
+        pool.conn.after_get = delete
+        stats = resharder.run()
+        second_delete.send()
+        self.assertTrue(deleting[0].wait())
+        self.assertEquals(deletes, ['/v1/%s/%s' % (cont, hsh)
+                                    for cont in (old_cont, new_cont)])
+        self.assertEquals(stats['deleted_during_move'], 1)
+        self.assertEquals(containers[new_cont], {})
+        self.assertEquals(containers[old_cont], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# Copyright (c) 2010-2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from sos import sketch
+
+
+class TestSketch(unittest.TestCase):
+
+    def test_count_min_sketch(self):
+        cms = sketch.CountMinSketch(width=64, depth=3)
+        counts = {}
+        for i in xrange(1000):
+            key = 'hash%d' % (i % 100 if i % 2 else 0)
+            counts[key] = counts.get(key, 0) + 1
+            cms.add(key)
+        for key, count in counts.items():
+            self.assertTrue(cms.estimate(key) >= count)
+        self.assertTrue(cms.estimate('hash0') < 600)
+        cms.scale(0.5)
+        self.assertTrue(cms.estimate('hash0') >= 250)
+
+    def test_hot_hashes(self):
+        hot = sketch.HotHashes(top_k=2, width=256, depth=4, half_life=10,
+                               candidates=3)
+        start = hot.landmark
+        for i in xrange(100):
+            hot.add('cold%d' % i, now=start)
+            for j in xrange(5):
+                hot.add('hot', now=start)
+        top = hot.top(now=start)
+        self.assertEquals(top[0][0], 'hot')
+        self.assertEquals(len(top), 2)
+        self.assertEquals(len(hot.candidates), 3)
+        # 500 requests decayed over tau seconds
+        self.assertAlmostEquals(top[0][1], 500 / hot.tau, 3)
+        # one half life later the rate has halved
+        self.assertAlmostEquals(hot.top(1, now=start + 10)[0][1],
+                                250 / hot.tau, 3)
+        # a new hash takes over once it is hotter, even when the weights
+        # have been rescaled on the way
+        now = start + 1000
+        for i in xrange(600):
+            hot.add('new', now=now)
+        self.assertTrue(hot.landmark > start)
+        self.assertEquals(hot.top(1, now=now)[0][0], 'new')
+        self.assertAlmostEquals(hot.top(1, now=now)[0][1], 600 / hot.tau, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()